@@ -0,0 +1,301 @@
+"""
+audience_index.py - Индексы пользователей для выборки аудитории рассылок
+
+Вместо перебора всех пользователей выборка пересекает готовые множества:
+username, язык, дневные корзины активности и отсортированные списки по
+балансу и сумме депозитов. Индексы обновляются точечно при изменении
+пользователя.
+"""
+
+import bisect
+import time
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from user_search import UserSearchIndex
+
+DAY = 86400
+
+# Поля с отсортированными индексами: позиция в строке индекса
+SORT_FIELDS = {"last_active": 2, "balance": 3, "total_deposited": 4}
+LAST_ACTIVE = SORT_FIELDS["last_active"]
+
+
+def sort_value(pos: int, row: Tuple) -> float:
+    """Значение поля в отсортированном индексе.
+
+    last_active упорядочен по дням: активность обновляется на каждом
+    действии, и переставлять игрока в списке имеет смысл только при смене дня.
+    """
+    if pos == LAST_ACTIVE:
+        return float(int(row[pos] // DAY) * DAY)
+    return row[pos]
+
+
+class _RangeIndex:
+    """Отсортированный список (значение, user_id) для выборки по диапазону"""
+
+    def __init__(self):
+        self._items: List[Tuple[float, int]] = []
+
+    def build(self, pairs: Iterable[Tuple[float, int]]):
+        self._items = sorted(pairs)
+
+    def add(self, value: float, uid: int):
+        bisect.insort(self._items, (value, uid))
+
+    def remove(self, value: float, uid: int):
+        pos = bisect.bisect_left(self._items, (value, uid))
+        if pos < len(self._items) and self._items[pos] == (value, uid):
+            del self._items[pos]
+
+    def walk(self, after: Optional[Tuple[float, int]] = None, reverse: bool = False) -> Iterator[Tuple[float, int]]:
+        """Элементы по порядку, начиная строго после after"""
+        if not reverse:
+            start = bisect.bisect_right(self._items, after) if after is not None else 0
+            for i in range(start, len(self._items)):
+                yield self._items[i]
+        else:
+            start = bisect.bisect_left(self._items, after) if after is not None else len(self._items)
+            for i in range(start - 1, -1, -1):
+                yield self._items[i]
+
+    def between(self, low: Optional[float], high: Optional[float]) -> Set[int]:
+        start = bisect.bisect_left(self._items, (low,)) if low is not None else 0
+        end = bisect.bisect_right(self._items, (high, float("inf"))) if high is not None else len(self._items)
+        return {uid for _, uid in self._items[start:end]}
+
+
+class AudienceIndex:
+    """Индексы по пользователям для быстрых выборок сегментов"""
+
+    def __init__(self):
+        self._reset()
+
+    def _reset(self):
+        self._rows: Dict[int, Tuple] = {}
+        self._by_username: Dict[str, Set[int]] = {}
+        self._by_language: Dict[str, Set[int]] = {}
+        self._by_day: Dict[int, Set[int]] = {}
+        self._blocked: Set[int] = set()
+        self._ids = _RangeIndex()
+        self._ranges = {pos: _RangeIndex() for pos in SORT_FIELDS.values()}
+        self._total_balance = 0.0
+        self._total_deposited = 0.0
+        # Выбор языка из locales для записей users.json без поля language
+        self._languages: Dict[str, str] = {}
+        self.search = UserSearchIndex()
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def _row(self, uid: int, user: Dict[str, Any]) -> Tuple:
+        return (
+            (user.get("username") or "").lower(),
+            user.get("language") or self._languages.get(str(uid)) or "ru",
+            float(user.get("last_active") or 0),
+            float(user.get("balance") or 0),
+            float(user.get("total_deposited") or 0),
+            bool(user.get("is_blocked")),
+        )
+
+    def rebuild(self, users: Dict[str, Dict[str, Any]], languages: Optional[Dict[str, str]] = None):
+        """Построить индексы заново по словарю users.json.
+
+        languages - выбор языка из locales, если его нет в записи пользователя.
+        """
+        self._reset()
+        self._languages = dict(languages or {})
+        for uid_str, user in users.items():
+            uid = int(user.get("id") or uid_str)
+            row = self._row(uid, user)
+            self._rows[uid] = row
+            self._link(uid, row, ranges=False)
+        self._ids.build((uid, uid) for uid in self._rows)
+        self.search.rebuild({uid: row[0] for uid, row in self._rows.items()})
+        for pos, index in self._ranges.items():
+            index.build((sort_value(pos, row), uid) for uid, row in self._rows.items())
+
+    def update(self, uid: int, user: Dict[str, Any]):
+        """Обновить индексы одного пользователя"""
+        row = self._row(uid, user)
+        old = self._rows.get(uid)
+        if old == row:
+            return
+        self._rows[uid] = row
+        if old is None:
+            self._link(uid, row)
+            return
+
+        username, language, last_active, balance, deposited, blocked = row
+        if username != old[0]:
+            self._move(self._by_username, old[0], username or None, uid)
+            self.search.update(uid, username)
+        if language != old[1]:
+            self._move(self._by_language, old[1], language, uid)
+        if int(last_active // DAY) != int(old[2] // DAY):
+            self._move(self._by_day, int(old[2] // DAY), int(last_active // DAY), uid)
+        for pos, index in self._ranges.items():
+            old_value, value = sort_value(pos, old), sort_value(pos, row)
+            if value != old_value:
+                index.remove(old_value, uid)
+                index.add(value, uid)
+        self._total_balance += balance - old[3]
+        self._total_deposited += deposited - old[4]
+        if blocked:
+            self._blocked.add(uid)
+        else:
+            self._blocked.discard(uid)
+
+    def remove(self, uid: int):
+        old = self._rows.pop(uid, None)
+        if old is None:
+            return
+        username, language, last_active, balance, deposited, _ = old
+        self._move(self._by_username, username, None, uid)
+        self._move(self._by_language, language, None, uid)
+        self._move(self._by_day, int(last_active // DAY), None, uid)
+        self._blocked.discard(uid)
+        self._ids.remove(uid, uid)
+        self.search.remove(uid)
+        for pos, index in self._ranges.items():
+            index.remove(sort_value(pos, old), uid)
+        self._total_balance -= balance
+        self._total_deposited -= deposited
+
+    @staticmethod
+    def _move(index: Dict[Any, Set[int]], old_key: Any, new_key: Any, uid: int):
+        ids = index.get(old_key)
+        if ids is not None:
+            ids.discard(uid)
+            if not ids:
+                del index[old_key]
+        if new_key is not None:
+            index.setdefault(new_key, set()).add(uid)
+
+    def _link(self, uid: int, row: Tuple, ranges: bool = True):
+        username, language, last_active, balance, deposited, blocked = row
+        if username:
+            self._by_username.setdefault(username, set()).add(uid)
+        self._by_language.setdefault(language, set()).add(uid)
+        self._by_day.setdefault(int(last_active // DAY), set()).add(uid)
+        if blocked:
+            self._blocked.add(uid)
+        self._total_balance += balance
+        self._total_deposited += deposited
+        if ranges:
+            self._ids.add(uid, uid)
+            self.search.update(uid, username)
+            for pos, index in self._ranges.items():
+                index.add(sort_value(pos, row), uid)
+
+    def _active_since(self, since: float) -> Set[int]:
+        first_day = int(since // DAY)
+        result: Set[int] = set()
+        for day, ids in self._by_day.items():
+            if day > first_day:
+                result |= ids
+            elif day == first_day:
+                # Граничная корзина - проверяем точное время
+                result.update(uid for uid in ids if self._rows[uid][2] >= since)
+        return result
+
+    def select(self, usernames: Optional[Iterable[str]] = None, language: Optional[str] = None,
+               active_days: Optional[float] = None,
+               min_balance: Optional[float] = None, max_balance: Optional[float] = None,
+               min_deposited: Optional[float] = None, max_deposited: Optional[float] = None,
+               include_blocked: bool = False) -> List[int]:
+        """ID пользователей, подходящих под все заданные условия"""
+        candidates: List[Set[int]] = []
+        if usernames is not None:
+            ids: Set[int] = set()
+            for name in usernames:
+                ids |= self._by_username.get(name.lstrip("@").lower(), set())
+            candidates.append(ids)
+        if language:
+            candidates.append(self._by_language.get(language, set()))
+        if active_days:
+            candidates.append(self._active_since(time.time() - active_days * DAY))
+        if min_balance is not None or max_balance is not None:
+            candidates.append(self._ranges[SORT_FIELDS["balance"]].between(min_balance, max_balance))
+        if min_deposited is not None or max_deposited is not None:
+            candidates.append(self._ranges[SORT_FIELDS["total_deposited"]].between(min_deposited, max_deposited))
+
+        if candidates:
+            candidates.sort(key=len)
+            result = set(candidates[0])
+            for ids in candidates[1:]:
+                result &= ids
+                if not result:
+                    break
+        else:
+            result = set(self._rows)
+
+        if not include_blocked:
+            result -= self._blocked
+        return sorted(result)
+
+    def summary(self) -> Dict[str, Any]:
+        """Сводка по пользователям без перебора"""
+        now = time.time()
+        return {
+            "total": len(self._rows),
+            "active_24h": len(self._active_since(now - DAY)),
+            "active_7d": len(self._active_since(now - 7 * DAY)),
+            "blocked": len(self._blocked),
+            "total_balance": self._total_balance,
+            "total_deposited": self._total_deposited,
+        }
+
+    def filter_ids(self, username: Optional[str] = None, id_prefix: Optional[str] = None,
+                   activity: Optional[str] = None) -> Optional[Set[int]]:
+        """Множество ID под фильтры страницы пользователей; None - без фильтров"""
+        candidates: List[Set[int]] = []
+        if username:
+            candidates.append(set(self.search.username_contains(username)))
+        if id_prefix:
+            candidates.append(set(self.search.id_prefix(id_prefix)))
+        if activity:
+            now = time.time()
+            if activity == "active":
+                candidates.append(self._active_since(now - DAY))
+            elif activity == "recent":
+                candidates.append(self._active_since(now - 7 * DAY) - self._active_since(now - DAY))
+            elif activity == "inactive":
+                candidates.append(set(self._rows) - self._active_since(now - 7 * DAY))
+
+        if not candidates:
+            return None
+        candidates.sort(key=len)
+        result = set(candidates[0])
+        for ids in candidates[1:]:
+            result &= ids
+        return result
+
+    def page(self, sort: str = "id", reverse: bool = False, after: Optional[Tuple[float, int]] = None,
+             limit: int = 50, only: Optional[Set[int]] = None) -> Tuple[List[int], Optional[Tuple[float, int]]]:
+        """Страница ID в порядке сортировки после курсора (значение, id).
+
+        Возвращает ID и курсор следующей страницы (None - страниц больше нет).
+        """
+        pos = SORT_FIELDS.get(sort)
+        if only is not None and len(only) <= 4 * limit + 1000:
+            # Фильтр узкий - сортируем только его
+            keyed = sorted(((sort_value(pos, self._rows[uid]) if pos is not None else uid, uid)
+                            for uid in only if uid in self._rows), reverse=reverse)
+            if after is not None:
+                keyed = [k for k in keyed if (k < after if reverse else k > after)]
+            items = iter(keyed)
+        else:
+            index = self._ranges[pos] if pos is not None else self._ids
+            items = index.walk(after, reverse)
+
+        result: List[Tuple[float, int]] = []
+        for item in items:
+            if only is not None and item[1] not in only:
+                continue
+            result.append(item)
+            if len(result) > limit:
+                break
+        if len(result) > limit:
+            return [uid for _, uid in result[:limit]], result[limit - 1]
+        return [uid for _, uid in result], None
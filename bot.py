@@ -11,10 +11,7 @@ import urllib.parse
 import uuid
 
 
-from typing import Dict, Optional, Tuple, Set
-
-
-from collections import defaultdict
+from typing import Callable, Dict, Optional, Tuple, Set
 
 
 import ssl
@@ -44,7 +41,7 @@ from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
 
 
-from aiogram.fsm.storage.memory import MemoryStorage
+from fsm_storage import KVStorage
 
 
 from bs4 import BeautifulSoup
@@ -93,10 +90,19 @@ import daolama_api as dao
 import dao_wallet as ton
 
 
-from xr_pay import create_invoice, check_invoice, usd_to_token
+from xr_pay import create_invoice, usd_to_token
 
 
 from locales import get_text, get_user_lang, set_user_lang, get_language_keyboard
+from wallet_tracker import WalletBalanceTracker
+from ton_watcher import DepositWatcher
+from invoice_poller import InvoicePoller, cryptopay_fetcher, xrocket_fetcher
+from payment_webhooks import PaymentWebhookServer, parse_payload
+from kv_store import KVStore, PersistentDict, PersistentSet
+from throttling import BucketRegistry, Rule, ThrottlingMiddleware
+from progress_renderer import ProgressRenderer
+from quote_cache import QuoteCache, QuoteRefresher
+import send_queue
 
 
 
@@ -131,23 +137,80 @@ logger.add("bot.log", rotation="10 MB", level="INFO")
 logger.add(sys.stderr, level="DEBUG",
            format="{time:HH:mm:ss} | {level} | {message}")
 
-PROCESSING_PURCHASES: Set[str] = set()
-USER_LAST_ACTION: Dict[int, float] = {}
 PURCHASE_COOLDOWN = 3.0
-
-USER_RATE_LIMITS: Dict[int, list] = defaultdict(list)
-RATE_LIMIT_ACTIONS = 10
-RATE_LIMIT_WINDOW = 60
-
-COMPLETED_PURCHASES: Dict[str, float] = {}
 PURCHASE_CACHE_TTL = 3600
-
-_rate_cache = {"ts": 0, "usd": 0.0, "rub": 0.0}
-
-PENDING_PAYMENTS: Dict[str, Tuple[int, float]] = {}
-USER_PAYMENTS: Dict[int, str] = {}
 PAYMENT_TIMEOUT = 1800
 MIN_DEPOSIT = 0.1
+PAID_INVOICE_TTL = 7 * 86400
+
+# Состояние платежей и покупок на диске, чтобы переживать перезапуски
+STATE_DB_PATH = os.getenv("STATE_DB_PATH", "data/state.db")
+state_store = KVStore(STATE_DB_PATH)
+
+# Покупки в обработке - только в памяти: после падения метка не должна
+# блокировать purchase_id, повтор отсекает COMPLETED_PURCHASES
+PROCESSING_PURCHASES: Set[str] = set()
+state_store.clear("processing_purchases")
+
+RATE_LIMIT_ACTIONS = 10
+RATE_LIMIT_WINDOW = 60
+RATE_LIMIT_RULE = Rule(RATE_LIMIT_WINDOW, burst=RATE_LIMIT_ACTIONS,
+                       message="⚠️ Too many requests. Please wait.")
+
+# Ограничения частоты по командам ("cmd:<команда>") и префиксам callback_data ("cb:<префикс>")
+CASINO_COMMAND_RULE = Rule(3, burst=2)
+THROTTLE_RULES: Dict[str, Rule] = {
+    "cb:buygo:": Rule(PURCHASE_COOLDOWN, message="⏳ Please wait a few seconds between purchases"),
+    "cb:withdraw_confirm": Rule(PURCHASE_COOLDOWN),
+    "cmd:dice": CASINO_COMMAND_RULE,
+    "cmd:football": CASINO_COMMAND_RULE,
+    "cmd:basketball": CASINO_COMMAND_RULE,
+    "cmd:darts": CASINO_COMMAND_RULE,
+    "cmd:bowling": CASINO_COMMAND_RULE,
+    "cmd:slot": CASINO_COMMAND_RULE,
+    "cmd:star": Rule(2, burst=2),
+    "cmd:top": Rule(5, burst=2),
+}
+THROTTLE_MAX_KEYS = 100000
+throttle_registry = BucketRegistry(max_keys=THROTTLE_MAX_KEYS)
+
+# purchase_id -> timestamp
+COMPLETED_PURCHASES: PersistentDict = PersistentDict(state_store, "completed_purchases", ttl=PURCHASE_CACHE_TTL)
+
+# Курсы и баланс кошелька, общие с админ-панелью
+QUOTES_FILE = os.getenv("QUOTES_FILE", "data/quotes.json")
+RATES_REFRESH_INTERVAL = 300
+quotes = QuoteCache(QUOTES_FILE)
+
+# code -> (user_id, timestamp)
+PENDING_PAYMENTS: PersistentDict = PersistentDict(state_store, "pending_payments", ttl=PAYMENT_TIMEOUT)
+# user_id -> code
+USER_PAYMENTS: PersistentDict = PersistentDict(state_store, "user_payments", ttl=PAYMENT_TIMEOUT, key_type=int)
+# code -> (amount, timestamp) - зачислено наблюдателем, ждёт нажатия "Проверить"
+CREDITED_PAYMENTS: PersistentDict = PersistentDict(state_store, "credited_payments", ttl=PAYMENT_TIMEOUT)
+DEPOSIT_SCAN_INTERVAL = float(os.getenv("DEPOSIT_SCAN_INTERVAL", "10"))
+
+# Ключи уже зачисленных счетов ("xrocket_<id>", "crypto_<id>")
+PAID_INVOICES: PersistentSet = PersistentSet(state_store, "paid_invoices", ttl=PAID_INVOICE_TTL)
+# Открытые счета xRocket/CryptoPay для восстановления опроса после перезапуска
+OPEN_INVOICES: PersistentDict = PersistentDict(state_store, "open_invoices", ttl=2 * PAYMENT_TIMEOUT)
+XROCKET_INVOICE_TTL = 600
+INVOICE_POLL_TICK = float(os.getenv("INVOICE_POLL_TICK", "5"))
+
+# Порт приёма вебхуков платёжных систем, 0 - вебхуки отключены
+PAYMENT_WEBHOOK_HOST = os.getenv("PAYMENT_WEBHOOK_HOST", "0.0.0.0")
+PAYMENT_WEBHOOK_PORT = int(os.getenv("PAYMENT_WEBHOOK_PORT", "0"))
+# Во сколько раз реже опрашивать счета, когда включены вебхуки
+WEBHOOK_POLL_BACKOFF = 6.0
+
+WALLET_REFRESH_INTERVAL = float(os.getenv("WALLET_REFRESH_INTERVAL", "30"))
+WALLET_RESERVE_FACTOR = 1.1
+
+# Сколько FSM-записей держать в памяти, остальные читаются с диска
+FSM_CACHE_SIZE = 10000
+
+# Не чаще одной правки сообщения с прогрессом покупки за интервал, сек
+PROGRESS_EDIT_INTERVAL = float(os.getenv("PROGRESS_EDIT_INTERVAL", "1.0"))
 
 _session = None
 
@@ -168,18 +231,8 @@ def get_session():
 
 
 def check_rate_limit(user_id: int) -> bool:
-    now = time.time()
-
-    USER_RATE_LIMITS[user_id] = [
-        ts for ts in USER_RATE_LIMITS[user_id]
-        if now - ts < RATE_LIMIT_WINDOW
-    ]
-
-    if len(USER_RATE_LIMITS[user_id]) >= RATE_LIMIT_ACTIONS:
-        return False
-
-    USER_RATE_LIMITS[user_id].append(now)
-    return True
+    allowed, _ = throttle_registry.consume(("rate_limit", user_id), RATE_LIMIT_RULE)
+    return allowed
 
 
 def cleanup_old_purchases():
@@ -194,28 +247,48 @@ def cleanup_old_purchases():
         del COMPLETED_PURCHASES[purchase_id]
 
 
+def fetch_ton_rates() -> Optional[Tuple[Dict[str, float], str]]:
+    """Курсы TON из coingecko, запасной источник - cryptocompare"""
+    try:
+        r = get_session().get(
+            "https://api.coingecko.com/api/v3/simple/price",
+            params={"ids": "the-open-network", "vs_currencies": "usd,rub"},
+            timeout=10
+        )
+        r.raise_for_status()
+        data = r.json().get("the-open-network", {})
+        rates = {"usd": float(data.get("usd", 0)), "rub": float(data.get("rub", 0))}
+        if rates["usd"] > 0:
+            return rates, "coingecko"
+    except Exception as e:
+        logger.error(f"Failed to update rates from coingecko: {e}")
+
+    try:
+        r = get_session().get(
+            "https://min-api.cryptocompare.com/data/price",
+            params={"fsym": "TON", "tsyms": "USD,RUB"},
+            timeout=10
+        )
+        r.raise_for_status()
+        data = r.json()
+        rates = {"usd": float(data.get("USD", 0) or 0), "rub": float(data.get("RUB", 0) or 0)}
+        if rates["usd"] > 0:
+            return rates, "cryptocompare"
+    except Exception as e:
+        logger.error(f"Failed to update rates from cryptocompare: {e}")
+    return None
+
+
 def ton_rates() -> tuple[float, float]:
-    now = time.time()
-    if now - _rate_cache["ts"] > 300 or _rate_cache["usd"] == 0:
-        try:
-            r = get_session().get(
-                "https://api.coingecko.com/api/v3/simple/price",
-                params={"ids": "the-open-network", "vs_currencies": "usd,rub"},
-                timeout=10
-            )
-            r.raise_for_status()
-            data = r.json()
-            _rate_cache.update({
-                "ts": now,
-                "usd": float(data.get("the-open-network", {}).get("usd", 0)),
-                "rub": float(data.get("the-open-network", {}).get("rub", 0))
-            })
-            logger.debug(f"Rates updated: {_rate_cache}")
-        except Exception as e:
-            logger.error(f"Failed to update rates: {e}")
-            if _rate_cache["usd"] == 0:
-                _rate_cache.update({"usd": 6.5, "rub": 650})
-    return _rate_cache["usd"], _rate_cache["rub"]
+    quote = quotes.get("ton_rates")
+    if quote is None:
+        # Обновлятель ещё не успел - один синхронный запрос
+        result = fetch_ton_rates()
+        if result is None:
+            return 6.5, 650.0
+        quotes.publish("ton_rates", result[0], result[1], max_age=RATES_REFRESH_INTERVAL * 3)
+        quote = quotes.get("ton_rates")
+    return quote.value["usd"], quote.value["rub"]
 
 
 def _fee(val: float | None = None) -> float:
@@ -259,7 +332,11 @@ def price_one(*, with_fee=False, retry_count=3) -> float | None:
     return round(base * (1 + _fee() / 100), 6) if with_fee else round(base, 6)
 
 
-def get_wallet_balance() -> float:
+def fetch_wallet_balance() -> Optional[float]:
+    """Баланс кошелька из сети, None если оба API недоступны.
+
+    Успешный результат публикуется в общий кэш котировок для админ-панели.
+    """
     try:
         r = get_session().get(
             f"https://tonapi.io/v2/accounts/{TON_WALLET_ADDRESS}",
@@ -267,7 +344,9 @@ def get_wallet_balance() -> float:
             timeout=15
         )
         r.raise_for_status()
-        return int(r.json().get("balance", 0)) / 1e9
+        balance = int(r.json().get("balance", 0)) / 1e9
+        quotes.publish("wallet_balance", balance, "tonapi", max_age=WALLET_REFRESH_INTERVAL * 3)
+        return balance
     except Exception as exc:
         logger.error(f"TON API balance error: {exc}")
         try:
@@ -279,10 +358,17 @@ def get_wallet_balance() -> float:
             )
             data = r.json()
             if data.get("ok"):
-                return int(data.get("result", {}).get("balance", 0)) / 1e9
+                balance = int(data.get("result", {}).get("balance", 0)) / 1e9
+                quotes.publish("wallet_balance", balance, "toncenter", max_age=WALLET_REFRESH_INTERVAL * 3)
+                return balance
         except Exception as e:
             logger.error(f"TonCenter API balance error: {e}")
-        return 0.0
+        return None
+
+
+def get_wallet_balance() -> float:
+    balance = fetch_wallet_balance()
+    return balance if balance is not None else 0.0
 
 
 def generate_payment_code(user_id: int) -> str:
@@ -299,24 +385,6 @@ def create_tonkeeper_link(address: str, amount: float, comment: str) -> str:
     return ton_link
 
 
-def decode_comment(comment: str) -> Optional[str]:
-    if not comment:
-        return None
-
-    comment = str(comment).strip()
-
-    if len(comment) % 4 == 0 and all(
-            c in 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/=' for c in comment):
-        try:
-            decoded = base64.b64decode(comment).decode('utf-8')
-            if decoded and (decoded.isdigit() or any(c.isalnum() for c in decoded)):
-                return decoded.strip()
-        except Exception:
-            pass
-
-    return comment
-
-
 def cleanup_expired_payments():
     current_time = time.time()
     expired_codes = []
@@ -331,6 +399,10 @@ def cleanup_expired_payments():
         del PENDING_PAYMENTS[code]
         logger.debug(f"Removed expired payment code {code}")
 
+    for code, (_, timestamp) in list(CREDITED_PAYMENTS.items()):
+        if current_time - timestamp > PAYMENT_TIMEOUT:
+            del CREDITED_PAYMENTS[code]
+
 
 def get_display_currency(user_id: int) -> tuple[str, str]:
     lang = get_user_lang(user_id)
@@ -351,11 +423,68 @@ def format_price_for_user(user_id: int, ton_amount: float) -> tuple[float, str]:
 
 
 bot = Bot(BOT_TOKEN, parse_mode=ParseMode.HTML)
-dp = Dispatcher(storage=MemoryStorage())
+
+# Все отправки идут через общую очередь с лимитами Telegram
+send_scheduler = send_queue.SendScheduler()
+bot.session.middleware(send_scheduler)
+dp = Dispatcher(storage=KVStorage(state_store, ttl=PAYMENT_TIMEOUT, cache_size=FSM_CACHE_SIZE))
+
+
+wallet_tracker = WalletBalanceTracker(fetch_wallet_balance, interval=WALLET_REFRESH_INTERVAL)
+quote_refresher = QuoteRefresher(quotes, {"ton_rates": (fetch_ton_rates, RATES_REFRESH_INTERVAL)})
+
+
+async def _on_ton_deposit(code: str, user_id: int, amount_ton: float, tx_hash: str):
+    """Зачисление депозита, найденного наблюдателем"""
+    if db.is_tx_processed(tx_hash):
+        return
+
+    db.record_deposit(user_id, amount_ton, tx_hash, f"Payment {code}")
+
+    if code in PENDING_PAYMENTS:
+        del PENDING_PAYMENTS[code]
+    if USER_PAYMENTS.get(user_id) == code:
+        del USER_PAYMENTS[user_id]
+    CREDITED_PAYMENTS[code] = (amount_ton, time.time())
+
+    try:
+        await bot.send_message(
+            user_id,
+            get_text(user_id, 'payment_found',
+                     amount=amount_ton,
+                     balance=db.get_user_balance(user_id)),
+            reply_markup=kb_main(user_id)
+        )
+    except Exception as e:
+        logger.warning(f"Cannot notify user {user_id} about deposit: {e}")
+
+
+deposit_watcher = DepositWatcher(
+    TON_WALLET_ADDRESS,
+    get_session,
+    PENDING_PAYMENTS,
+    _on_ton_deposit,
+    load_cursor=lambda: db.get_settings().get("ton_watcher_lt", 0),
+    save_cursor=lambda lt: db.update_settings({"ton_watcher_lt": lt}),
+    api_key=os.getenv("TONCENTER_API_KEY", ""),
+    min_amount=MIN_DEPOSIT,
+    interval=DEPOSIT_SCAN_INTERVAL,
+)
+
+invoice_poller = InvoicePoller(
+    tick=INVOICE_POLL_TICK,
+    ttl=PAYMENT_TIMEOUT,
+    backoff_scale=WEBHOOK_POLL_BACKOFF if PAYMENT_WEBHOOK_PORT else 1.0,
+    persist=OPEN_INVOICES,
+)
+invoice_poller.register_provider("xrocket", xrocket_fetcher(os.getenv("XROCKET_API_KEY", "")))
+if CRYPTOPAY_ENABLED:
+    invoice_poller.register_provider("cryptopay", cryptopay_fetcher(
+        os.getenv("CRYPTOPAY_TOKEN"), getattr(crypto_pay, "IS_TESTNET", False)))
 
 
 def _bal_tuple():
-    return get_wallet_balance(), db.get_internal()
+    return wallet_tracker.balance, db.get_internal()
 
 
 admin.setup(
@@ -610,6 +739,10 @@ class BlockCheckMiddleware(BaseMiddleware):
 # Регистрируем middleware
 dp.message.middleware(BlockCheckMiddleware())
 dp.callback_query.middleware(BlockCheckMiddleware())
+
+throttling_middleware = ThrottlingMiddleware(THROTTLE_RULES, throttle_registry)
+dp.message.outer_middleware(throttling_middleware)
+dp.callback_query.outer_middleware(throttling_middleware)
 @dp.message(CommandStart())
 async def cmd_start(m: types.Message, state: FSMContext):
     await ensure_user_registered(m)
@@ -697,6 +830,8 @@ async def on_chat_member_update(event: ChatMemberUpdated):
     Когда бота добавляют админом - регистрируем чат.
     """
     logger.info(f"my_chat_member event: chat={event.chat.id}, type={event.chat.type}, from={event.from_user.id}")
+    # Уведомления о чатах не должны задерживать ответы пользователям
+    send_queue.send_priority.set(send_queue.BACKGROUND)
     # Проверяем что это групповой чат
     if event.chat.type not in ("group", "supergroup"):
         return
@@ -1455,6 +1590,7 @@ async def cb_set_language(c: types.CallbackQuery):
     user_id = c.from_user.id
 
     set_user_lang(user_id, lang)
+    db.set_user_language(user_id, get_user_lang(user_id))
 
     await safe_edit(
         c.message,
@@ -1827,6 +1963,7 @@ async def cb_withdraw_confirm(c: types.CallbackQuery, state: FSMContext):
         progress_text = f"⏳ <b>Обработка вывода...</b>\n\n⭐ {amount} звёзд → @{recipient}"
     
     msg = await c.message.edit_text(progress_text, parse_mode="HTML")
+    reserve_key = f"task_withdraw:{user_id}:{uuid.uuid4().hex[:8]}"
     
     try:
         # Получаем recipient_id через DAO
@@ -1846,8 +1983,14 @@ async def cb_withdraw_confirm(c: types.CallbackQuery, state: FSMContext):
         if not messages:
             raise Exception("Empty messages")
         
+        # Резервируем сумму транзакции в учёте кошелька
+        spend = sum(int(m.get("amount", 0)) for m in messages) / 1e9
+        if not wallet_tracker.try_reserve(reserve_key, spend * WALLET_RESERVE_FACTOR):
+            raise Exception("Insufficient bot wallet balance")
+        
         # Отправляем транзакцию
         ton.send_messages_no_wait(messages)
+        wallet_tracker.commit(reserve_key, spend)
         tx_result = True
         
         if not tx_result:
@@ -1885,6 +2028,9 @@ async def cb_withdraw_confirm(c: types.CallbackQuery, state: FSMContext):
         
         await msg.edit_text(error_text, reply_markup=kb, parse_mode="HTML")
     
+    finally:
+        wallet_tracker.release(reserve_key)
+    
     await state.clear()
 
 
@@ -1983,7 +2129,9 @@ async def cb_check_deposit(c: types.CallbackQuery, state: FSMContext):
         )
         return
 
-    if time.time() - payment_timestamp > PAYMENT_TIMEOUT:
+    credited = CREDITED_PAYMENTS.pop(payment_code, None)
+
+    if not credited and time.time() - payment_timestamp > PAYMENT_TIMEOUT:
         await state.clear()
         if payment_code in PENDING_PAYMENTS:
             del PENDING_PAYMENTS[payment_code]
@@ -1997,122 +2145,56 @@ async def cb_check_deposit(c: types.CallbackQuery, state: FSMContext):
         )
         return
 
-    await safe_edit(
-        c.message,
-        get_text(user_id, 'checking_payment'),
-        reply_markup=None
-    )
-
-    try:
-        session = get_session()
-        response = session.get(
-            "https://toncenter.com/api/v2/getTransactions",
-            params={
-                "address": TON_WALLET_ADDRESS,
-                "limit": 30,
-                "archival": True
-            },
-            headers={"X-API-Key": os.getenv("TONCENTER_API_KEY", "")},
-            timeout=15
+    if not credited:
+        await safe_edit(
+            c.message,
+            get_text(user_id, 'checking_payment'),
+            reply_markup=None
         )
 
-        if response.status_code == 200:
-            data = response.json()
-            if data.get("ok"):
-                transactions = data.get("result", [])
-                found = False
-
-                for tx in transactions:
-                    tx_time = tx.get("utime", 0)
-                    if tx_time < payment_timestamp:
-                        continue
-
-                    in_msg = tx.get("in_msg")
-                    if not in_msg or not in_msg.get("value"):
-                        continue
-
-                    value = int(in_msg.get("value", 0))
-                    amount_ton = value / 1e9
-
-                    if amount_ton < MIN_DEPOSIT:
-                        continue
-
-                    msg_data = in_msg.get("msg_data", {})
-                    comment = None
-
-                    if isinstance(msg_data, dict):
-                        for field in ["text", "comment", "payload", "body"]:
-                            value = msg_data.get(field)
-                            if value:
-                                comment = decode_comment(str(value))
-                                if comment:
-                                    break
-
-                    if not comment:
-                        message = in_msg.get("message")
-                        if message:
-                            comment = decode_comment(message)
-
-                    logger.debug(f"Transaction comment: {comment}, expected: {payment_code}")
-
-                    if comment and str(comment).strip() == payment_code:
-                        tx_id = tx.get("transaction_id", {})
-                        tx_hash = tx_id.get("hash", f"tx_{tx_time}_{user_id}")
-
-                        if not db.is_tx_processed(tx_hash):
-                            db.record_deposit(user_id, amount_ton, tx_hash, f"Payment {payment_code}")
-
-                            if payment_code in PENDING_PAYMENTS:
-                                del PENDING_PAYMENTS[payment_code]
-                            if user_id in USER_PAYMENTS:
-                                del USER_PAYMENTS[user_id]
-                            await state.clear()
-
-                            await safe_edit(
-                                c.message,
-                                get_text(user_id, 'payment_found',
-                                         amount=amount_ton,
-                                         balance=db.get_user_balance(user_id)),
-                                reply_markup=kb_main(user_id)
-                            )
-
-                            found = True
-                            break
-
-                if not found:
-                    remaining_minutes = max(0, int((payment_timestamp + PAYMENT_TIMEOUT - time.time()) / 60))
-
-                    not_found_text = f"{get_text(user_id, 'payment_not_found')}\n\n"
-                    not_found_text += f"💎 Адрес для пополнения:\n<code>{TON_WALLET_ADDRESS}</code>\n\n"
-                    not_found_text += f"📝 Комментарий:\n<code>{payment_code}</code>\n\n"
-                    not_found_text += f"⏰ Осталось времени: {remaining_minutes} минут"
-
-                    await safe_edit(
-                        c.message,
-                        not_found_text,
-                        reply_markup=types.InlineKeyboardMarkup(inline_keyboard=[
-                            [types.InlineKeyboardButton(text=get_text(user_id, 'btn_check_again'),
-                                                        callback_data="check_ton_deposit")],
-                            [types.InlineKeyboardButton(text=get_text(user_id, 'btn_how_comment'),
-                                                        callback_data="how_comment")],
-                            [types.InlineKeyboardButton(text=get_text(user_id, 'btn_back'), callback_data="menu")]
-                        ])
-                    )
-        else:
-            logger.error(f"TonCenter API error: {response.status_code}")
-            await safe_edit(
-                c.message,
-                get_text(user_id, 'payment_check_error'),
-                reply_markup=kb_back(user_id)
-            )
+        # Проверка идёт через общий наблюдатель: одновременные нажатия
+        # объединяются в один запрос к toncenter
+        await deposit_watcher.sync()
+        credited = CREDITED_PAYMENTS.pop(payment_code, None)
 
-    except Exception as e:
-        logger.error(f"Error during deposit check: {e}")
+    if credited:
+        amount_ton, _ = credited
+        await state.clear()
+        await safe_edit(
+            c.message,
+            get_text(user_id, 'payment_found',
+                     amount=amount_ton,
+                     balance=db.get_user_balance(user_id)),
+            reply_markup=kb_main(user_id)
+        )
+        return
+
+    if not deposit_watcher.healthy:
         await safe_edit(
             c.message,
             get_text(user_id, 'payment_check_error'),
             reply_markup=kb_back(user_id)
         )
+        return
+
+    remaining_minutes = max(0, int((payment_timestamp + PAYMENT_TIMEOUT - time.time()) / 60))
+
+    not_found_text = f"{get_text(user_id, 'payment_not_found')}\n\n"
+    not_found_text += f"💎 Адрес для пополнения:\n<code>{TON_WALLET_ADDRESS}</code>\n\n"
+    not_found_text += f"📝 Комментарий:\n<code>{payment_code}</code>\n\n"
+    not_found_text += f"⏰ Осталось времени: {remaining_minutes} минут"
+
+    await safe_edit(
+        c.message,
+        not_found_text,
+        reply_markup=types.InlineKeyboardMarkup(inline_keyboard=[
+            [types.InlineKeyboardButton(text=get_text(user_id, 'btn_check_again'),
+                                        callback_data="check_ton_deposit")],
+            [types.InlineKeyboardButton(text=get_text(user_id, 'btn_how_comment'),
+                                        callback_data="how_comment")],
+            [types.InlineKeyboardButton(text=get_text(user_id, 'btn_back'), callback_data="menu")]
+        ])
+    )
 
 
 @dp.callback_query(F.data == "how_comment")
@@ -2201,31 +2283,134 @@ async def msg_usd(m: types.Message, state: FSMContext):
         reply_markup=kb_pay,
     )
     await state.set_state(TopUpXR.wait)
-    asyncio.create_task(_poll_invoice(user_id, inv["id"], usd_amt))
+    invoice_poller.add(
+        "xrocket", inv["id"], user_id,
+        on_paid=_on_xrocket_paid,
+        on_expired=_on_xrocket_expired,
+        ttl=XROCKET_INVOICE_TTL,
+        usd_amt=usd_amt,
+        token=token,
+    )
 
 
-async def _poll_invoice(uid: int, invoice_id: str, usd_amt: float):
-    logger.info(f"Start polling invoice {invoice_id} for user {uid}")
-    for _ in range(60):
-        await asyncio.sleep(10)
-        try:
-            resp = await check_invoice(invoice_id)
-            status = (resp.get("data") or resp).get("status", "").lower()
-            if status in {"paid", "success", "completed"}:
-                usd_rate, _ = ton_rates()
-                ton_amt = round(usd_amt / usd_rate, 6)
-                db.update_balance(uid, ton_amt)
-                db.add_internal(ton_amt)
-                await bot.send_message(
-                    uid,
-                    get_text(uid, 'payment_confirmed', amount=ton_amt),
-                    reply_markup=kb_main(uid),
-                )
-                logger.info(f"Invoice {invoice_id} paid.")
-                return
-        except Exception as exc:
-            logger.warning(f"Invoice check error {invoice_id}: {exc}")
-    await bot.send_message(uid, get_text(uid, 'invoice_expired'), reply_markup=kb_main(uid))
+def _claim_invoice(key: str) -> bool:
+    """Пометить счёт зачисленным; False если он уже был зачислен"""
+    if key in PAID_INVOICES or db.is_tx_processed(key):
+        return False
+    PAID_INVOICES.add(key)
+    return True
+
+
+def _credit_xrocket_invoice(uid: int, invoice_id, usd_amt: float) -> Optional[float]:
+    """Зачислить оплаченный счёт xRocket, None если уже зачислен"""
+    key = f"xrocket_{invoice_id}"
+    usd_rate, _ = ton_rates()
+    ton_amt = round(usd_amt / usd_rate, 6)
+    if not _claim_invoice(key):
+        return None
+    try:
+        db.update_balance(uid, ton_amt)
+    except Exception:
+        # Отметка снимается, чтобы счёт зачислился при повторной проверке
+        PAID_INVOICES.discard(key)
+        raise
+    db.add_internal(ton_amt)
+    logger.info(f"Invoice {invoice_id} paid.")
+    return ton_amt
+
+
+async def _crypto_to_ton(amount: float, currency: str) -> float:
+    ton_amount = await crypto_pay.convert_to_ton(amount, currency)
+
+    if not ton_amount:
+        usd_rate, _ = ton_rates()
+        if currency in ("USDT", "USDC"):
+            ton_amount = amount / usd_rate
+        else:
+            ton_amount = 1.0
+            logger.error(f"Failed to convert {amount} {currency} to TON")
+    return ton_amount
+
+
+def _credit_crypto_invoice(user_id: int, invoice_id, ton_amount: float, currency: str) -> bool:
+    """Зачислить оплаченный счёт CryptoPay, False если уже зачислен"""
+    key = f"crypto_{invoice_id}"
+    if not _claim_invoice(key):
+        return False
+    try:
+        db.record_deposit(user_id, ton_amount, key, f"CryptoPay {currency}")
+    except Exception:
+        PAID_INVOICES.discard(key)
+        raise
+    return True
+
+
+async def _settle_xrocket_invoice(user_id: int, invoice_id, usd_amt: float):
+    ton_amt = _credit_xrocket_invoice(user_id, invoice_id, usd_amt)
+    if ton_amt is None:
+        return
+    await bot.send_message(
+        user_id,
+        get_text(user_id, 'payment_confirmed', amount=ton_amt),
+        reply_markup=kb_main(user_id),
+    )
+
+
+async def _on_xrocket_paid(inv):
+    await _settle_xrocket_invoice(inv.user_id, inv.invoice_id, inv.data["usd_amt"])
+
+
+async def _on_xrocket_expired(inv):
+    await bot.send_message(inv.user_id, get_text(inv.user_id, 'invoice_expired'), reply_markup=kb_main(inv.user_id))
+
+
+async def _settle_crypto_invoice(user_id: int, invoice_id, amount: float, currency: str):
+    ton_amount = await _crypto_to_ton(amount, currency)
+    if not _credit_crypto_invoice(user_id, invoice_id, ton_amount, currency):
+        return
+
+    await bot.send_message(
+        user_id,
+        get_text(user_id, 'crypto_auto_confirmed',
+                 received=amount,
+                 currency=currency,
+                 credited=ton_amount),
+        reply_markup=kb_main(user_id)
+    )
+    logger.info(f"CryptoPay invoice {invoice_id} paid automatically")
+
+
+async def _on_crypto_paid(inv):
+    await _settle_crypto_invoice(inv.user_id, inv.invoice_id, inv.data["amount"], inv.data["currency"])
+
+
+async def _on_crypto_expired(inv):
+    logger.info(f"CryptoPay invoice {inv.invoice_id} expired without payment")
+
+
+async def _webhook_xrocket_paid(invoice: dict):
+    invoice_id = invoice.get("id")
+    # Счёт на отслеживании: зачисление и уведомление через его колбэк
+    if await invoice_poller.resolve("xrocket", invoice_id, "paid"):
+        return
+    parsed = parse_payload(invoice.get("payload"))
+    if not parsed:
+        logger.warning(f"xRocket webhook: unknown payload for invoice {invoice_id}")
+        return
+    user_id, _, usd_amt = parsed
+    await _settle_xrocket_invoice(user_id, invoice_id, usd_amt)
+
+
+async def _webhook_crypto_paid(invoice: dict):
+    invoice_id = invoice.get("invoice_id")
+    if await invoice_poller.resolve("cryptopay", invoice_id, "paid"):
+        return
+    parsed = parse_payload(invoice.get("payload"))
+    if not parsed:
+        logger.warning(f"CryptoPay webhook: unknown payload for invoice {invoice_id}")
+        return
+    user_id, currency, amount = parsed
+    await _settle_crypto_invoice(user_id, invoice_id, amount, currency)
 
 
 @dp.callback_query(F.data == "topup_crypto")
@@ -2344,7 +2529,13 @@ async def msg_crypto_amount(m: types.Message, state: FSMContext):
             reply_markup=kb_pay
         )
 
-        asyncio.create_task(_poll_crypto_invoice(user_id, invoice_id, amount, currency))
+        invoice_poller.add(
+            "cryptopay", invoice_id, user_id,
+            on_paid=_on_crypto_paid,
+            on_expired=_on_crypto_expired,
+            amount=amount,
+            currency=currency,
+        )
 
     except Exception as e:
         logger.error(f"CryptoPay invoice creation error: {e}")
@@ -2385,25 +2576,9 @@ async def cb_check_crypto_payment(c: types.CallbackQuery, state: FSMContext):
         invoice = await crypto_pay.check_invoice(invoice_id)
 
         if invoice and invoice.get("status") == "paid":
-            ton_amount = await crypto_pay.convert_to_ton(amount, currency)
-
-            if not ton_amount:
-                usd_rate, _ = ton_rates()
-                if currency in ("USDT", "USDC"):
-                    ton_amount = amount / usd_rate
-                else:
-                    ton_amount = 1.0
-                    logger.error(f"Failed to convert {amount} {currency} to TON")
-
-            db.update_balance(user_id, ton_amount)
-            db.add_internal(ton_amount)
-
-            db.record_deposit(
-                user_id,
-                ton_amount,
-                f"crypto_{invoice_id}",
-                f"CryptoPay {currency}"
-            )
+            ton_amount = await _crypto_to_ton(amount, currency)
+            _credit_crypto_invoice(user_id, invoice_id, ton_amount, currency)
+            await invoice_poller.resolve("cryptopay", invoice_id, "paid", notify=False)
 
             await state.clear()
 
@@ -2448,54 +2623,6 @@ async def cb_check_crypto_payment(c: types.CallbackQuery, state: FSMContext):
         )
 
 
-async def _poll_crypto_invoice(user_id: int, invoice_id: int, amount: float, currency: str):
-    logger.info(f"Start polling CryptoPay invoice {invoice_id} for user {user_id}")
-
-    for _ in range(60):
-        await asyncio.sleep(10)
-
-        try:
-            invoice = await crypto_pay.check_invoice(invoice_id)
-
-            if invoice and invoice.get("status") == "paid":
-                ton_amount = await crypto_pay.convert_to_ton(amount, currency)
-
-                if not ton_amount:
-                    usd_rate, _ = ton_rates()
-                    if currency in ("USDT", "USDC"):
-                        ton_amount = amount / usd_rate
-                    else:
-                        ton_amount = 1.0
-                        logger.error(f"Failed to convert {amount} {currency} to TON")
-
-                db.update_balance(user_id, ton_amount)
-                db.add_internal(ton_amount)
-
-                db.record_deposit(
-                    user_id,
-                    ton_amount,
-                    f"crypto_{invoice_id}",
-                    f"CryptoPay {currency}"
-                )
-
-                await bot.send_message(
-                    user_id,
-                    get_text(user_id, 'crypto_auto_confirmed',
-                             received=amount,
-                             currency=currency,
-                             credited=ton_amount),
-                    reply_markup=kb_main(user_id)
-                )
-
-                logger.info(f"CryptoPay invoice {invoice_id} paid automatically")
-                return
-
-        except Exception as e:
-            logger.warning(f"CryptoPay poll error for invoice {invoice_id}: {e}")
-
-    logger.info(f"CryptoPay invoice {invoice_id} expired without payment")
-
-
 @dp.callback_query(F.data == "buy")
 async def cb_buy(c: types.CallbackQuery, state: FSMContext):
     await ensure_user_registered(c)
@@ -2678,35 +2805,37 @@ async def process_purchase(message: types.Message, state: FSMContext, user_id: i
 
 
 @dp.callback_query(Buy.confirming, F.data.startswith("buygo:"))
-async def cb_buy_go(c: types.CallbackQuery, state: FSMContext):
+async def cb_buy_go(c: types.CallbackQuery, state: FSMContext,
+                    throttle_refund: Optional[Callable[[], None]] = None):
     await ensure_user_registered(c)
     user_id = c.from_user.id
     lang = get_user_lang(user_id)
 
+    # Отклонённые и повторные нажатия не расходуют лимит покупок
+    refund = throttle_refund or (lambda: None)
+
     try:
         purchase_id = c.data.split(":", 1)[1]
     except Exception:
+        refund()
         await c.answer("❌ Invalid request", show_alert=True)
         await state.clear()
         return
 
     now = time.time()
-    if user_id in USER_LAST_ACTION:
-        if now - USER_LAST_ACTION[user_id] < PURCHASE_COOLDOWN:
-            await c.answer("⏳ Please wait a few seconds between purchases", show_alert=True)
-            return
 
     if purchase_id in PROCESSING_PURCHASES:
+        refund()
         await c.answer("⏳ Already processing, please wait...", show_alert=True)
         return
 
     if purchase_id in COMPLETED_PURCHASES:
+        refund()
         await c.answer("✅ This purchase was already completed", show_alert=True)
         await state.clear()
         return await safe_edit(c.message, get_text(user_id, 'main_menu'), kb_main(user_id))
 
     PROCESSING_PURCHASES.add(purchase_id)
-    USER_LAST_ACTION[user_id] = now
 
     def create_progress_bar(percent: int, width: int = 15) -> str:
         filled = int(width * percent / 100)
@@ -2731,6 +2860,12 @@ async def cb_buy_go(c: types.CallbackQuery, state: FSMContext):
         progress = create_progress_bar(percent)
         return f"{title}{info}{stage_text}{progress}"
 
+    renderer = ProgressRenderer(
+        c.message,
+        lambda stage, percent: create_progress_message(stage, percent, qty, f"@{username}"),
+        min_interval=PROGRESS_EDIT_INTERVAL,
+    )
+
     try:
         await c.answer()
 
@@ -2747,32 +2882,17 @@ async def cb_buy_go(c: types.CallbackQuery, state: FSMContext):
         if current_balance < cost:
             raise ValueError("Insufficient balance")
 
-        if get_wallet_balance() < cost * 1.1:
+        # Резерв в локальном учёте кошелька, без запроса баланса в сеть
+        if not wallet_tracker.try_reserve(purchase_id, cost * WALLET_RESERVE_FACTOR):
             raise ValueError("Insufficient bot wallet balance")
 
-        msg = await c.message.edit_text(
-            create_progress_message(
-                stage="Инициализация..." if lang == 'ru' else "Initializing...",
-                percent=5,
-                stars=qty,
-                recipient=f"@{username}"
-            ),
-            reply_markup=None
-        )
-
-        await asyncio.sleep(0.3)
-
-        await msg.edit_text(
-            create_progress_message(
-                stage="Проверка получателя..." if lang == 'ru' else "Checking recipient...",
-                percent=15,
-                stars=qty,
-                recipient=f"@{username}"
-            )
-        )
+        # Первый кадр сразу: он же убирает кнопки подтверждения
+        await renderer.start("Инициализация..." if lang == 'ru' else "Initializing...", 5)
+        renderer.update("Проверка получателя..." if lang == 'ru' else "Checking recipient...", 15)
 
+        # Запросы к DAO и TON синхронные - в потоке, чтобы рендерер успевал показывать этапы
         try:
-            recipient_data = dao.stars_recipient(username)
+            recipient_data = await asyncio.to_thread(dao.stars_recipient, username)
             recipient_id = recipient_data.get("recipient")
             if not recipient_id:
                 raise dao.DAOLamaError("No recipient ID returned")
@@ -2782,7 +2902,7 @@ async def cb_buy_go(c: types.CallbackQuery, state: FSMContext):
         except dao.DAOLamaError as e:
             error_msg = str(e).lower()
             if "not found" in error_msg or "does not exist" in error_msg:
-                await msg.edit_text(
+                await renderer.finish(
                     get_text(user_id, 'user_not_found', username=username),
                     reply_markup=kb_main(user_id)
                 )
@@ -2790,27 +2910,11 @@ async def cb_buy_go(c: types.CallbackQuery, state: FSMContext):
                 return
             raise
 
-        await msg.edit_text(
-            create_progress_message(
-                stage="Получатель подтвержден ✅" if lang == 'ru' else "Recipient verified ✅",
-                percent=30,
-                stars=qty,
-                recipient=f"@{username}"
-            )
-        )
-
-        await asyncio.sleep(0.5)
+        renderer.update("Получатель подтвержден ✅" if lang == 'ru' else "Recipient verified ✅", 30)
 
-        await msg.edit_text(
-            create_progress_message(
-                stage="Создание транзакции..." if lang == 'ru' else "Creating transaction...",
-                percent=40,
-                stars=qty,
-                recipient=f"@{username}"
-            )
-        )
+        renderer.update("Создание транзакции..." if lang == 'ru' else "Creating transaction...", 40)
 
-        purchase = dao.stars_buy(recipient_id, qty, TON_WALLET_ADDRESS)
+        purchase = await asyncio.to_thread(dao.stars_buy, recipient_id, qty, TON_WALLET_ADDRESS)
 
         if "messages" not in purchase:
             raise dao.DAOLamaError(f"Invalid response structure: {purchase}")
@@ -2825,25 +2929,9 @@ async def cb_buy_go(c: types.CallbackQuery, state: FSMContext):
             if current_time > valid_until:
                 raise dao.DAOLamaError("Transaction expired")
 
-        await msg.edit_text(
-            create_progress_message(
-                stage="Транзакция подготовлена ✅" if lang == 'ru' else "Transaction prepared ✅",
-                percent=50,
-                stars=qty,
-                recipient=f"@{username}"
-            )
-        )
-
-        await asyncio.sleep(0.5)
+        renderer.update("Транзакция подготовлена ✅" if lang == 'ru' else "Transaction prepared ✅", 50)
 
-        await msg.edit_text(
-            create_progress_message(
-                stage="Обработка платежа..." if lang == 'ru' else "Processing payment...",
-                percent=60,
-                stars=qty,
-                recipient=f"@{username}"
-            )
-        )
+        renderer.update("Обработка платежа..." if lang == 'ru' else "Processing payment...", 60)
 
         success = db.atomic_purchase(
             user_id=user_id,
@@ -2855,54 +2943,19 @@ async def cb_buy_go(c: types.CallbackQuery, state: FSMContext):
         if not success:
             raise ValueError("Failed to deduct balance (possibly insufficient funds)")
 
-        await msg.edit_text(
-            create_progress_message(
-                stage="Платеж обработан ✅" if lang == 'ru' else "Payment processed ✅",
-                percent=70,
-                stars=qty,
-                recipient=f"@{username}"
-            )
-        )
+        renderer.update("Платеж обработан ✅" if lang == 'ru' else "Payment processed ✅", 70)
 
-        await asyncio.sleep(0.5)
-
-        await msg.edit_text(
-            create_progress_message(
-                stage="Отправка в блокчейн TON..." if lang == 'ru' else "Sending to TON blockchain...",
-                percent=80,
-                stars=qty,
-                recipient=f"@{username}"
-            )
-        )
+        renderer.update("Отправка в блокчейн TON..." if lang == 'ru' else "Sending to TON blockchain...", 80)
 
         try:
-            ton.send_messages_no_wait(messages)
-
-            await asyncio.sleep(0.3)
-
-            await msg.edit_text(
-                create_progress_message(
-                    stage="Подтверждение транзакции..." if lang == 'ru' else "Confirming transaction...",
-                    percent=90,
-                    stars=qty,
-                    recipient=f"@{username}"
-                )
-            )
+            await asyncio.to_thread(ton.send_messages_no_wait, messages)
+            wallet_tracker.commit(purchase_id)
 
-            await asyncio.sleep(0.5)
+            renderer.update("Подтверждение транзакции..." if lang == 'ru' else "Confirming transaction...", 90)
 
             COMPLETED_PURCHASES[purchase_id] = now
 
-            await msg.edit_text(
-                create_progress_message(
-                    stage="Завершение..." if lang == 'ru' else "Finalizing...",
-                    percent=100,
-                    stars=qty,
-                    recipient=f"@{username}"
-                )
-            )
-
-            await asyncio.sleep(0.5)
+            renderer.update("Завершение..." if lang == 'ru' else "Finalizing...", 100)
 
             if lang == 'en':
                 success_text = (
@@ -2919,7 +2972,7 @@ async def cb_buy_go(c: types.CallbackQuery, state: FSMContext):
                     "Проверить баланс: Настройки Telegram → Stars"
                 )
 
-            await msg.edit_text(success_text, reply_markup=kb_main(user_id))
+            await renderer.finish(success_text, reply_markup=kb_main(user_id))
             logger.info(f"★ Purchase completed: {qty} → @{username} (cost {cost:.6f} TON)")
 
             # === КОМИССИЯ ВЛАДЕЛЬЦУ ЧАТА ОТ ПОКУПКИ ===
@@ -2928,6 +2981,7 @@ async def cb_buy_go(c: types.CallbackQuery, state: FSMContext):
             source_chat_id = state_data.get("source_chat_id")
             logger.info(f"source_chat_id={source_chat_id}")
             if source_chat_id:
+                db.add_chat_member(source_chat_id, user_id)
                 chat_info = db.get_chat(source_chat_id)
                 if chat_info:
                     owner_id_chat = chat_info.get("owner_id")
@@ -2949,21 +3003,12 @@ async def cb_buy_go(c: types.CallbackQuery, state: FSMContext):
                                 )
                                 logger.info(f"Chat purchase commission: chat={source_chat_id}, owner={owner_id_chat}, amount={commission:.6f}")
 
-
         except RuntimeError as e:
             if "TX not confirmed" in str(e):
+                wallet_tracker.commit(purchase_id)
                 COMPLETED_PURCHASES[purchase_id] = now
 
-                await msg.edit_text(
-                    create_progress_message(
-                        stage="Ожидание подтверждения сети..." if lang == 'ru' else "Waiting for network confirmation...",
-                        percent=95,
-                        stars=qty,
-                        recipient=f"@{username}"
-                    )
-                )
-
-                await asyncio.sleep(1)
+                renderer.update("Ожидание подтверждения сети..." if lang == 'ru' else "Waiting for network confirmation...", 95)
 
                 if lang == 'en':
                     delayed_text = (
@@ -2984,7 +3029,7 @@ async def cb_buy_go(c: types.CallbackQuery, state: FSMContext):
                         "⚠️ <b>Внимание:</b> Из-за текущей загрузки сети подтверждение может занять больше времени."
                     )
 
-                await msg.edit_text(delayed_text, reply_markup=kb_main(user_id))
+                await renderer.finish(delayed_text, reply_markup=kb_main(user_id))
                 logger.info(f"★ Purchase sent (slow confirm): {qty} → @{username}")
             else:
                 db.rollback_purchase(user_id, cost, qty, purchase_id)
@@ -3002,12 +3047,12 @@ async def cb_buy_go(c: types.CallbackQuery, state: FSMContext):
         error_msg = str(exc).lower()
 
         if "timeout" in error_msg or "connection" in error_msg:
-            await c.message.edit_text(
+            await renderer.finish(
                 get_text(user_id, 'service_unavailable'),
                 reply_markup=kb_main(user_id)
             )
         else:
-            await c.message.edit_text(
+            await renderer.finish(
                 get_text(user_id, 'purchase_error', error=html.escape(str(exc))),
                 reply_markup=kb_main(user_id)
             )
@@ -3031,12 +3076,12 @@ async def cb_buy_go(c: types.CallbackQuery, state: FSMContext):
         error_text = str(e)
 
         if "balance" in error_text.lower():
-            await c.message.edit_text(
+            await renderer.finish(
                 get_text(user_id, 'balance_changed'),
                 reply_markup=kb_main(user_id)
             )
         else:
-            await c.message.edit_text(
+            await renderer.finish(
                 get_text(user_id, 'processing_error'),
                 reply_markup=kb_main(user_id)
             )
@@ -3049,12 +3094,13 @@ async def cb_buy_go(c: types.CallbackQuery, state: FSMContext):
         except Exception:
             pass
 
-        await c.message.edit_text(
+        await renderer.finish(
             get_text(user_id, 'processing_error'),
             reply_markup=kb_main(user_id)
         )
 
     finally:
+        wallet_tracker.release(purchase_id)
         PROCESSING_PURCHASES.discard(purchase_id)
         await state.clear()
 
@@ -3086,9 +3132,12 @@ async def self_diagnostics():
         problems.append("Price API temporarily unavailable")
 
     try:
-        bal = get_wallet_balance()
-        if bal < 0.1:
-            problems.append(f"Low TON wallet balance ({bal:.4f} TON)")
+        if wallet_tracker.updated_at == 0:
+            problems.append("Cannot check wallet balance")
+        else:
+            bal = wallet_tracker.balance
+            if bal < 0.1:
+                problems.append(f"Low TON wallet balance ({bal:.4f} TON)")
     except Exception as exc:
         problems.append(f"Cannot check wallet balance: {exc}")
 
@@ -3117,15 +3166,7 @@ async def cleanup_task():
         try:
             cleanup_expired_payments()
             cleanup_old_purchases()
-
-            now = time.time()
-            for user_id in list(USER_RATE_LIMITS.keys()):
-                USER_RATE_LIMITS[user_id] = [
-                    ts for ts in USER_RATE_LIMITS[user_id]
-                    if now - ts < RATE_LIMIT_WINDOW
-                ]
-                if not USER_RATE_LIMITS[user_id]:
-                    del USER_RATE_LIMITS[user_id]
+            state_store.purge_expired()
 
         except Exception as e:
             logger.error(f"Error in cleanup task: {e}")
@@ -3137,9 +3178,28 @@ async def main():
     logger.info("Starting bot...")
     db.init_schema()
 
-    asyncio.create_task(cleanup_task())
+    # Фоновые задачи и их уведомления идут в очереди отправки после ответов пользователям
+    with send_queue.priority(send_queue.BACKGROUND):
+        asyncio.create_task(cleanup_task())
+        await wallet_tracker.start()
+        await quote_refresher.start()
+        deposit_watcher.start()
+        invoice_poller.restore("xrocket", _on_xrocket_paid, _on_xrocket_expired)
+        invoice_poller.restore("cryptopay", _on_crypto_paid, _on_crypto_expired)
+        invoice_poller.start()
+
+        webhook_server = None
+        if PAYMENT_WEBHOOK_PORT:
+            webhook_server = PaymentWebhookServer(
+                PAYMENT_WEBHOOK_HOST, PAYMENT_WEBHOOK_PORT,
+                cryptopay_token=os.getenv("CRYPTOPAY_TOKEN", "") if CRYPTOPAY_ENABLED else "",
+                on_cryptopay_paid=_webhook_crypto_paid,
+                xrocket_key=os.getenv("XROCKET_API_KEY", ""),
+                on_xrocket_paid=_webhook_xrocket_paid,
+            )
+            await webhook_server.start()
 
-    await self_diagnostics()
+        await self_diagnostics()
 
     try:
 
@@ -3176,11 +3236,19 @@ async def main():
         logger.exception(f"Bot crashed: {e}")
         raise
     finally:
+        await wallet_tracker.stop()
+        await quote_refresher.stop()
+        await deposit_watcher.stop()
+        await invoice_poller.stop()
+        await send_scheduler.close()
+        if webhook_server:
+            await webhook_server.stop()
         try:
             if _session is not None:
                 _session.close()
         except Exception:
             pass
+        state_store.close()
 
 
 if __name__ == "__main__":
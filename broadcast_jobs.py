@@ -0,0 +1,193 @@
+"""
+broadcast_jobs.py - Фоновое выполнение рассылок админ-панели
+
+Рассылка - задание в БД: текст, кнопки, курсор и счётчики. Воркер в
+отдельном потоке со своим event loop отправляет пачками через SendScheduler
+(лимиты Telegram и RetryAfter), после каждой пачки сохраняет курсор и
+продлевает аренду задания, поэтому после падения процесса задание
+продолжается с последней пачки - в этом или другом процессе.
+"""
+
+import asyncio
+import os
+import socket
+import threading
+import time
+from typing import Any, Dict, List, Optional, Set
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramForbiddenError
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+from loguru import logger
+
+import send_queue
+
+
+ACTIVE_STATUSES = ("queued", "running")
+
+
+def build_keyboard(buttons: List[Dict[str, Any]]) -> Optional[InlineKeyboardMarkup]:
+    """Клавиатура рассылки из кнопок формы"""
+    rows = []
+    for btn in buttons or []:
+        if btn.get("url"):
+            rows.append([InlineKeyboardButton(text=btn["text"], url=btn["url"])])
+        elif btn.get("callback"):
+            rows.append([InlineKeyboardButton(text=btn["text"], callback_data=btn["callback"])])
+    return InlineKeyboardMarkup(inline_keyboard=rows) if rows else None
+
+
+class BroadcastWorker:
+    """Поток-исполнитель заданий рассылки (по одному заданию за раз).
+
+    Воркеров может быть несколько (процессы админки): задание выполняет тот,
+    кто захватил его аренду в БД. Отмена - флаг в записи задания, который
+    воркер перечитывает после каждой пачки.
+    """
+
+    def __init__(self, token: str, store: Any, per_second: float = 20.0, batch_size: int = 50,
+                 poll_interval: float = 10.0, lease: float = 120.0):
+        # store - модуль БД с функциями *_broadcast_job / get_broadcast_audience
+        self._token = token
+        self._store = store
+        self._per_second = per_second
+        self._batch_size = batch_size
+        self._poll_interval = poll_interval
+        self._lease = lease
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._queued: Set[str] = set()
+        self._thread: Optional[threading.Thread] = None
+        self._ready = threading.Event()
+        self._start_lock = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        """Запустить поток; незавершённые задания он подберёт сам"""
+        with self._start_lock:
+            if self.running:
+                return
+            self._ready.clear()
+            self._thread = threading.Thread(target=self._run_loop, name="broadcast-worker", daemon=True)
+            self._thread.start()
+            self._ready.wait()
+
+    def submit(self, job_id: str):
+        """Поставить задание в очередь воркера"""
+        self._loop.call_soon_threadsafe(self._enqueue, job_id)
+
+    def cancel(self, job_id: str) -> bool:
+        """Остановить задание; уже отправленное не отзывается"""
+        return self._store.cancel_broadcast_job(job_id)
+
+    def stop(self):
+        if self._loop and self.running:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join(timeout=5)
+
+    def _run_loop(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._queue = asyncio.Queue()
+        self._loop.create_task(self._serve())
+        self._ready.set()
+        try:
+            self._loop.run_forever()
+        finally:
+            self._loop.close()
+
+    def _enqueue(self, job_id: str):
+        if job_id not in self._queued:
+            self._queued.add(job_id)
+            self._queue.put_nowait(job_id)
+
+    def _poll(self):
+        """Подобрать ожидающие задания и брошенные упавшими воркерами"""
+        now = time.time()
+        pending = [j for j in self._store.get_broadcast_jobs(limit=1000)
+                   if j.get("status") in ACTIVE_STATUSES]
+        # Сначала прерванные (running), затем стоявшие в очереди - в порядке создания
+        pending.sort(key=lambda j: (j["status"] != "running", j.get("created_at", 0)))
+        for job in pending:
+            if job["status"] == "queued" or (job.get("owner") != self.owner
+                                             and now - (job.get("heartbeat") or 0) >= self._lease):
+                self._enqueue(job["id"])
+
+    async def _serve(self):
+        scheduler = send_queue.SendScheduler(global_per_second=self._per_second)
+        bot = Bot(token=self._token)
+        bot.session.middleware(scheduler)
+        try:
+            self._poll()
+            with send_queue.priority(send_queue.BACKGROUND):
+                while True:
+                    try:
+                        job_id = await asyncio.wait_for(self._queue.get(), self._poll_interval)
+                    except asyncio.TimeoutError:
+                        self._poll()
+                        continue
+                    self._queued.discard(job_id)
+                    try:
+                        await self._run_job(bot, job_id)
+                    except Exception as e:
+                        logger.exception(f"Broadcast {job_id} crashed: {e}")
+                        self._store.checkpoint_broadcast_job(
+                            job_id, self.owner, {"status": "failed", "error": str(e)[:200], "owner": None}
+                        )
+        finally:
+            await scheduler.close()
+            await bot.session.close()
+
+    async def _run_job(self, bot: Bot, job_id: str):
+        job = self._store.claim_broadcast_job(job_id, self.owner, self._lease)
+        if not job:
+            return
+
+        audience = self._store.get_broadcast_audience(job_id)
+        keyboard = build_keyboard(job.get("buttons"))
+        counters = {k: job.get(k, 0) for k in ("sent", "failed", "blocked")}
+        cursor = job.get("cursor", 0)
+        logger.info(f"Broadcast {job_id}: {len(audience) - cursor} recipients left")
+
+        while cursor < len(audience):
+            batch = audience[cursor:cursor + self._batch_size]
+            results = await asyncio.gather(*(self._send_one(bot, job, keyboard, uid) for uid in batch))
+            for result in results:
+                counters[result] += 1
+            cursor += len(batch)
+
+            current = self._store.checkpoint_broadcast_job(job_id, self.owner, {"cursor": cursor, **counters})
+            if current is None:
+                logger.warning(f"Broadcast {job_id} was taken over by another worker at {cursor}")
+                return
+            if current.get("cancel_requested"):
+                self._store.checkpoint_broadcast_job(job_id, self.owner, {"status": "cancelled", "owner": None})
+                logger.info(f"Broadcast {job_id} cancelled at {cursor}/{len(audience)}")
+                return
+
+        self._store.checkpoint_broadcast_job(job_id, self.owner, {
+            "status": "completed",
+            "finished_at": time.time(),
+            "owner": None,
+        })
+        logger.info(f"Broadcast {job_id} completed: {counters}")
+
+    async def _send_one(self, bot: Bot, job: Dict[str, Any],
+                        keyboard: Optional[InlineKeyboardMarkup], user_id: int) -> str:
+        try:
+            if job.get("photo_url"):
+                await bot.send_photo(chat_id=user_id, photo=job["photo_url"], caption=job["text"],
+                                     reply_markup=keyboard, parse_mode="HTML")
+            else:
+                await bot.send_message(chat_id=user_id, text=job["text"],
+                                       reply_markup=keyboard, parse_mode="HTML")
+            return "sent"
+        except TelegramForbiddenError:
+            return "blocked"
+        except Exception as e:
+            logger.debug(f"Broadcast {job['id']} failed for {user_id}: {e}")
+            return "failed"
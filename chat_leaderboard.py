@@ -0,0 +1,108 @@
+"""
+chat_leaderboard.py - Топы игроков чатов по объёму ставок
+
+Для каждого чата ставки копятся в дневных корзинах, а рейтинги за день,
+неделю и месяц (календарные, по местному времени) и за всё время хранятся
+отсортированными и обновляются на каждом спине. Смена периода
+обрабатывается лениво: при первом чтении рейтинг собирается из корзин
+нового периода. Чтение топа - срез первых limit элементов.
+"""
+
+import bisect
+from datetime import date
+from typing import Dict, List, Optional, Tuple
+
+PERIODS = ("day", "week", "month")
+
+
+def period_start(period: str, day: date) -> int:
+    """Порядковый номер первого дня периода, содержащего day"""
+    if period == "day":
+        return day.toordinal()
+    if period == "week":
+        return day.toordinal() - day.weekday()
+    if period == "month":
+        return day.replace(day=1).toordinal()
+    raise ValueError(f"Unknown period: {period}")
+
+
+class Ranking:
+    """Суммы по игрокам и их порядок по убыванию"""
+
+    def __init__(self, key: Optional[int] = None, volumes: Optional[Dict[int, float]] = None):
+        self.key = key
+        self.volumes: Dict[int, float] = dict(volumes or {})
+        self._order: List[Tuple[float, int]] = sorted((-v, uid) for uid, v in self.volumes.items())
+
+    def set(self, user_id: int, volume: float):
+        old = self.volumes.get(user_id)
+        if old == volume:
+            return
+        if old is not None:
+            pos = bisect.bisect_left(self._order, (-old, user_id))
+            if pos < len(self._order) and self._order[pos] == (-old, user_id):
+                del self._order[pos]
+        self.volumes[user_id] = volume
+        bisect.insort(self._order, (-volume, user_id))
+
+    def add(self, user_id: int, amount: float):
+        self.set(user_id, self.volumes.get(user_id, 0.0) + amount)
+
+    def top(self, limit: int) -> List[Tuple[int, float]]:
+        return [(uid, -neg) for neg, uid in self._order[:limit]]
+
+
+class ChatLeaderboards:
+    """Рейтинги по чатам: дневные корзины + рейтинги периодов и за всё время"""
+
+    def __init__(self):
+        # chat_id -> номер дня -> user_id -> сумма ставок
+        self._days: Dict[int, Dict[int, Dict[int, float]]] = {}
+        self._rankings: Dict[Tuple[int, str], Ranking] = {}
+        self._all: Dict[int, Ranking] = {}
+
+    def add_spin(self, chat_id: int, user_id: int, bet: float, ts: float):
+        """Учесть ставку в корзине дня и в актуальных рейтингах периодов"""
+        day = date.fromtimestamp(ts)
+        bucket = self._days.setdefault(chat_id, {}).setdefault(day.toordinal(), {})
+        bucket[user_id] = bucket.get(user_id, 0.0) + bet
+        for period in PERIODS:
+            ranking = self._rankings.get((chat_id, period))
+            # Рейтинг другого периода будет пересобран при чтении
+            if ranking is not None and ranking.key == period_start(period, day):
+                ranking.add(user_id, bet)
+
+    def set_total(self, chat_id: int, user_id: int, volume: float):
+        """Сумма ставок игрока в чате за всё время"""
+        ranking = self._all.get(chat_id)
+        if ranking is None:
+            ranking = self._all[chat_id] = Ranking()
+        ranking.set(user_id, volume)
+
+    def _ranking(self, chat_id: int, period: str) -> Ranking:
+        today = date.today()
+        key = period_start(period, today)
+        ranking = self._rankings.get((chat_id, period))
+        if ranking is not None and ranking.key == key:
+            return ranking
+
+        days = self._days.get(chat_id, {})
+        # Корзины старше начала текущих недели и месяца больше не нужны
+        oldest = min(period_start("week", today), period_start("month", today))
+        for ordinal in [d for d in days if d < oldest]:
+            del days[ordinal]
+
+        volumes: Dict[int, float] = {}
+        for ordinal, bucket in days.items():
+            if ordinal >= key:
+                for uid, bet in bucket.items():
+                    volumes[uid] = volumes.get(uid, 0.0) + bet
+        ranking = self._rankings[(chat_id, period)] = Ranking(key, volumes)
+        return ranking
+
+    def top(self, chat_id: int, period: str, limit: int = 10) -> List[Tuple[int, float]]:
+        """[(user_id, объём)] по убыванию; period - day, week, month или all"""
+        if period in PERIODS:
+            return self._ranking(chat_id, period).top(limit)
+        ranking = self._all.get(chat_id)
+        return ranking.top(limit) if ranking is not None else []
@@ -0,0 +1,76 @@
+"""
+chat_members.py - Участники чатов и рейтинг их балансов
+
+chat_id -> игроки, которые играли или покупали из чата, и обратный индекс
+user_id -> чаты. Для каждого чата балансы участников хранятся
+отсортированными: топ и место игрока - bisect и срез, без перебора NGR и
+users.json.
+"""
+
+import bisect
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+
+class ChatMembers:
+    """Участники чатов с упорядоченными балансами"""
+
+    def __init__(self):
+        self._reset()
+
+    def _reset(self):
+        self._members: Dict[int, Set[int]] = {}
+        self._user_chats: Dict[int, Set[int]] = {}
+        self._balances: Dict[int, float] = {}
+        # chat_id -> (-баланс, user_id) по возрастанию = балансы по убыванию
+        self._order: Dict[int, List[Tuple[float, int]]] = {}
+
+    def rebuild(self, members: Dict[int, Iterable[int]], balances: Dict[int, float]):
+        """Построить индекс: участники по чатам и текущие балансы"""
+        self._reset()
+        self._balances = {uid: float(balance) for uid, balance in balances.items()}
+        for chat_id, user_ids in members.items():
+            self._members[chat_id] = set(user_ids)
+            for uid in self._members[chat_id]:
+                self._user_chats.setdefault(uid, set()).add(chat_id)
+            self._order[chat_id] = sorted((-self._balances.get(uid, 0.0), uid) for uid in self._members[chat_id])
+
+    def add(self, chat_id: int, user_id: int) -> bool:
+        """Добавить участника; True, если он новый для чата"""
+        members = self._members.setdefault(chat_id, set())
+        if user_id in members:
+            return False
+        members.add(user_id)
+        self._user_chats.setdefault(user_id, set()).add(chat_id)
+        bisect.insort(self._order.setdefault(chat_id, []), (-self._balances.get(user_id, 0.0), user_id))
+        return True
+
+    def update_balance(self, user_id: int, balance: float):
+        """Переставить игрока во всех его чатах после смены баланса"""
+        balance = float(balance)
+        old = self._balances.get(user_id, 0.0)
+        self._balances[user_id] = balance
+        if old == balance:
+            return
+        for chat_id in self._user_chats.get(user_id, ()):
+            order = self._order[chat_id]
+            pos = bisect.bisect_left(order, (-old, user_id))
+            if pos < len(order) and order[pos] == (-old, user_id):
+                del order[pos]
+            bisect.insort(order, (-balance, user_id))
+
+    def count(self, chat_id: int) -> int:
+        return len(self._members.get(chat_id, ()))
+
+    def is_member(self, chat_id: int, user_id: int) -> bool:
+        return user_id in self._members.get(chat_id, ())
+
+    def top(self, chat_id: int, limit: int = 10) -> List[Tuple[int, float]]:
+        """[(user_id, баланс)] по убыванию баланса"""
+        return [(uid, -neg) for neg, uid in self._order.get(chat_id, [])[:limit]]
+
+    def rank(self, chat_id: int, user_id: int) -> Optional[int]:
+        """Место игрока в чате по балансу (с 1) или None"""
+        if not self.is_member(chat_id, user_id):
+            return None
+        key = (-self._balances.get(user_id, 0.0), user_id)
+        return bisect.bisect_left(self._order[chat_id], key) + 1
@@ -6,14 +6,25 @@ db.py -       (JSON )
      -
 """
 
+import fcntl
+import heapq
+import itertools
 import json
 import os
 import time
 import threading
-from typing import Dict, Any, Optional, List
+from typing import Callable, Dict, Any, Iterator, Optional, List
 from loguru import logger
 from decimal import Decimal, ROUND_DOWN
 
+from audience_index import AudienceIndex
+from history_index import HistoryIndex, parse_cursor
+from live_feed import EventBus
+from partner_index import PartnerIndex
+from ngr_store import NGRStore
+from chat_leaderboard import ChatLeaderboards
+from chat_members import ChatMembers
+
 # ========================
 #   
 # ========================
@@ -27,6 +38,8 @@ SETTINGS_FILE = os.path.join(DATA_DIR, "settings.json")
 SPINS_FILE = os.path.join(DATA_DIR, "spins.json")
 TRANSACTIONS_FILE = os.path.join(DATA_DIR, "transactions.json")
 
+MAX_SPINS = 10000  # храним только последние спины
+
 #    
 LOCK = threading.RLock()
 
@@ -55,95 +68,303 @@ def _invalidate_balance(user_id: int):
 #    I/O
 # ========================
 
+_MISSING = object()
+
+# Числовые поля-счётчики: при одновременном изменении в двух процессах
+# складываются приращения, а не выигрывает последняя запись
+ADDITIVE_FIELDS = {
+    "balance", "total_deposited", "total_bought", "spin_count", "total_spin_bet",
+    "total_spin_win", "internal_balance", "total_earnings", "withdrawn", "total_volume",
+}
+
+
+def _merge(base: Any, ours: Any, theirs: Any, field: str = None) -> Any:
+    """Трёхстороннее слияние: base - последнее общее состояние файла"""
+    if ours == base:
+        return theirs
+    if theirs == base or theirs is _MISSING:
+        return ours
+    if ours is _MISSING:
+        return theirs
+
+    if isinstance(ours, dict) and isinstance(theirs, dict):
+        base = base if isinstance(base, dict) else {}
+        result = {}
+        for key in list(theirs) + [k for k in ours if k not in theirs]:
+            value = _merge(base.get(key, _MISSING), ours.get(key, _MISSING), theirs.get(key, _MISSING), key)
+            if value is not _MISSING:
+                result[key] = value
+        return result
+
+    if isinstance(ours, list) and isinstance(theirs, list):
+        base = base if isinstance(base, list) else []
+        if all(isinstance(item, dict) and "id" in item for item in base + ours + theirs):
+            # Записи с id (выводы, задания): слияние по id, порядок как на диске
+            base_by_id = {item["id"]: item for item in base}
+            ours_by_id = {item["id"]: item for item in ours}
+            result = []
+            for item in theirs:
+                value = _merge(base_by_id.get(item["id"], _MISSING), ours_by_id.get(item["id"], _MISSING), item)
+                if value is not _MISSING:
+                    result.append(value)
+            on_disk = {item["id"] for item in theirs}
+            result.extend(item for item in ours if item["id"] not in on_disk and item["id"] not in base_by_id)
+            return result
+        # Журналы: из версии с диска убираем записи, удалённые у нас (ротация,
+        # очистка), и добавляем записи, которых не было в base
+        removed: Dict[str, int] = {}
+        for item in base:
+            key = json.dumps(item, sort_keys=True)
+            removed[key] = removed.get(key, 0) + 1
+        added = []
+        for item in ours:
+            key = json.dumps(item, sort_keys=True)
+            if removed.get(key):
+                removed[key] -= 1
+            else:
+                added.append(item)
+        result = []
+        for item in theirs:
+            key = json.dumps(item, sort_keys=True)
+            if removed.get(key):
+                removed[key] -= 1
+            else:
+                result.append(item)
+        return result + added
+
+    if (field in ADDITIVE_FIELDS and isinstance(base, (int, float))
+            and isinstance(ours, (int, float)) and isinstance(theirs, (int, float))):
+        return theirs + (ours - base)
+    return ours
+
+
 class JSONCache:
-    """  JSON    """
+    """Кэш JSON-файлов с отложенной записью, общий для бота и админки.
+
+    Файлы пишут оба процесса. Чистый кэш перечитывается, когда файл изменился
+    на диске (mtime/размер, проверка не чаще check_interval). При записи поверх
+    чужих изменений выполняется трёхстороннее слияние под блокировкой файла.
+    """
     
-    def __init__(self, write_delay: float = 1.0):
+    def __init__(self, write_delay: float = 1.0, check_interval: float = 0.5,
+                 lock: Optional[threading.RLock] = None):
         self._cache: Dict[str, Any] = {}
         self._dirty: Dict[str, bool] = {}
         self._write_delay = write_delay
+        self._check_interval = check_interval
         self._timers: Dict[str, threading.Timer] = {}
-        self._lock = threading.RLock()
+        # Общая с модулем блокировка: слушатели перечитывания (и слияния в
+        # потоке отложенной записи) меняют индексы под той же блокировкой,
+        # под которой их читают
+        self._lock = lock or threading.RLock()
+        # Последнее общее с диском состояние: текст файла и его (mtime_ns, size)
+        self._base: Dict[str, Optional[str]] = {}
+        self._stats: Dict[str, Optional[tuple]] = {}
+        self._checked: Dict[str, float] = {}
+        self._versions: Dict[str, int] = {}
+        self._reload_listeners: Dict[str, List[Callable[[Any, Any], None]]] = {}
+        self._limits: Dict[str, int] = {}
+    
+    @staticmethod
+    def _stat(filepath: str) -> Optional[tuple]:
+        try:
+            st = os.stat(filepath)
+            return (st.st_mtime_ns, st.st_size)
+        except FileNotFoundError:
+            return None
+    
+    def version(self, filepath: str) -> int:
+        """Счётчик изменений файла (свои записи и перечитывания с диска)"""
+        return self._versions.get(filepath, 0)
+    
+    def add_reload_listener(self, filepath: str, callback: Callable[[Any, Any], None]):
+        """callback(old, new) после подхвата изменений другого процесса"""
+        self._reload_listeners.setdefault(filepath, []).append(callback)
+    
+    def set_limit(self, filepath: str, max_items: int):
+        """Журнал хранит не больше max_items последних записей (и после слияния)"""
+        self._limits[filepath] = max_items
+    
+    def _bump(self, filepath: str):
+        self._versions[filepath] = self._versions.get(filepath, 0) + 1
+    
+    def _read_disk(self, filepath: str) -> Optional[str]:
+        try:
+            with open(filepath, 'r', encoding='utf-8') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+    
+    def _replace(self, filepath: str, old: Any, new: Any):
+        self._cache[filepath] = new
+        self._bump(filepath)
+        for callback in self._reload_listeners.get(filepath, []):
+            try:
+                callback(old, new)
+            except Exception as e:
+                logger.error(f"Reload listener failed for {filepath}: {e}")
+    
+    def _refresh(self, filepath: str):
+        """Перечитать чистый файл, если его изменил другой процесс"""
+        now = time.monotonic()
+        if now - self._checked.get(filepath, 0.0) < self._check_interval:
+            return
+        self._checked[filepath] = now
+        stat = self._stat(filepath)
+        if stat is None or stat == self._stats.get(filepath):
+            return
+        try:
+            text = self._read_disk(filepath)
+            data = json.loads(text)
+        except Exception as e:
+            # Файл мог быть записан не атомарно - попробуем при следующей проверке
+            logger.warning(f"Error reloading {filepath}: {e}")
+            return
+        self._base[filepath] = text
+        self._stats[filepath] = stat
+        self._replace(filepath, self._cache.get(filepath), data)
     
     def load(self, filepath: str, default: Any = None) -> Any:
-        """     """
+        """Данные файла из кэша; изменения других процессов подхватываются"""
         with self._lock:
-            #  
             if filepath in self._cache:
+                if not self._dirty.get(filepath, False):
+                    self._refresh(filepath)
                 return self._cache[filepath]
             
-            #   
             try:
-                if os.path.exists(filepath):
-                    with open(filepath, 'r', encoding='utf-8') as f:
-                        data = json.load(f)
-                        self._cache[filepath] = data
-                        return data
+                stat = self._stat(filepath)
+                text = self._read_disk(filepath)
+                if text is not None:
+                    data = json.loads(text)
+                    self._cache[filepath] = data
+                    self._base[filepath] = text
+                    self._stats[filepath] = stat
+                    self._checked[filepath] = time.monotonic()
+                    return data
             except Exception as e:
                 logger.error(f"Error loading {filepath}: {e}")
             
-            #    
             self._cache[filepath] = default
+            self._base[filepath] = None
+            self._stats[filepath] = None
             return default
     
     def save(self, filepath: str, data: Any, immediate: bool = False):
-        """    """
+        """Сохранить данные (запись на диск отложенная или сразу)"""
         with self._lock:
             self._cache[filepath] = data
             self._dirty[filepath] = True
+            self._bump(filepath)
             
-            if immediate:
+            if immediate or self._write_delay <= 0:
                 self._write_now(filepath)
             else:
                 self._schedule_write(filepath)
     
+    def set_write_delay(self, seconds: float):
+        self._write_delay = seconds
+    
     def _schedule_write(self, filepath: str):
-        """  """
-        #     
+        """Отложенная запись (повторные save переносят её)"""
         if filepath in self._timers:
             self._timers[filepath].cancel()
         
-        #   
         timer = threading.Timer(self._write_delay, self._write_now, args=[filepath])
+        timer.daemon = True
         self._timers[filepath] = timer
         timer.start()
     
     def _write_now(self, filepath: str):
-        """   """
+        """Записать файл, слив с изменениями другого процесса"""
         with self._lock:
             if not self._dirty.get(filepath, False):
                 return
             
             try:
-                #    
                 os.makedirs(os.path.dirname(filepath), exist_ok=True)
                 
-                #    
-                temp_file = filepath + '.tmp'
-                with open(temp_file, 'w', encoding='utf-8') as f:
-                    json.dump(self._cache[filepath], f, ensure_ascii=False, indent=2)
-                
-                #  
-                os.replace(temp_file, filepath)
+                with open(filepath + '.lock', 'a') as lock_file:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                    try:
+                        data = self._cache[filepath]
+                        if self._stat(filepath) != self._stats.get(filepath):
+                            theirs_text = self._read_disk(filepath)
+                            if theirs_text is not None:
+                                base_text = self._base.get(filepath)
+                                base = json.loads(base_text) if base_text is not None else _MISSING
+                                merged = _merge(base, data, json.loads(theirs_text))
+                                limit = self._limits.get(filepath)
+                                if limit and isinstance(merged, list) and len(merged) > limit:
+                                    merged = merged[-limit:]
+                                logger.debug(f"Merged concurrent changes into {filepath}")
+                                self._replace(filepath, data, merged)
+                                data = merged
+                        
+                        self._write_disk(filepath, data)
+                    finally:
+                        fcntl.flock(lock_file, fcntl.LOCK_UN)
                 
                 self._dirty[filepath] = False
                 
-                #  
                 if filepath in self._timers:
                     del self._timers[filepath]
                     
             except Exception as e:
                 logger.error(f"Error saving {filepath}: {e}")
     
+    def _write_disk(self, filepath: str, data: Any):
+        """Атомарная запись файла (вызывается под блокировкой файла)"""
+        text = json.dumps(data, ensure_ascii=False, indent=2)
+        temp_file = f"{filepath}.{os.getpid()}.tmp"
+        with open(temp_file, 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.replace(temp_file, filepath)
+        
+        self._base[filepath] = text
+        self._stats[filepath] = self._stat(filepath)
+    
+    def update(self, filepath: str, default: Any, func: Callable[[Any], Any]) -> Any:
+        """Прочитать-изменить-записать под блокировкой файла.
+
+        func получает актуальные данные с диска и меняет их на месте; между
+        процессами изменения не теряются и не пересекаются. Возвращает
+        результат func.
+        """
+        with self._lock:
+            self._write_now(filepath)
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+            
+            with open(filepath + '.lock', 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    stat = self._stat(filepath)
+                    if filepath not in self._cache or stat != self._stats.get(filepath):
+                        text = self._read_disk(filepath)
+                        data = json.loads(text) if text is not None else default
+                        self._base[filepath] = text
+                        self._stats[filepath] = stat
+                        self._replace(filepath, self._cache.get(filepath), data)
+                    self._checked[filepath] = time.monotonic()
+                    
+                    data = self._cache[filepath]
+                    result = func(data)
+                    self._write_disk(filepath, data)
+                    self._bump(filepath)
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+            return result
+    
     def flush_all(self):
-        """   """
+        """Записать все несохранённые файлы"""
         with self._lock:
             for filepath in list(self._dirty.keys()):
                 if self._dirty[filepath]:
                     self._write_now(filepath)
 
 #   
-_cache = JSONCache(write_delay=3.0)
+_cache = JSONCache(write_delay=3.0, lock=LOCK)
+_cache.set_limit(SPINS_FILE, MAX_SPINS)
 
 # ========================
 # 
@@ -188,6 +409,169 @@ def init():
 # 
 # ========================
 
+USER_LANGUAGES_FILE = os.path.join(DATA_DIR, "user_languages.json")  # ведёт locales.py
+
+def _load_json(filepath: str, default: Any) -> Any:
+    """Прочитать JSON-файл мимо кэша (файлы других модулей)"""
+    try:
+        with open(filepath, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+# Подписчики на изменения пользователей: callback(user_id, user)
+_user_listeners: List[Callable[[int, Dict[str, Any]], None]] = []
+_audience_index: Optional[AudienceIndex] = None
+
+def add_user_listener(callback: Callable[[int, Dict[str, Any]], None]):
+    """Вызывать callback после каждого изменения пользователя"""
+    _user_listeners.append(callback)
+
+def _user_changed(user_id_str: str, user: Dict[str, Any]):
+    for callback in _user_listeners:
+        try:
+            callback(int(user_id_str), user)
+        except Exception as e:
+            logger.error(f"User listener failed for {user_id_str}: {e}")
+
+def _users_reloaded(old: Optional[Dict[str, Any]], new: Dict[str, Any]):
+    """Пользователи изменены другим процессом: обновить индексы и кэш балансов"""
+    old = old or {}
+    for user_id_str, user in new.items():
+        previous = old.get(user_id_str)
+        if previous != user:
+            _invalidate_balance(int(user_id_str))
+            _user_changed(user_id_str, user)
+            # Блокировки из админки (другой процесс)
+            blocked = bool(user.get("is_blocked"))
+            if previous is not None and bool(previous.get("is_blocked")) != blocked:
+                events.publish("block", user_id=int(user_id_str), blocked=blocked)
+
+_cache.add_reload_listener(USERS_FILE, _users_reloaded)
+
+# ========================
+# Шина событий
+# ========================
+
+# События для живой ленты админки (см. live_feed.py)
+events = EventBus()
+
+# Поля записей журналов, попадающие в события
+EVENT_FIELDS = {
+    "deposit": ("user_id", "amount"),
+    "purchase": ("user_id", "stars", "amount"),
+    "spin": ("user_id", "bet", "win", "chat_id"),
+    "withdrawal": ("id", "owner_id", "amount", "status"),
+}
+
+def _publish_record(kind: str, record: Dict[str, Any]):
+    events.publish(kind, ts=record.get("timestamp") or record.get("created_at"),
+                   **{f: record.get(f) for f in EVENT_FIELDS[kind]})
+
+def _new_records(old: Optional[List[Dict]], new: List[Dict], window: float = 60.0) -> List[Dict]:
+    """Записи журнала, появившиеся в new (дописанные другим процессом).
+
+    Журналы только дописываются, а слияние добавляет записи в конец, поэтому
+    сравниваются лишь хвосты за последние window секунд.
+    """
+    if not isinstance(new, list):
+        return []
+    old = old if isinstance(old, list) else []
+    last_ts = old[-1].get("timestamp", 0) if old else 0
+    known = set()
+    for record in reversed(old):
+        if record.get("timestamp", 0) < last_ts - window:
+            break
+        known.add((record.get("timestamp"), record.get("user_id")))
+    
+    result = []
+    for record in reversed(new):
+        if record.get("timestamp", 0) < last_ts - window:
+            break
+        if (record.get("timestamp"), record.get("user_id")) not in known:
+            result.append(record)
+    result.reverse()
+    return result
+
+def _journal_reloaded(kind: str):
+    def listener(old, new):
+        for record in _new_records(old, new):
+            _publish_record(kind, record)
+    return listener
+
+def _withdrawals_reloaded(old: Optional[List[Dict]], new: List[Dict]):
+    previous = {w.get("id"): w.get("status") for w in old or []}
+    for withdrawal in new or []:
+        status = previous.get(withdrawal.get("id"))
+        if status is None:
+            _publish_record("withdrawal", withdrawal)
+        elif status != withdrawal.get("status"):
+            events.publish("withdrawal_status", **{f: withdrawal.get(f) for f in EVENT_FIELDS["withdrawal"]})
+
+_cache.add_reload_listener(DEPOSITS_FILE, _journal_reloaded("deposit"))
+_cache.add_reload_listener(PURCHASES_FILE, _journal_reloaded("purchase"))
+_cache.add_reload_listener(SPINS_FILE, _journal_reloaded("spin"))
+
+def poll_events():
+    """Подхватить изменения журналов другими процессами (события уйдут в шину)"""
+    with LOCK:
+        for filepath in (USERS_FILE, DEPOSITS_FILE, PURCHASES_FILE, SPINS_FILE, WITHDRAWALS_FILE):
+            _cache.load(filepath, [] if filepath != USERS_FILE else {})
+
+def set_write_delay(seconds: float):
+    """Задержка отложенной записи; 0 - писать сразу (админ-панель)"""
+    _cache.set_write_delay(seconds)
+
+def _get_audience_index() -> AudienceIndex:
+    """Индекс пользователей; строится при первом обращении"""
+    global _audience_index
+    with LOCK:
+        if _audience_index is None:
+            _audience_index = AudienceIndex()
+            _audience_index.rebuild(_cache.load(USERS_FILE, {}), _load_json(USER_LANGUAGES_FILE, {}))
+            add_user_listener(_audience_index.update)
+            logger.info(f"Audience index built: {len(_audience_index)} users")
+        return _audience_index
+
+def select_audience(**filters) -> List[int]:
+    """ID пользователей по сегменту (см. AudienceIndex.select)"""
+    with LOCK:
+        return _get_audience_index().select(**filters)
+
+def search_users(query: str, limit: int = 10) -> List[Dict[str, Any]]:
+    """Поиск пользователей по префиксу ID и подстроке username"""
+    with LOCK:
+        ids = _get_audience_index().search.search(query, limit)
+        users = _cache.load(USERS_FILE, {})
+        return [dict(users[str(uid)]) for uid in ids if str(uid) in users]
+
+def get_users_summary() -> Dict[str, Any]:
+    """Сводка по пользователям: количество, активность, суммы"""
+    with LOCK:
+        return _get_audience_index().summary()
+
+def get_users_page(sort: str = "id", order: str = "asc", cursor: str = None, limit: int = 50,
+                   username: str = None, user_id: str = None, activity: str = None) -> Dict[str, Any]:
+    """Страница пользователей с сортировкой и фильтрами; cursor - из next_cursor прошлой страницы"""
+    after = None
+    if cursor:
+        value, _, uid = cursor.rpartition(":")
+        after = (float(value), int(uid))
+
+    with LOCK:
+        index = _get_audience_index()
+        only = index.filter_ids(username=username, id_prefix=user_id, activity=activity)
+        ids, last = index.page(sort, order == "desc", after, limit, only)
+        users = _cache.load(USERS_FILE, {})
+        page = [dict(users[str(uid)]) for uid in ids if str(uid) in users]
+        total = len(index) if only is None else len(only)
+
+    return {
+        "users": page,
+        "total": total,
+        "next_cursor": f"{last[0]}:{last[1]}" if last else None
+    }
+
 def get_user(user_id: int) -> Dict[str, Any]:
     """   """
     with LOCK:
@@ -217,6 +601,7 @@ def get_user(user_id: int) -> Dict[str, Any]:
             users[user_id_str]["last_active"] = time.time()
             _cache.save(USERS_FILE, users)
         
+        _user_changed(user_id_str, users[user_id_str])
         return users[user_id_str]
 
 def update_user(user_id: int, data: Dict[str, Any]):
@@ -232,6 +617,7 @@ def update_user(user_id: int, data: Dict[str, Any]):
         users[user_id_str].update(data)
         users[user_id_str]["last_active"] = time.time()
         _cache.save(USERS_FILE, users)
+        _user_changed(user_id_str, users[user_id_str])
 
 def get_user_balance(user_id: int) -> float:
     """  """
@@ -269,6 +655,7 @@ def update_user_balance(user_id: int, amount: float, operation: str = "set") ->
         
         users[user_id_str]["balance"] = new_balance
         _cache.save(USERS_FILE, users)
+        _user_changed(user_id_str, users[user_id_str])
         return True
 
 def atomic_balance_change(user_id: int, delta: float) -> bool:
@@ -294,6 +681,7 @@ def update_user_stat(user_id: int, stat_name: str, value: Any):
         
         users[user_id_str][stat_name] = value
         _cache.save(USERS_FILE, users)
+        _user_changed(user_id_str, users[user_id_str])
 
 def get_all_users() -> List[Dict[str, Any]]:
     """  """
@@ -364,6 +752,75 @@ def get_wallet_by_address(address: str) -> Optional[Dict[str, Any]]:
 # 
 # ========================
 
+# Сводка по пользователю: счётчики, суммы и время первого/последнего события
+USER_SUMMARIES_FILE = os.path.join(DATA_DIR, "user_summaries.json")
+
+def _empty_event_summary() -> Dict[str, Any]:
+    return {"count": 0, "first": None, "last": None}
+
+def _bump_event(summary: Dict[str, Any], kind: str, ts: float, **sums: float):
+    event = summary.setdefault(kind, _empty_event_summary())
+    event["count"] += 1
+    if event["first"] is None:
+        event["first"] = ts
+    event["last"] = ts
+    for key, value in sums.items():
+        event[key] = event.get(key, 0) + value
+
+def _build_user_summaries() -> Dict[str, Dict[str, Any]]:
+    """Первичное построение сводок из истории (для данных до появления сводок)"""
+    summaries: Dict[str, Dict[str, Any]] = {}
+    for dep in _cache.load(DEPOSITS_FILE, []):
+        _bump_event(summaries.setdefault(str(dep.get("user_id")), {}), "deposits",
+                    dep.get("timestamp", 0), sum=float(dep.get("amount", 0)))
+    for pur in _cache.load(PURCHASES_FILE, []):
+        _bump_event(summaries.setdefault(str(pur.get("user_id")), {}), "purchases",
+                    pur.get("timestamp", 0), sum=float(pur.get("amount", 0)), stars=int(pur.get("stars", 0)))
+    for tx in _cache.load(TRANSACTIONS_FILE, []):
+        _bump_event(summaries.setdefault(str(tx.get("user_id")), {}), "transactions",
+                    tx.get("timestamp", 0), sum=float(tx.get("amount", 0)))
+
+    # Список спинов обрезан до последних 10000 - счётчики берём из пользователя
+    spin_times: Dict[str, List[float]] = {}
+    for spin in _cache.load(SPINS_FILE, []):
+        spin_times.setdefault(str(spin.get("user_id")), []).append(spin.get("timestamp", 0))
+    for uid, user in _cache.load(USERS_FILE, {}).items():
+        if not user.get("spin_count"):
+            continue
+        times = spin_times.get(uid) or [None]
+        summaries.setdefault(uid, {})["spins"] = {
+            "count": int(user.get("spin_count", 0)),
+            "bet": float(user.get("total_spin_bet", 0)),
+            "win": float(user.get("total_spin_win", 0)),
+            "first": min(times) if times[0] is not None else None,
+            "last": max(times) if times[0] is not None else None
+        }
+    return summaries
+
+def _load_user_summaries() -> Dict[str, Dict[str, Any]]:
+    summaries = _cache.load(USER_SUMMARIES_FILE, None)
+    if summaries is None:
+        summaries = _build_user_summaries()
+        _cache.save(USER_SUMMARIES_FILE, summaries)
+        logger.info(f"User summaries built for {len(summaries)} users")
+    return summaries
+
+def _record_user_event(user_id: int, kind: str, ts: float, **sums: float):
+    """Обновить сводку пользователя при записи события"""
+    with LOCK:
+        summaries = _load_user_summaries()
+        _bump_event(summaries.setdefault(str(user_id), {}), kind, ts, **sums)
+        _cache.save(USER_SUMMARIES_FILE, summaries)
+
+def get_user_summary(user_id: int) -> Dict[str, Dict[str, Any]]:
+    """Сводка пользователя: deposits, purchases, spins, transactions"""
+    with LOCK:
+        summary = _load_user_summaries().get(str(user_id), {})
+        return {
+            kind: dict(summary.get(kind) or _empty_event_summary())
+            for kind in ("deposits", "purchases", "spins", "transactions")
+        }
+
 def log_deposit(user_id: int, amount: float, hash: str, from_address: str = None):
     """ """
     with LOCK:
@@ -377,8 +834,11 @@ def log_deposit(user_id: int, amount: float, hash: str, from_address: str = None
             "timestamp": time.time()
         }
         
+        # Сводка строится из истории при первом обращении - до добавления события
+        _record_user_event(user_id, "deposits", deposit["timestamp"], sum=float(amount))
         deposits.append(deposit)
         _cache.save(DEPOSITS_FILE, deposits)
+        _publish_record("deposit", deposit)
         
         #   
         user = get_user(user_id)
@@ -418,8 +878,10 @@ def log_purchase(user_id: int, stars: int, amount: float, tx_hash: str = None):
             "timestamp": time.time()
         }
         
+        _record_user_event(user_id, "purchases", purchase["timestamp"], sum=float(amount), stars=int(stars))
         purchases.append(purchase)
         _cache.save(PURCHASES_FILE, purchases)
+        _publish_record("purchase", purchase)
         
         #   
         user = get_user(user_id)
@@ -484,14 +946,19 @@ def log_spin(user_id: int, spin_id: str = None, bet: float = 0, win: float = 0,
             "chat_id": chat_id
         }
         
+        _record_user_event(user_id, "spins", spin["timestamp"], bet=float(bet), win=float(win))
         spins.append(spin)
         
-        # Ротация - храним только последние 10000 спинов
-        MAX_SPINS = 10000
+        # Ротация - храним только последние MAX_SPINS спинов
         if len(spins) > MAX_SPINS:
             spins = spins[-MAX_SPINS:]
         
         _cache.save(SPINS_FILE, spins)
+        _publish_record("spin", spin)
+        if chat_id is not None:
+            add_chat_member(chat_id, user_id)
+            if _chat_leaderboards is not None:
+                _chat_leaderboards.add_spin(chat_id, user_id, spin["bet"], spin["timestamp"])
         
         #   
         user = get_user(user_id)
@@ -531,6 +998,7 @@ def log_transaction(user_id: int, type: str, amount: float, description: str = N
             "timestamp": time.time()
         }
         
+        _record_user_event(user_id, "transactions", transaction["timestamp"], sum=float(amount))
         transactions.append(transaction)
         _cache.save(TRANSACTIONS_FILE, transactions)
 
@@ -816,6 +1284,52 @@ def get_transactions_list() -> List[Dict]:
             logger.error(f"Error loading transactions: {e}")
             return []
 
+# Журналы истории для выгрузок админки
+HISTORY_FILES = {
+    "deposits": DEPOSITS_FILE,
+    "purchases": PURCHASES_FILE,
+    "spins": SPINS_FILE,
+    "transactions": TRANSACTIONS_FILE,
+}
+
+def iter_history(kind: str, since: float = None, until: float = None,
+                 user_id: int = None, chunk_size: int = 500) -> Iterator[Dict]:
+    """Записи журнала по одной, без копирования списка.
+
+    Журналы только дописываются (ротация заменяет список целиком), поэтому
+    границы берутся под LOCK, а записи отдаются кусками между захватами.
+    """
+    filepath = HISTORY_FILES[kind]
+    with LOCK:
+        records = _cache.load(filepath, [])
+        end = len(records) if isinstance(records, list) else 0
+    
+    for start in range(0, end, chunk_size):
+        with LOCK:
+            chunk = records[start:min(start + chunk_size, end)]
+        for record in chunk:
+            ts = record.get("timestamp", 0)
+            if since is not None and ts < since:
+                continue
+            if until is not None and ts >= until:
+                continue
+            if user_id is not None and record.get("user_id") != user_id:
+                continue
+            yield record
+
+_history_indexes: Dict[str, HistoryIndex] = {}
+
+def get_history_page(kind: str, before: str = None, after: str = None, limit: int = 50) -> Dict[str, Any]:
+    """Страница журнала по курсору "timestamp:user_id" (см. HistoryIndex.page)"""
+    before_key, after_key = parse_cursor(before), parse_cursor(after)
+    with LOCK:
+        records = _cache.load(HISTORY_FILES[kind], [])
+        index = _history_indexes.setdefault(kind, HistoryIndex())
+        index.sync(records if isinstance(records, list) else [])
+        page = index.page(before=before_key, after=after_key, limit=limit)
+        page["total"] = len(index)
+        return page
+
 def find_spin_by_hash(spin_hash: str) -> Optional[Dict]:
     """   """
     try:
@@ -1015,27 +1529,26 @@ def block_user(user_id, reason=''):
     import os
     
     user_id_str = str(user_id)
-    users_file = 'data/users.json'
     
     try:
-        #  
-        with open(users_file, 'r', encoding='utf-8') as f:
-            users = json.load(f)
-        
-        if user_id_str not in users:
-            print(f"User {user_id_str} not found in users.json")
-            return False
-        
-        #  
-        users[user_id_str]['is_blocked'] = True
-        users[user_id_str]['blocked_at'] = int(time.time())
-        users[user_id_str]['blocked_reason'] = reason
-        
-        #    
-        with open(users_file, 'w', encoding='utf-8') as f:
-            json.dump(users, f, ensure_ascii=False, indent=2)
+        with LOCK:
+            users = _cache.load(USERS_FILE, {})
+            
+            if user_id_str not in users:
+                print(f"User {user_id_str} not found in users.json")
+                return False
+            
+            #  
+            users[user_id_str]['is_blocked'] = True
+            users[user_id_str]['blocked_at'] = int(time.time())
+            users[user_id_str]['blocked_reason'] = reason
+            
+            # Сразу на диск: бот должен увидеть блокировку без задержки записи
+            _cache.save(USERS_FILE, users, immediate=True)
+            _user_changed(user_id_str, users[user_id_str])
         
         print(f"User {user_id_str} successfully blocked")
+        events.publish("block", user_id=int(user_id_str), blocked=True)
         
         #    
         import sqlite3
@@ -1064,24 +1577,24 @@ def unblock_user(user_id):
     import os
     
     user_id_str = str(user_id)
-    users_file = 'data/users.json'
     
     try:
-        with open(users_file, 'r', encoding='utf-8') as f:
-            users = json.load(f)
-        
-        if user_id_str not in users:
-            return False
-        
-        # 
-        users[user_id_str]['is_blocked'] = False
-        users[user_id_str]['blocked_at'] = None
-        users[user_id_str]['blocked_reason'] = None
-        
-        with open(users_file, 'w', encoding='utf-8') as f:
-            json.dump(users, f, ensure_ascii=False, indent=2)
+        with LOCK:
+            users = _cache.load(USERS_FILE, {})
+            
+            if user_id_str not in users:
+                return False
+            
+            # 
+            users[user_id_str]['is_blocked'] = False
+            users[user_id_str]['blocked_at'] = None
+            users[user_id_str]['blocked_reason'] = None
+            
+            _cache.save(USERS_FILE, users, immediate=True)
+            _user_changed(user_id_str, users[user_id_str])
         
         print(f"User {user_id_str} unblocked")
+        events.publish("block", user_id=int(user_id_str), blocked=False)
         
         #  
         import sqlite3
@@ -1253,6 +1766,7 @@ def update_balance(user_id: int, amount: float):
         users[user_id_str]['balance'] = new_balance
         
         _cache.save(USERS_FILE, users)
+        _user_changed(user_id_str, users[user_id_str])
         logger.info(f"Balance updated for user {user_id}: {current_balance} -> {new_balance}")
         
         return new_balance
@@ -1282,29 +1796,12 @@ def rollback_purchase(user_id: int, cost: float, stars: int, purchase_id: str):
                 users[user_id_str]['total_bought'] = total_bought - stars
             
             _cache.save(USERS_FILE, users)
+            _user_changed(user_id_str, users[user_id_str])
             logger.info(f"Rollback success: user={user_id}, returned={cost:.4f}, balance: {old_balance:.4f} -> {new_balance:.4f}")
     except Exception as e:
         # Ошибка в rollback не должна ломать основной процесс
         logger.error(f"Rollback failed (safe): {e}")
 
-def rollback_purchase(user_id: int, cost: float, stars: int, purchase_id: str):
-    """Безопасный возврат баланса при ошибке покупки"""
-    try:
-        if not user_id or not cost or cost <= 0:
-            return
-        user_id_str = str(user_id)
-        with LOCK:
-            users = _cache.load(USERS_FILE, {})
-            if user_id_str not in users:
-                return
-            old_balance = float(users[user_id_str].get("balance", 0))
-            new_balance = old_balance + float(cost)
-            users[user_id_str]["balance"] = new_balance
-            _cache.save(USERS_FILE, users)
-            logger.info(f"Rollback: returned {cost} to user {user_id}")
-    except Exception as e:
-        logger.error(f"Rollback failed: {e}")
-
 
 
 # ============================================================
@@ -1312,12 +1809,131 @@ def rollback_purchase(user_id: int, cost: float, stars: int, purchase_id: str):
 # ============================================================
 
 CHATS_FILE = os.path.join(DATA_DIR, "chats.json")
-CHAT_EARNINGS_FILE = os.path.join(DATA_DIR, "chat_earnings.json")
+CHAT_EARNINGS_FILE = os.path.join(DATA_DIR, "chat_earnings.json")  # прежний общий файл, переносится в CHAT_EARNINGS_DIR
+CHAT_EARNINGS_DIR = os.path.join(DATA_DIR, "chat_earnings")  # <chat_id>.json - последние записи чата
+CHAT_EARNINGS_ARCHIVE_DIR = os.path.join(DATA_DIR, "chat_earnings_archive")
+CHAT_EARNINGS_PER_CHAT = 1000  # записей истории на чат
+CHAT_EARNINGS_ARCHIVE = True  # вытесненные записи дописываются в архив чата (JSONL)
 
 # Процент комиссии владельцам чатов
 CHAT_SPIN_COMMISSION = 40  # 40% от проигрыша в спинах
 CHAT_PURCHASE_COMMISSION = 30  # 30% от наценки при покупке
 
+def _archive_chat_earnings(chat_id_str: str, records: List[Dict[str, Any]]):
+    """Дописать вытесненные записи в архив чата"""
+    if not CHAT_EARNINGS_ARCHIVE or not records:
+        return
+    os.makedirs(CHAT_EARNINGS_ARCHIVE_DIR, exist_ok=True)
+    with open(os.path.join(CHAT_EARNINGS_ARCHIVE_DIR, f"{chat_id_str}.jsonl"), 'a', encoding='utf-8') as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+def _trim_chat_earnings(records: List[Dict[str, Any]], slack: int = 0) -> List[Dict[str, Any]]:
+    """Оставить последние CHAT_EARNINGS_PER_CHAT записей (обрезка пачками по slack).
+
+    Возвращает вытесненные записи: их архивируют после записи файла чата,
+    чтобы падение между двумя записями не дублировало их в архиве.
+    """
+    overflow = len(records) - CHAT_EARNINGS_PER_CHAT
+    if overflow <= slack:
+        return []
+    trimmed = records[:overflow]
+    del records[:overflow]
+    return trimmed
+
+def _chat_earnings_file(chat_id_str: str) -> str:
+    return os.path.join(CHAT_EARNINGS_DIR, f"{chat_id_str}.json")
+
+_chat_earnings_migrated = False
+
+def _migrate_chat_earnings():
+    """Разложить общий chat_earnings.json по файлам чатов (вызывать под LOCK).
+
+    Файл сначала переименовывается в chat_earnings.json.migrating; если
+    процесс упал посреди переноса, следующий запуск продолжит с него.
+    Повторный перенос записей, уже попавших в файл чата, не дублирует их.
+    """
+    global _chat_earnings_migrated
+    if _chat_earnings_migrated:
+        return
+    
+    migrating = CHAT_EARNINGS_FILE + ".migrating"
+    os.makedirs(DATA_DIR, exist_ok=True)
+    with open(CHAT_EARNINGS_FILE + '.lock', 'a') as lock_file:
+        # Переносит один процесс, другой ждёт и видит уже перенесённое
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            if not os.path.exists(migrating):
+                try:
+                    os.replace(CHAT_EARNINGS_FILE, migrating)
+                except FileNotFoundError:
+                    _chat_earnings_migrated = True
+                    return
+            with open(migrating, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            
+            if isinstance(data, list):
+                # Самый старый формат - общий список на все чаты
+                by_chat: Dict[str, List[Dict[str, Any]]] = {}
+                for record in sorted(data, key=lambda x: x.get("timestamp", 0)):
+                    by_chat.setdefault(str(record.get("chat_id")), []).append(record)
+                data = by_chat
+            
+            for chat_id_str, records in data.items():
+                def prepend(current, records=records):
+                    known = {json.dumps(r, sort_keys=True) for r in current}
+                    missing = [r for r in records if json.dumps(r, sort_keys=True) not in known]
+                    current[:] = sorted(missing + current, key=lambda x: x.get("timestamp", 0))
+                    return _trim_chat_earnings(current)
+                trimmed = _cache.update(_chat_earnings_file(chat_id_str), [], prepend)
+                _archive_chat_earnings(chat_id_str, trimmed)
+            os.replace(migrating, CHAT_EARNINGS_FILE + ".migrated")
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+    
+    _chat_earnings_migrated = True
+    logger.info(f"Chat earnings moved to {CHAT_EARNINGS_DIR}: {len(data)} chats")
+
+def _load_chat_earnings(chat_id_str: str) -> List[Dict[str, Any]]:
+    """История заработков чата (вызывать под LOCK)"""
+    _migrate_chat_earnings()
+    return _cache.load(_chat_earnings_file(chat_id_str), [])
+
+def _earning_chat_ids() -> List[str]:
+    """Чаты, у которых есть история заработков"""
+    _migrate_chat_earnings()
+    try:
+        names = os.listdir(CHAT_EARNINGS_DIR)
+    except FileNotFoundError:
+        return []
+    return [name[:-len(".json")] for name in names if name.endswith(".json")]
+
+_partner_index: Optional[PartnerIndex] = None
+
+def _get_partner_index() -> PartnerIndex:
+    """Индекс партнёров; строится при первом обращении"""
+    global _partner_index
+    with LOCK:
+        if _partner_index is None:
+            _partner_index = PartnerIndex(PARTNER_LEVELS)
+            _partner_index.rebuild(_cache.load(CHATS_FILE, {}))
+        return _partner_index
+
+def _chat_changed(chat_id_str: str, chat: Dict[str, Any]):
+    if _partner_index is not None:
+        _partner_index.update(chat_id_str, chat)
+
+def _chats_reloaded(old: Optional[Dict[str, Any]], new: Dict[str, Any]):
+    """Чаты изменены другим процессом: обновить индекс партнёров"""
+    if _partner_index is None:
+        return
+    for chat_id_str in set(old or {}) - set(new):
+        _partner_index.remove(chat_id_str)
+    for chat_id_str, chat in new.items():
+        _chat_changed(chat_id_str, chat)
+
+_cache.add_reload_listener(CHATS_FILE, _chats_reloaded)
+
 
 def register_chat(chat_id: int, owner_id: int, title: str = "") -> Dict[str, Any]:
     """Регистрация нового чата при добавлении бота"""
@@ -1349,6 +1965,7 @@ def register_chat(chat_id: int, owner_id: int, title: str = "") -> Dict[str, Any
             }
             _cache.save(CHATS_FILE, chats)
             logger.info(f"Chat registered: {chat_id} (owner: {owner_id}, title: {title})")
+        _chat_changed(chat_id_str, chats[chat_id_str])
         return chats[chat_id_str]
 
 
@@ -1366,6 +1983,7 @@ def update_chat(chat_id: int, data: Dict[str, Any]):
         if chat_id_str in chats:
             chats[chat_id_str].update(data)
             _cache.save(CHATS_FILE, chats)
+            _chat_changed(chat_id_str, chats[chat_id_str])
 
 
 def deactivate_chat(chat_id: int):
@@ -1388,15 +2006,17 @@ def get_active_chats() -> List[Dict[str, Any]]:
 
 def get_owner_chats(owner_id: int) -> List[Dict[str, Any]]:
     """Получить все чаты владельца"""
-    chats = _cache.load(CHATS_FILE, {})
-    return [c for c in chats.values() if c.get("owner_id") == owner_id and c.get("is_active", True)]
+    with LOCK:
+        chats = _cache.load(CHATS_FILE, {})
+        return [chats[cid] for cid in _get_partner_index().chat_ids(owner_id, active_only=True)]
 
 
 
 def get_owner_all_chats(owner_id: int) -> List[Dict[str, Any]]:
     """Получить ВСЕ чаты владельца (включая неактивные) для расчёта прогресса"""
-    chats = _cache.load(CHATS_FILE, {})
-    return [c for c in chats.values() if c.get("owner_id") == owner_id]
+    with LOCK:
+        chats = _cache.load(CHATS_FILE, {})
+        return [chats[cid] for cid in _get_partner_index().chat_ids(owner_id)]
 
 
 def add_chat_earning(chat_id: int, amount: float, earning_type: str, 
@@ -1426,9 +2046,10 @@ def add_chat_earning(chat_id: int, amount: float, earning_type: str,
             chat["total_purchases"] = chat.get("total_purchases", 0) + 1
         
         _cache.save(CHATS_FILE, chats)
+        _chat_changed(chat_id_str, chat)
         
-        # Логируем заработок
-        earnings = _cache.load(CHAT_EARNINGS_FILE, [])
+        # Логируем заработок в историю чата (свой файл на чат)
+        earnings = _load_chat_earnings(chat_id_str)
         earnings.append({
             "chat_id": chat_id,
             "owner_id": chat["owner_id"],
@@ -1438,36 +2059,44 @@ def add_chat_earning(chat_id: int, amount: float, earning_type: str,
             "details": details,
             "timestamp": time.time()
         })
-        # Храним последние 10000 записей
-        if len(earnings) > 10000:
-            earnings = earnings[-10000:]
-        _cache.save(CHAT_EARNINGS_FILE, earnings)
+        trimmed = _trim_chat_earnings(earnings, slack=CHAT_EARNINGS_PER_CHAT // 10)
+        # После обрезки файл пишется сразу, и только потом - архив
+        _cache.save(_chat_earnings_file(chat_id_str), earnings, immediate=bool(trimmed))
+        _archive_chat_earnings(chat_id_str, trimmed)
         
         logger.info(f"Chat earning: chat={chat_id}, type={earning_type}, amount={amount:.6f}")
 
 
 def get_chat_earnings(chat_id: int = None, owner_id: int = None, 
                       limit: int = 100) -> List[Dict[str, Any]]:
-    """Получить историю заработков"""
-    earnings = _cache.load(CHAT_EARNINGS_FILE, [])
-    
-    if chat_id:
-        earnings = [e for e in earnings if e.get("chat_id") == chat_id]
-    if owner_id:
-        earnings = [e for e in earnings if e.get("owner_id") == owner_id]
-    
-    return sorted(earnings, key=lambda x: x.get("timestamp", 0), reverse=True)[:limit]
+    """Получить историю заработков (новые первыми)"""
+    with LOCK:
+        if chat_id:
+            chat_ids = [str(chat_id)]
+        elif owner_id:
+            chat_ids = _get_partner_index().chat_ids(owner_id)
+        else:
+            chat_ids = _earning_chat_ids()
+        histories = [_load_chat_earnings(cid) for cid in chat_ids]
+        
+        # История каждого чата упорядочена по времени - сливаем с конца
+        newest = heapq.merge(*(reversed(records) for records in histories),
+                             key=lambda x: x.get("timestamp", 0), reverse=True)
+        if chat_id and owner_id:
+            newest = (e for e in newest if e.get("owner_id") == owner_id)
+        return list(itertools.islice(newest, limit))
 
 
 def get_owner_total_earnings(owner_id: int) -> Dict[str, float]:
     """Получить общий заработок владельца по всем его чатам"""
-    chats = get_owner_all_chats(owner_id)
+    with LOCK:
+        totals = _get_partner_index().totals(owner_id)
     return {
-        "total": sum(c.get("total_earnings", 0) for c in chats),
-        "spin": sum(c.get("spin_earnings", 0) for c in chats),
-        "purchase": sum(c.get("purchase_earnings", 0) for c in chats),
-        "withdrawn": sum(c.get("withdrawn", 0) for c in chats),
-        "available": sum(c.get("total_earnings", 0) - c.get("withdrawn", 0) for c in chats)
+        "total": totals["total_earnings"],
+        "spin": totals["spin_earnings"],
+        "purchase": totals["purchase_earnings"],
+        "withdrawn": totals["withdrawn"],
+        "available": totals["total_earnings"] - totals["withdrawn"]
     }
 
 
@@ -1562,6 +2191,7 @@ def add_chat_volume(chat_id: int, amount: float):
         if chat_id_str in chats:
             chats[chat_id_str]["total_volume"] = chats[chat_id_str].get("total_volume", 0) + amount
             _cache.save(CHATS_FILE, chats)
+            _chat_changed(chat_id_str, chats[chat_id_str])
 
 
 def calculate_spin_commission_by_level(bet: float, win: float, owner_id: int) -> float:
@@ -1600,6 +2230,8 @@ def remove_chat(chat_id: int) -> bool:
         if chat_id_str in chats:
             del chats[chat_id_str]
             _cache.save(CHATS_FILE, chats)
+            if _partner_index is not None:
+                _partner_index.remove(chat_id_str)
             logger.info(f"Chat removed: {chat_id}")
             return True
     return False
@@ -1610,6 +2242,7 @@ def remove_chat(chat_id: int) -> bool:
 # ============================================================
 
 WITHDRAWALS_FILE = os.path.join(DATA_DIR, "partner_withdrawals.json")
+_cache.add_reload_listener(WITHDRAWALS_FILE, _withdrawals_reloaded)
 
 def create_withdrawal_request(owner_id: int, amount: float, wallet_address: str) -> dict:
     """Создать запрос на вывод"""
@@ -1630,6 +2263,7 @@ def create_withdrawal_request(owner_id: int, amount: float, wallet_address: str)
         
         withdrawals.append(request)
         _cache.save(WITHDRAWALS_FILE, withdrawals)
+        _publish_record("withdrawal", request)
         logger.info(f"Withdrawal request created: {request['id']}, amount={amount}, owner={owner_id}")
         return request
 
@@ -1684,6 +2318,7 @@ def update_withdrawal_status(withdrawal_id: str, status: str, tx_hash: str = Non
                             remaining -= to_withdraw
                 
                 _cache.save(WITHDRAWALS_FILE, withdrawals)
+                events.publish("withdrawal_status", **{f: w.get(f) for f in EVENT_FIELDS["withdrawal"]})
                 logger.info(f"Withdrawal {withdrawal_id} updated: status={status}")
                 return True
         
@@ -1697,40 +2332,26 @@ def get_pending_withdrawals_count() -> int:
 
 
 def get_all_partners() -> list:
-    """Получить всех партнёров с их статистикой"""
-    chats = _cache.load(CHATS_FILE, {})
-    
-    # Группируем по owner_id
-    partners = {}
-    for chat_id, chat in chats.items():
-        owner_id = chat.get("owner_id")
-        if owner_id not in partners:
-            partners[owner_id] = {
+    """Получить всех партнёров с их статистикой (по убыванию объёма)"""
+    with LOCK:
+        index = _get_partner_index()
+        result = []
+        for owner_id, totals, chats_count in index.partners():
+            level_key, _ = index.level(owner_id)
+            earnings, withdrawn = totals["total_earnings"], totals["withdrawn"]
+            result.append({
                 "owner_id": owner_id,
-                "chats": [],
-                "total_earnings": 0,
-                "total_volume": 0,
-                "total_withdrawn": 0
-            }
-        
-        partners[owner_id]["chats"].append(chat)
-        partners[owner_id]["total_earnings"] += chat.get("total_earnings", 0)
-        partners[owner_id]["total_volume"] += chat.get("total_volume", 0)
-        partners[owner_id]["total_withdrawn"] += chat.get("withdrawn", 0)
-    
-    # Добавляем уровень каждому партнёру
-    result = []
-    for owner_id, data in partners.items():
-        level_info = get_owner_level(owner_id)
-        data["level"] = level_info["level_key"]
-        data["level_name"] = level_info["level"]["name"]
-        data["available"] = data["total_earnings"] - data["total_withdrawn"]
-        data["chats_count"] = len(data["chats"])
-        data["total_earned"] = data["total_earnings"]
-        data["withdrawn"] = data["total_withdrawn"]
-        result.append(data)
-    
-    return sorted(result, key=lambda x: x["total_volume"], reverse=True)
+                "level": level_key,
+                "level_name": PARTNER_LEVELS[level_key]["name"],
+                "chats_count": chats_count,
+                "total_volume": totals["total_volume"],
+                "total_earnings": earnings,
+                "total_earned": earnings,
+                "total_withdrawn": withdrawn,
+                "withdrawn": withdrawn,
+                "available": earnings - withdrawn,
+            })
+        return result
 
 
 def set_partner_level(owner_id: int, level_key: str) -> bool:
@@ -1741,10 +2362,10 @@ def set_partner_level(owner_id: int, level_key: str) -> bool:
     with LOCK:
         chats = _cache.load(CHATS_FILE, {})
         updated = False
-        for chat_id, chat in chats.items():
-            if chat.get("owner_id") == owner_id:
-                chat["manual_level"] = level_key
-                updated = True
+        for chat_id in _get_partner_index().chat_ids(owner_id):
+            chats[chat_id]["manual_level"] = level_key
+            _chat_changed(chat_id, chats[chat_id])
+            updated = True
         
         if updated:
             _cache.save(CHATS_FILE, chats)
@@ -1756,48 +2377,32 @@ def adjust_partner_balance(owner_id: int, amount: float, reason: str = "") -> bo
     """Изменить баланс партнёра (добавить/вычесть)"""
     with LOCK:
         chats = _cache.load(CHATS_FILE, {})
-        # Находим первый чат партнёра для корректировки
-        for chat_id, chat in chats.items():
-            if chat.get("owner_id") == owner_id:
-                chat["total_earnings"] = chat.get("total_earnings", 0) + amount
-                chat["balance_adjustments"] = chat.get("balance_adjustments", [])
-                chat["balance_adjustments"].append({
-                    "amount": amount,
-                    "reason": reason,
-                    "timestamp": time.time()
-                })
-                _cache.save(CHATS_FILE, chats)
-                logger.info(f"Partner {owner_id} balance adjusted by {amount}: {reason}")
-                return True
-        return False
+        # Корректируем первый чат партнёра
+        chat_ids = _get_partner_index().chat_ids(owner_id)
+        if not chat_ids:
+            return False
+        
+        chat = chats[chat_ids[0]]
+        chat["total_earnings"] = chat.get("total_earnings", 0) + amount
+        chat["balance_adjustments"] = chat.get("balance_adjustments", [])
+        chat["balance_adjustments"].append({
+            "amount": amount,
+            "reason": reason,
+            "timestamp": time.time()
+        })
+        _cache.save(CHATS_FILE, chats)
+        _chat_changed(chat_ids[0], chat)
+        logger.info(f"Partner {owner_id} balance adjusted by {amount}: {reason}")
+        return True
 
 
 def get_owner_level(owner_id: int) -> dict:
     """Получить уровень партнёра (с учётом ручной установки)"""
-    chats = get_owner_all_chats(owner_id)
-    total_volume = sum(c.get("total_volume", 0) for c in chats)
-    
-    # Проверяем ручной уровень
-    manual_level = None
-    for chat in chats:
-        if chat.get("manual_level"):
-            manual_level = chat.get("manual_level")
-            break
-    
-    if manual_level and manual_level in PARTNER_LEVELS:
-        level = PARTNER_LEVELS[manual_level]
-        level_key = manual_level
-    else:
-        # Автоматический расчёт
-        level = PARTNER_LEVELS["bronze"]
-        level_key = "bronze"
-        
-        if total_volume >= PARTNER_LEVELS["gold"]["min_volume"]:
-            level = PARTNER_LEVELS["gold"]
-            level_key = "gold"
-        elif total_volume >= PARTNER_LEVELS["silver"]["min_volume"]:
-            level = PARTNER_LEVELS["silver"]
-            level_key = "silver"
+    with LOCK:
+        index = _get_partner_index()
+        total_volume = index.volume(owner_id)
+        level_key, is_manual = index.level(owner_id)
+    level = PARTNER_LEVELS[level_key]
     
     # Прогресс до следующего уровня
     next_level = None
@@ -1821,7 +2426,7 @@ def get_owner_level(owner_id: int) -> dict:
         "next_level": next_level,
         "progress": max(0, min(progress, 100)),
         "remaining": max(remaining, 0),
-        "is_manual": manual_level is not None
+        "is_manual": is_manual
     }
 
 
@@ -1829,19 +2434,112 @@ def get_owner_level(owner_id: int) -> dict:
 # NGR TRACKING - Net Gaming Revenue для партнёрской программы
 # ============================================================
 
-PLAYER_NGR_FILE = os.path.join(DATA_DIR, "player_ngr.json")
+PLAYER_NGR_FILE = os.path.join(DATA_DIR, "player_ngr.json")  # прежний формат, переносится в NGR_STORE_FILE
+NGR_STORE_FILE = os.path.join(DATA_DIR, "player_ngr.bin")
+
+_ngr_store: Optional[NGRStore] = None
+
+def _get_ngr_store() -> NGRStore:
+    """Хранилище NGR; при первом запуске переносит данные из player_ngr.json"""
+    global _ngr_store
+    with LOCK:
+        if _ngr_store is None:
+            if not os.path.exists(NGR_STORE_FILE):
+                # Перенос через временный файл: прерванная миграция повторится
+                legacy = _load_json(PLAYER_NGR_FILE, {})
+                temp_file = NGR_STORE_FILE + ".tmp"
+                if os.path.exists(temp_file):
+                    os.remove(temp_file)
+                temp = NGRStore(temp_file)
+                temp.open()
+                for player in legacy.values():
+                    temp.put(int(player["user_id"]), int(player["chat_id"]),
+                             float(player.get("total_wagered", 0)), float(player.get("total_won", 0)),
+                             float(player.get("paid_ngr", 0)), flush=False)
+                temp.close()
+                os.replace(temp_file, NGR_STORE_FILE)
+                if legacy:
+                    logger.info(f"Player NGR migrated to {NGR_STORE_FILE}: {len(legacy)} records")
+            _ngr_store = NGRStore(NGR_STORE_FILE)
+            _ngr_store.open()
+        return _ngr_store
+
+_chat_leaderboards: Optional[ChatLeaderboards] = None
+
+def _get_chat_leaderboards() -> ChatLeaderboards:
+    """Топы чатов; строятся при первом /top из журнала спинов и NGR"""
+    global _chat_leaderboards
+    store = _get_ngr_store()
+    with LOCK:
+        if _chat_leaderboards is None:
+            boards = ChatLeaderboards()
+            for spin in _cache.load(SPINS_FILE, []):
+                if spin.get("chat_id") is not None:
+                    boards.add_spin(spin["chat_id"], spin.get("user_id"), float(spin.get("bet", 0)),
+                                    spin.get("timestamp", 0))
+            for (user_id, chat_id), (wagered, _, _) in store.items():
+                boards.set_total(chat_id, user_id, wagered)
+            _chat_leaderboards = boards
+        return _chat_leaderboards
+
+CHAT_MEMBERS_FILE = os.path.join(DATA_DIR, "chat_members.json")
+
+_chat_members: Optional[ChatMembers] = None
+
+def _get_chat_members() -> ChatMembers:
+    """Участники чатов; при первом запуске собираются из NGR игроков"""
+    global _chat_members
+    store = _get_ngr_store()
+    with LOCK:
+        if _chat_members is None:
+            saved = _cache.load(CHAT_MEMBERS_FILE, None)
+            if saved is None:
+                saved = {}
+                for (user_id, chat_id), _ in store.items():
+                    saved.setdefault(str(chat_id), []).append(user_id)
+                _cache.save(CHAT_MEMBERS_FILE, saved)
+            users = _cache.load(USERS_FILE, {})
+            members = ChatMembers()
+            members.rebuild({int(chat_id): user_ids for chat_id, user_ids in saved.items()},
+                            {int(uid): user.get("balance", 0) for uid, user in users.items()})
+            add_user_listener(lambda user_id, user: members.update_balance(user_id, user.get("balance", 0)))
+            _chat_members = members
+        return _chat_members
+
+def _chat_members_reloaded(old: Optional[Dict[str, List[int]]], new: Dict[str, List[int]]):
+    if _chat_members is None:
+        return
+    for chat_id, user_ids in (new or {}).items():
+        for user_id in user_ids:
+            _chat_members.add(int(chat_id), user_id)
+
+_cache.add_reload_listener(CHAT_MEMBERS_FILE, _chat_members_reloaded)
+
+def add_chat_member(chat_id: int, user_id: int):
+    """Отметить игрока участником чата (спин или покупка из чата)"""
+    members = _get_chat_members()
+    with LOCK:
+        if not members.add(chat_id, user_id):
+            return
+        data = _cache.load(CHAT_MEMBERS_FILE, {})
+        data.setdefault(str(chat_id), []).append(user_id)
+        _cache.save(CHAT_MEMBERS_FILE, data)
+        update_chat(chat_id, {"members_count": members.count(chat_id)})
+
+def get_chat_member_count(chat_id: int) -> int:
+    """Число игроков, игравших или покупавших из чата"""
+    return _get_chat_members().count(chat_id)
 
 def get_player_ngr(user_id: int, chat_id: int) -> dict:
     """Получить NGR данные игрока в чате"""
-    key = f"{user_id}_{chat_id}"
-    data = _cache.load(PLAYER_NGR_FILE, {})
-    return data.get(key, {
+    values = _get_ngr_store().get(user_id, chat_id) or (0.0, 0.0, 0.0)
+    return {
         "user_id": user_id,
         "chat_id": chat_id,
-        "total_wagered": 0.0,  # Все ставки
-        "total_won": 0.0,      # Все выигрыши
-        "paid_ngr": 0.0        # Уже выплаченный NGR партнёру
-    })
+        "total_wagered": values[0],  # Все ставки
+        "total_won": values[1],      # Все выигрыши
+        "paid_ngr": values[2]        # Уже выплаченный NGR партнёру
+    }
 
 
 def update_player_ngr_and_calc_commission(user_id: int, chat_id: int, bet: float, win: float, owner_id: int) -> float:
@@ -1853,29 +2551,21 @@ def update_player_ngr_and_calc_commission(user_id: int, chat_id: int, bet: float
     
     Если игрок в плюсе (NGR < 0) или NGR не вырос - комиссия 0.
     """
-    key = f"{user_id}_{chat_id}"
+    store = _get_ngr_store()
     
     with LOCK:
-        data = _cache.load(PLAYER_NGR_FILE, {})
-        
-        player = data.get(key, {
-            "user_id": user_id,
-            "chat_id": chat_id,
-            "total_wagered": 0.0,
-            "total_won": 0.0,
-            "paid_ngr": 0.0
-        })
+        total_wagered, total_won, paid_ngr = store.get(user_id, chat_id) or (0.0, 0.0, 0.0)
         
         # Обновляем статистику
-        player["total_wagered"] = player.get("total_wagered", 0) + bet
-        player["total_won"] = player.get("total_won", 0) + win
+        total_wagered += bet
+        total_won += win
         
         # Рассчитываем текущий NGR
-        current_ngr = player["total_wagered"] - player["total_won"]
-        paid_ngr = player.get("paid_ngr", 0)
+        current_ngr = total_wagered - total_won
         
         # Комиссия только если NGR вырос (игрок проиграл больше)
         commission = 0.0
+        new_paid_ngr = paid_ngr
         if current_ngr > paid_ngr:
             new_loss = current_ngr - paid_ngr
             
@@ -1886,10 +2576,11 @@ def update_player_ngr_and_calc_commission(user_id: int, chat_id: int, bet: float
             commission = new_loss * (commission_percent / 100)
             
             # Обновляем paid_ngr
-            player["paid_ngr"] = current_ngr
+            new_paid_ngr = current_ngr
         
-        data[key] = player
-        _cache.save(PLAYER_NGR_FILE, data)
+        store.put(user_id, chat_id, total_wagered, total_won, new_paid_ngr)
+        if _chat_leaderboards is not None:
+            _chat_leaderboards.set_total(chat_id, user_id, total_wagered)
         
         logger.debug(f"NGR update: user={user_id}, chat={chat_id}, bet={bet}, win={win}, "
                     f"ngr={current_ngr:.4f}, paid={paid_ngr:.4f}, commission={commission:.6f}")
@@ -1920,6 +2611,7 @@ def update_chat_volume_ngr(chat_id: int, bet: float, win: float):
             new_volume = max(0, current_volume + net_loss)  # Не уходим в минус
             chats[chat_id_str]["total_volume"] = new_volume
             _cache.save(CHATS_FILE, chats)
+            _chat_changed(chat_id_str, chats[chat_id_str])
             logger.debug(f"Chat volume updated: chat={chat_id}, bet={bet}, win={win}, net={net_loss}, volume={new_volume}")
 
 
@@ -1970,86 +2662,35 @@ def record_partner_withdrawal_to_balance(owner_id: int, amount: float) -> bool:
 
 
 def get_chat_top_by_volume(chat_id: int, period: str, limit: int = 10) -> list:
-    """Топ игроков чата по объёму ставок за период"""
-    import datetime
-    
+    """Топ игроков чата по объёму ставок за период (day, week, month, all)"""
+    boards = _get_chat_leaderboards()
     with LOCK:
-        spins = _cache.load(SPINS_FILE, [])
-        ngr_data = _cache.load(PLAYER_NGR_FILE, {})
+        top = boards.top(chat_id, period, limit)
         users_data = _cache.load(USERS_FILE, {})
-    
-    volumes = {}
-    
-    # Для "all time" используем player_ngr (там полные данные)
-    if period == "all":
-        for key, data in ngr_data.items():
-            if data.get("chat_id") == chat_id:
-                uid = data.get("user_id")
-                volumes[uid] = data.get("total_wagered", 0)
-    else:
-        # Для периодов используем только spins с chat_id
-        now = datetime.datetime.now()
-        if period == "day":
-            start_time = now.replace(hour=0, minute=0, second=0, microsecond=0).timestamp()
-        elif period == "week":
-            start_time = (now - datetime.timedelta(days=now.weekday())).replace(hour=0, minute=0, second=0, microsecond=0).timestamp()
-        elif period == "month":
-            start_time = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0).timestamp()
-        else:
-            start_time = 0
-        
-        for spin in spins:
-            spin_chat = spin.get("chat_id")
-            if spin_chat != chat_id:
-                continue
-            if spin.get("timestamp", 0) < start_time:
-                continue
-            
-            uid = spin.get("user_id")
-            bet = spin.get("bet", 0)
-            volumes[uid] = volumes.get(uid, 0) + bet
-    
-    # Сортируем и формируем топ
-    sorted_users = sorted(volumes.items(), key=lambda x: x[1], reverse=True)[:limit]
-    
-    result = []
-    for uid, volume in sorted_users:
-        user_info = users_data.get(str(uid), {})
-        result.append({
-            "user_id": uid,
-            "username": user_info.get("username", "Unknown"),
-            "volume": volume
-        })
-    
-    return result
+        return [
+            {
+                "user_id": uid,
+                "username": users_data.get(str(uid), {}).get("username", "Unknown"),
+                "volume": volume
+            }
+            for uid, volume in top
+        ]
 
 
 def get_chat_top_by_balance(chat_id: int, limit: int = 10) -> list:
     """Топ игроков по балансу среди участников чата"""
+    members = _get_chat_members()
     with LOCK:
-        ngr_data = _cache.load(PLAYER_NGR_FILE, {})
+        top = members.top(chat_id, limit)
         users_data = _cache.load(USERS_FILE, {})
-    
-    # Собираем user_id которые играли в этом чате (из player_ngr)
-    chat_users = set()
-    for key, data in ngr_data.items():
-        if data.get("chat_id") == chat_id:
-            chat_users.add(data.get("user_id"))
-    
-    # Получаем балансы только этих пользователей
-    users_with_balance = []
-    for uid in chat_users:
-        user_info = users_data.get(str(uid), {})
-        balance = user_info.get("balance", 0)
-        users_with_balance.append({
-            "user_id": uid,
-            "username": user_info.get("username", "Unknown"),
-            "balance": balance
-        })
-    
-    # Сортируем
-    sorted_users = sorted(users_with_balance, key=lambda x: x["balance"], reverse=True)[:limit]
-    return sorted_users
+        return [
+            {
+                "user_id": uid,
+                "username": users_data.get(str(uid), {}).get("username", "Unknown"),
+                "balance": balance
+            }
+            for uid, balance in top
+        ]
 
 
 # ==================== ДЕМО СЧЁТ ====================
@@ -2211,3 +2852,139 @@ def withdraw_task_stars(user_id: int, amount: int) -> bool:
     data[uid]["stars"] = current - amount
     _save_tasks(data)
     return True
+
+
+# === РАССЫЛКИ ===
+BROADCASTS_FILE = os.path.join(DATA_DIR, "broadcasts.json")
+BROADCAST_AUDIENCE_DIR = os.path.join(DATA_DIR, "broadcasts")
+BROADCAST_LEASE = 120  # секунд без heartbeat, после которых задание забирает другой воркер
+
+def create_broadcast_job(text: str, user_ids: List[int], photo_url: str = None,
+                         buttons: list = None) -> dict:
+    """Создать задание рассылки; аудитория сохраняется отдельным файлом"""
+    job_id = f"bc_{int(time.time())}_{os.urandom(3).hex()}"
+
+    os.makedirs(BROADCAST_AUDIENCE_DIR, exist_ok=True)
+    audience_file = os.path.join(BROADCAST_AUDIENCE_DIR, f"{job_id}.json")
+    with open(audience_file + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(user_ids, f, separators=(",", ":"))
+    os.replace(audience_file + '.tmp', audience_file)
+
+    job = {
+        "id": job_id,
+        "status": "queued",  # queued, running, completed, cancelled, failed
+        "text": text,
+        "photo_url": photo_url,
+        "buttons": buttons or [],
+        "total": len(user_ids),
+        "cursor": 0,
+        "sent": 0,
+        "failed": 0,
+        "blocked": 0,
+        "error": None,
+        "created_at": time.time(),
+        "started_at": None,
+        "finished_at": None,
+        "updated_at": time.time()
+    }
+    # Под блокировкой файла, как захват и прогресс заданий воркером
+    with LOCK:
+        _cache.update(BROADCASTS_FILE, {}, lambda jobs: jobs.__setitem__(job_id, job))
+    logger.info(f"Broadcast job created: {job_id}, audience={len(user_ids)}")
+    return dict(job)
+
+def get_broadcast_job(job_id: str) -> Optional[dict]:
+    """Получить задание рассылки по ID"""
+    job = _cache.load(BROADCASTS_FILE, {}).get(job_id)
+    return dict(job) if job else None
+
+def get_broadcast_jobs(status: str = None, limit: int = 50) -> List[dict]:
+    """Задания рассылки, новые первыми"""
+    jobs = list(_cache.load(BROADCASTS_FILE, {}).values())
+    if status:
+        jobs = [j for j in jobs if j.get("status") == status]
+    jobs.sort(key=lambda j: j.get("created_at", 0), reverse=True)
+    return [dict(j) for j in jobs[:limit]]
+
+def update_broadcast_job(job_id: str, data: Dict[str, Any]) -> bool:
+    """Обновить поля задания (прогресс, статус)"""
+    def update(jobs):
+        if job_id not in jobs:
+            return False
+        jobs[job_id].update(data)
+        jobs[job_id]["updated_at"] = time.time()
+        return True
+
+    with LOCK:
+        return _cache.update(BROADCASTS_FILE, {}, update)
+
+def claim_broadcast_job(job_id: str, owner: str, lease: float = BROADCAST_LEASE) -> Optional[dict]:
+    """Захватить активное задание для воркера owner.
+
+    Задание принадлежит одному воркеру: его owner и heartbeat хранятся в
+    записи. Чужое задание можно забрать, только если heartbeat старше lease
+    секунд (воркер упал). None - задание неактивно или занято.
+    """
+    def claim(jobs):
+        job = jobs.get(job_id)
+        if not job or job.get("status") not in ("queued", "running"):
+            return None
+        now = time.time()
+        if job.get("owner") not in (None, owner) and now - (job.get("heartbeat") or 0) < lease:
+            return None
+        if job.get("cancel_requested"):
+            job.update({"status": "cancelled", "owner": None, "updated_at": now})
+            return None
+        job.update({
+            "status": "running",
+            "owner": owner,
+            "heartbeat": now,
+            "started_at": job.get("started_at") or now,
+            "updated_at": now,
+        })
+        return dict(job)
+
+    with LOCK:
+        return _cache.update(BROADCASTS_FILE, {}, claim)
+
+def checkpoint_broadcast_job(job_id: str, owner: str, data: Dict[str, Any]) -> Optional[dict]:
+    """Сохранить прогресс задания и продлить аренду.
+
+    Возвращает актуальное задание (с cancel_requested, выставленным
+    админкой) или None, если задание перешло к другому воркеру.
+    """
+    def checkpoint(jobs):
+        job = jobs.get(job_id)
+        if not job or job.get("owner") != owner:
+            return None
+        job.update(data)
+        job["heartbeat"] = job["updated_at"] = time.time()
+        return dict(job)
+
+    with LOCK:
+        return _cache.update(BROADCASTS_FILE, {}, checkpoint)
+
+def cancel_broadcast_job(job_id: str) -> bool:
+    """Отменить задание: ожидающее - сразу, выполняемое - флагом для воркера"""
+    def cancel(jobs):
+        job = jobs.get(job_id)
+        if not job or job.get("status") not in ("queued", "running"):
+            return False
+        if job["status"] == "queued":
+            job["status"] = "cancelled"
+        else:
+            job["cancel_requested"] = True
+        job["updated_at"] = time.time()
+        return True
+
+    with LOCK:
+        return _cache.update(BROADCASTS_FILE, {}, cancel)
+
+def get_broadcast_audience(job_id: str) -> List[int]:
+    """Список получателей задания"""
+    audience_file = os.path.join(BROADCAST_AUDIENCE_DIR, f"{job_id}.json")
+    try:
+        with open(audience_file, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return []
@@ -0,0 +1,95 @@
+"""
+fsm_storage.py - Хранилище FSM aiogram на диске с ограниченным кэшем
+
+Состояние и данные пользователя лежат одной записью в KVStore и истекают,
+если флоу не трогали дольше ttl. В памяти держится LRU последних ключей.
+"""
+
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+from kv_store import KVStore
+
+
+FSM_NAMESPACE = "fsm"
+
+# (state, data, expires_at)
+_Record = Tuple[Optional[str], Dict[str, Any], float]
+
+
+class KVStorage(BaseStorage):
+    """FSM-хранилище поверх KVStore с LRU-кэшем и TTL простоя"""
+
+    def __init__(self, store: KVStore, ttl: float = 1800.0, cache_size: int = 10000):
+        self._store = store
+        self._ttl = ttl
+        self._cache_size = cache_size
+        self._cache: "OrderedDict[str, _Record]" = OrderedDict()
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        thread = key.thread_id if key.thread_id is not None else ""
+        return f"{key.bot_id}:{key.chat_id}:{key.user_id}:{thread}:{key.destiny}"
+
+    def _remember(self, skey: str, record: _Record):
+        self._cache[skey] = record
+        self._cache.move_to_end(skey)
+        while len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+
+    def _load(self, skey: str) -> _Record:
+        record = self._cache.get(skey)
+        if record is None:
+            raw = self._store.get(FSM_NAMESPACE, skey)
+            if raw:
+                record = (raw.get("s"), raw.get("d") or {}, raw.get("e", 0.0))
+            else:
+                record = (None, {}, 0.0)
+            self._remember(skey, record)
+        else:
+            self._cache.move_to_end(skey)
+
+        state, data, expires = record
+        if (state is not None or data) and expires <= time.time():
+            # Флоу заброшен дольше ttl
+            record = (None, {}, 0.0)
+            self._remember(skey, record)
+        return record
+
+    def _save(self, skey: str, state: Optional[str], data: Dict[str, Any]):
+        if state is None and not data:
+            self._remember(skey, (None, {}, 0.0))
+            self._store.delete(FSM_NAMESPACE, skey)
+            return
+
+        expires = time.time() + self._ttl
+        self._remember(skey, (state, data, expires))
+        raw: Dict[str, Any] = {"e": round(expires, 1)}
+        if state is not None:
+            raw["s"] = state
+        if data:
+            raw["d"] = data
+        self._store.set(FSM_NAMESPACE, skey, raw, expires)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        skey = self._key(key)
+        _, data, _ = self._load(skey)
+        self._save(skey, state.state if isinstance(state, State) else state, data)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return self._load(self._key(key))[0]
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        skey = self._key(key)
+        state, _, _ = self._load(skey)
+        self._save(skey, state, data.copy())
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return self._load(self._key(key))[1].copy()
+
+    async def close(self) -> None:
+        self._cache.clear()
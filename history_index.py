@@ -0,0 +1,131 @@
+"""
+history_index.py - Упорядоченные по времени индексы журналов истории
+
+Журналы (депозиты, покупки, спины) хранятся списками в порядке записи.
+Индекс держит отсортированные ключи (timestamp, user_id) и ссылки на
+записи, поэтому страница по курсору - это bisect и срез размером с
+страницу, независимо от длины истории.
+"""
+
+import bisect
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+Key = Tuple[float, int]
+
+
+def record_key(record: Dict[str, Any]) -> Key:
+    return (float(record.get("timestamp") or 0), int(record.get("user_id") or 0))
+
+
+def parse_cursor(cursor: Optional[str]) -> Optional[Key]:
+    """Курсор "timestamp:user_id"; ValueError при неверном формате"""
+    if not cursor:
+        return None
+    ts, uid = cursor.split(":", 1)
+    return (float(ts), int(uid))
+
+
+def format_cursor(key: Optional[Key]) -> Optional[str]:
+    if key is None:
+        return None
+    return f"{key[0]!r}:{key[1]}"
+
+
+class HistoryIndex:
+    """Индекс одного журнала; синхронизируется со списком перед чтением"""
+
+    def __init__(self):
+        # Проиндексированные записи в порядке журнала
+        self._order: Deque[Dict[str, Any]] = deque()
+        self._keys: List[Key] = []
+        self._records: List[Dict[str, Any]] = []
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def sync(self, records: List[Dict[str, Any]]):
+        """Учесть изменения журнала.
+
+        Журнал дописывается в конец и ротируется с начала, а перечитанный с
+        диска список - новый объект с равными записями. Поэтому индекс
+        сверяет границы: ушедшие из начала записи удаляет, новый хвост
+        добавляет. Строится заново, только если список с индексом не
+        совпадает (очистка, слияние записей двух процессов).
+        """
+        dropped = self._dropped(records)
+        if dropped is None:
+            self._rebuild(records)
+            return
+
+        for _ in range(dropped):
+            self._remove(self._order.popleft())
+        for record in records[len(self._order):]:
+            self._order.append(record)
+            self._insert(record)
+
+    def _dropped(self, records: List[Dict[str, Any]]) -> Optional[int]:
+        """Сколько записей ушло из начала журнала; None - records не продолжает индекс"""
+        order = self._order
+        if not order:
+            return 0
+        if not records:
+            return None
+        for dropped, record in enumerate(order):
+            if record is records[0] or record == records[0]:
+                break
+        else:
+            return None
+        last = len(order) - 1 - dropped
+        if last >= len(records) or not (order[-1] is records[last] or order[-1] == records[last]):
+            return None
+        return dropped
+
+    def _rebuild(self, records: List[Dict[str, Any]]):
+        pairs = sorted(((record_key(r), i) for i, r in enumerate(records)))
+        self._keys = [key for key, _ in pairs]
+        self._records = [records[i] for _, i in pairs]
+        self._order = deque(records)
+
+    def _insert(self, record: Dict[str, Any]):
+        key = record_key(record)
+        if not self._keys or key >= self._keys[-1]:
+            self._keys.append(key)
+            self._records.append(record)
+        else:
+            pos = bisect.bisect_right(self._keys, key)
+            self._keys.insert(pos, key)
+            self._records.insert(pos, record)
+
+    def _remove(self, record: Dict[str, Any]):
+        key = record_key(record)
+        pos = bisect.bisect_left(self._keys, key)
+        while pos < len(self._keys) and self._keys[pos] == key:
+            if self._records[pos] is record:
+                del self._keys[pos]
+                del self._records[pos]
+                return
+            pos += 1
+
+    def page(self, before: Optional[Key] = None, after: Optional[Key] = None,
+             limit: int = 50) -> Dict[str, Any]:
+        """Страница от новых к старым.
+
+        before - записи строго старше курсора (листание назад),
+        after - строго новее (возврат к свежим). Без курсоров - самые новые.
+        В ответе курсоры before/after для соседних страниц (None - дальше пусто).
+        """
+        if after is not None:
+            start = bisect.bisect_right(self._keys, after)
+            end = min(start + limit, len(self._keys))
+        else:
+            end = bisect.bisect_left(self._keys, before) if before is not None else len(self._keys)
+            start = max(end - limit, 0)
+
+        items = self._records[start:end]
+        items.reverse()
+        return {
+            "items": items,
+            "before": format_cursor(self._keys[start]) if start > 0 else None,
+            "after": format_cursor(self._keys[end - 1]) if end < len(self._keys) and end > start else None,
+        }
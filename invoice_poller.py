@@ -0,0 +1,301 @@
+"""
+invoice_poller.py - Единый опрос статусов счетов xRocket и CryptoPay
+
+Вместо отдельной задачи на каждый счёт открытые счета лежат в очереди
+с приоритетом по времени следующей проверки. На каждом такте делается
+один списочный запрос на провайдера, старые счета проверяются реже.
+"""
+
+import asyncio
+import heapq
+import time
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, List, MutableMapping, Optional, Tuple
+
+import aiohttp
+from loguru import logger
+
+
+CRYPTOPAY_API = "https://pay.crypt.bot/api"
+CRYPTOPAY_TESTNET_API = "https://testnet-pay.crypt.bot/api"
+XROCKET_API = "https://pay.xrocket.tg"
+
+PAID_STATUSES = {"paid", "success", "completed"}
+EXPIRED_STATUSES = {"expired", "cancelled", "canceled"}
+
+# Возраст счёта (сек) -> интервал проверки (сек)
+BACKOFF_STEPS = ((120, 5.0), (600, 15.0), (float("inf"), 60.0))
+
+StatusFetcher = Callable[[List[str]], Awaitable[Dict[str, str]]]
+InvoiceCallback = Callable[["OpenInvoice"], Awaitable[None]]
+
+_http: Optional[aiohttp.ClientSession] = None
+
+
+def _get_http() -> aiohttp.ClientSession:
+    global _http
+    if _http is None or _http.closed:
+        _http = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=15))
+    return _http
+
+
+async def close_http():
+    global _http
+    if _http is not None and not _http.closed:
+        await _http.close()
+    _http = None
+
+
+def cryptopay_fetcher(token: str, testnet: bool = False, batch_size: int = 100) -> StatusFetcher:
+    """Статусы счетов CryptoPay одним запросом getInvoices на пачку id"""
+    base = CRYPTOPAY_TESTNET_API if testnet else CRYPTOPAY_API
+
+    async def fetch(invoice_ids: List[str]) -> Dict[str, str]:
+        statuses: Dict[str, str] = {}
+        for i in range(0, len(invoice_ids), batch_size):
+            chunk = invoice_ids[i:i + batch_size]
+            async with _get_http().get(
+                f"{base}/getInvoices",
+                params={"invoice_ids": ",".join(chunk), "count": len(chunk)},
+                headers={"Crypto-Pay-API-Token": token},
+            ) as resp:
+                data = await resp.json(content_type=None)
+            if not data.get("ok"):
+                raise RuntimeError(f"CryptoPay getInvoices error: {data.get('error')}")
+            for item in data.get("result", {}).get("items", []):
+                statuses[str(item.get("invoice_id"))] = str(item.get("status", "")).lower()
+        return statuses
+
+    return fetch
+
+
+def xrocket_fetcher(api_key: str, page_size: int = 1000, max_pages: int = 5) -> StatusFetcher:
+    """Статусы счетов xRocket из списка tg-invoices (по странице за запрос).
+
+    Счета, не попавшие в первые max_pages страниц, запрашиваются по одному.
+    """
+
+    async def fetch(invoice_ids: List[str]) -> Dict[str, str]:
+        wanted = set(invoice_ids)
+        statuses: Dict[str, str] = {}
+        for page in range(max_pages):
+            async with _get_http().get(
+                f"{XROCKET_API}/tg-invoices",
+                params={"limit": page_size, "offset": page * page_size},
+                headers={"Rocket-Pay-Key": api_key, "accept": "application/json"},
+            ) as resp:
+                data = await resp.json(content_type=None)
+            if not data.get("success", True):
+                raise RuntimeError(f"xRocket tg-invoices error: {data.get('message')}")
+            results = (data.get("data") or {}).get("results", [])
+            for item in results:
+                inv_id = str(item.get("id"))
+                if inv_id in wanted:
+                    statuses[inv_id] = str(item.get("status", "")).lower()
+            if len(statuses) == len(wanted) or len(results) < page_size:
+                break
+
+        for inv_id in wanted - statuses.keys():
+            async with _get_http().get(
+                f"{XROCKET_API}/tg-invoices/{inv_id}",
+                headers={"Rocket-Pay-Key": api_key, "accept": "application/json"},
+            ) as resp:
+                if resp.status == 404:
+                    # Провайдер счёт не знает - оплачен он уже не будет
+                    statuses[inv_id] = "expired"
+                    continue
+                data = await resp.json(content_type=None)
+            if data.get("success", True) and data.get("data"):
+                statuses[inv_id] = str(data["data"].get("status", "")).lower()
+        return statuses
+
+    return fetch
+
+
+@dataclass
+class OpenInvoice:
+    provider: str
+    invoice_id: str
+    user_id: int
+    created_at: float
+    expires_at: float
+    data: dict
+    on_paid: InvoiceCallback
+    on_expired: Optional[InvoiceCallback] = None
+    future: asyncio.Future = field(default=None, repr=False)
+
+
+class InvoicePoller:
+    """Планировщик проверки открытых счетов"""
+
+    def __init__(self, tick: float = 5.0, ttl: float = 1800.0, backoff_scale: float = 1.0,
+                 persist: Optional[MutableMapping] = None, expire_grace: float = 600.0):
+        self._tick = tick
+        self._ttl = ttl
+        # Сколько ждать статуса провайдера после expires_at, прежде чем закрыть счёт
+        self._expire_grace = expire_grace
+        # >1, когда основной путь подтверждения - вебхуки, а опрос лишь резервный
+        self._backoff_scale = backoff_scale
+        # "provider:invoice_id" -> [user_id, created_at, expires_at, data], переживает перезапуск
+        self._persist = persist
+        self._providers: Dict[str, StatusFetcher] = {}
+        self._open: Dict[Tuple[str, str], OpenInvoice] = {}
+        # (next_check, provider, invoice_id)
+        self._heap: List[Tuple[float, str, str]] = []
+        self._task: Optional[asyncio.Task] = None
+
+    def register_provider(self, name: str, fetch: StatusFetcher):
+        self._providers[name] = fetch
+
+    def __len__(self) -> int:
+        return len(self._open)
+
+    def add(self, provider: str, invoice_id, user_id: int, on_paid: InvoiceCallback,
+            on_expired: Optional[InvoiceCallback] = None, ttl: Optional[float] = None,
+            **data) -> asyncio.Future:
+        """Поставить счёт на отслеживание; future завершится статусом paid/expired"""
+        now = time.time()
+        invoice = self._track(provider, str(invoice_id), user_id, now, now + (ttl or self._ttl),
+                              data, on_paid, on_expired)
+        if self._persist is not None:
+            self._persist[f"{provider}:{invoice.invoice_id}"] = [user_id, now, invoice.expires_at, data]
+        logger.info(f"Tracking {provider} invoice {invoice.invoice_id} for user {user_id}")
+        return invoice.future
+
+    def _track(self, provider: str, invoice_id: str, user_id: int, created_at: float, expires_at: float,
+               data: dict, on_paid: InvoiceCallback, on_expired: Optional[InvoiceCallback]) -> OpenInvoice:
+        invoice = OpenInvoice(
+            provider=provider,
+            invoice_id=invoice_id,
+            user_id=user_id,
+            created_at=created_at,
+            expires_at=expires_at,
+            data=data,
+            on_paid=on_paid,
+            on_expired=on_expired,
+            future=asyncio.get_running_loop().create_future(),
+        )
+        self._open[(provider, invoice_id)] = invoice
+        heapq.heappush(self._heap, (time.time() + self._delay(time.time() - created_at), provider, invoice_id))
+        return invoice
+
+    def restore(self, provider: str, on_paid: InvoiceCallback, on_expired: Optional[InvoiceCallback] = None) -> int:
+        """Вернуть на отслеживание сохранённые счета провайдера после перезапуска"""
+        if self._persist is None:
+            return 0
+        restored = 0
+        for key, (user_id, created_at, expires_at, data) in list(self._persist.items()):
+            name, _, invoice_id = key.partition(":")
+            if name != provider or (provider, invoice_id) in self._open:
+                continue
+            self._track(provider, invoice_id, user_id, created_at, expires_at, data, on_paid, on_expired)
+            restored += 1
+        if restored:
+            logger.info(f"Restored {restored} open {provider} invoices")
+        return restored
+
+    def get(self, provider: str, invoice_id) -> Optional[OpenInvoice]:
+        return self._open.get((provider, str(invoice_id)))
+
+    def _delay(self, age: float) -> float:
+        for max_age, delay in BACKOFF_STEPS:
+            if age < max_age:
+                return delay * self._backoff_scale
+        return BACKOFF_STEPS[-1][1] * self._backoff_scale
+
+    async def resolve(self, provider: str, invoice_id, status: str, notify: bool = True) -> bool:
+        """Завершить счёт (из опроса, ручной проверки или вебхука).
+
+        Ошибка колбэка оплаты пробрасывается, а счёт остаётся на отслеживании:
+        зачисление повторится на следующей проверке, вебхук ответит 5xx.
+        """
+        key = (provider, str(invoice_id))
+        invoice = self._open.get(key)
+        if invoice is None:
+            return False
+
+        callback = invoice.on_paid if status == "paid" else invoice.on_expired
+        if callback and notify:
+            try:
+                await callback(invoice)
+            except Exception as e:
+                logger.error(f"{provider} invoice {invoice.invoice_id} {status} callback error: {e}")
+                if status == "paid":
+                    now = time.time()
+                    heapq.heappush(self._heap, (now + self._delay(now - invoice.created_at),
+                                                provider, invoice.invoice_id))
+                    raise
+
+        # Параллельный resolve того же счёта мог уже завершить его
+        if self._open.pop(key, None) is not None and self._persist is not None:
+            self._persist.pop(f"{provider}:{invoice.invoice_id}", None)
+        if not invoice.future.done():
+            invoice.future.set_result(status)
+        return True
+
+    def _pop_due(self, now: float) -> Dict[str, List[OpenInvoice]]:
+        due: Dict[str, List[OpenInvoice]] = {}
+        seen = set()
+        while self._heap and self._heap[0][0] <= now:
+            _, provider, invoice_id = heapq.heappop(self._heap)
+            invoice = self._open.get((provider, invoice_id))
+            # Завершённые счета остаются в куче до своей очереди и пропускаются здесь
+            if invoice is not None and (provider, invoice_id) not in seen:
+                seen.add((provider, invoice_id))
+                due.setdefault(provider, []).append(invoice)
+        return due
+
+    async def tick(self):
+        """Один проход: по одному списочному запросу на провайдера"""
+        now = time.time()
+        due = self._pop_due(now)
+
+        for provider, invoices in due.items():
+            statuses: Dict[str, str] = {}
+            fetch = self._providers.get(provider)
+            if fetch is None:
+                logger.error(f"No status fetcher registered for provider {provider}")
+            else:
+                try:
+                    statuses = await fetch([inv.invoice_id for inv in invoices])
+                except Exception as e:
+                    logger.warning(f"{provider} batch status check failed ({len(invoices)} invoices): {e}")
+
+            for inv in invoices:
+                status = statuses.get(inv.invoice_id, "")
+                if status in PAID_STATUSES:
+                    try:
+                        await self.resolve(provider, inv.invoice_id, "paid")
+                    except Exception:
+                        # Счёт снова в очереди, остальные проверяем дальше
+                        pass
+                elif status in EXPIRED_STATUSES:
+                    await self.resolve(provider, inv.invoice_id, "expired")
+                elif now >= inv.expires_at + self._expire_grace:
+                    # Провайдер так и не подтвердил истечение (ошибки запроса, статус
+                    # active) - закрываем, чтобы счёт не опрашивался вечно
+                    logger.warning(f"{provider} invoice {inv.invoice_id} force-expired, "
+                                   f"last status {status or 'unknown'}")
+                    await self.resolve(provider, inv.invoice_id, "expired")
+                else:
+                    # До конца отсрочки без статуса провайдера счёт проверяется дальше
+                    next_check = now + self._delay(now - inv.created_at)
+                    heapq.heappush(self._heap, (next_check, provider, inv.invoice_id))
+
+    async def _loop(self):
+        while True:
+            try:
+                await self.tick()
+            except Exception as e:
+                logger.error(f"Invoice poller error: {e}")
+            await asyncio.sleep(self._tick)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        await close_http()
@@ -0,0 +1,199 @@
+"""
+kv_store.py - Компактное хранилище состояния бота на диске (sqlite)
+
+Используется для данных, которые должны переживать перезапуск:
+ожидающие платежи, идемпотентность покупок, открытые счета.
+Значения хранятся компактным JSON, у каждой записи может быть срок жизни.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, List, MutableMapping, MutableSet, Optional, Tuple
+
+from loguru import logger
+
+
+def _dumps(value: Any) -> str:
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+
+
+class KVStore:
+    """Пространства имён ключ-значение с TTL поверх sqlite"""
+
+    def __init__(self, path: str):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS kv ("
+            " ns TEXT NOT NULL,"
+            " key TEXT NOT NULL,"
+            " value TEXT NOT NULL,"
+            " expires REAL,"
+            " PRIMARY KEY (ns, key)"
+            ") WITHOUT ROWID"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS kv_expires ON kv (expires) WHERE expires IS NOT NULL")
+
+    def get(self, ns: str, key: str, default: Any = None) -> Any:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, expires FROM kv WHERE ns = ? AND key = ?", (ns, key)
+            ).fetchone()
+        if row is None or (row[1] is not None and row[1] <= time.time()):
+            return default
+        return json.loads(row[0])
+
+    def set(self, ns: str, key: str, value: Any, expires: Optional[float] = None):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO kv (ns, key, value, expires) VALUES (?, ?, ?, ?)",
+                (ns, key, _dumps(value), expires)
+            )
+
+    def delete(self, ns: str, key: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM kv WHERE ns = ? AND key = ?", (ns, key))
+
+    def items(self, ns: str) -> List[Tuple[str, Any, Optional[float]]]:
+        """Живые записи пространства имён: (key, value, expires)"""
+        now = time.time()
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT key, value, expires FROM kv WHERE ns = ? AND (expires IS NULL OR expires > ?)",
+                (ns, now)
+            ).fetchall()
+        return [(key, json.loads(value), expires) for key, value, expires in rows]
+
+    def clear(self, ns: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM kv WHERE ns = ?", (ns,))
+
+    def purge_expired(self) -> int:
+        """Удалить просроченные записи во всех пространствах имён"""
+        with self._lock:
+            cur = self._conn.execute(
+                "DELETE FROM kv WHERE expires IS NOT NULL AND expires <= ?", (time.time(),)
+            )
+        if cur.rowcount:
+            logger.debug(f"KV store: purged {cur.rowcount} expired entries")
+        return cur.rowcount
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class PersistentDict(MutableMapping):
+    """dict с записью на диск; загружается из хранилища при первом обращении"""
+
+    def __init__(self, store: KVStore, ns: str, ttl: Optional[float] = None,
+                 key_type: Callable[[str], Any] = str):
+        self._store = store
+        self._ns = ns
+        self._ttl = ttl
+        self._key_type = key_type
+        self._data: Optional[Dict[Any, Any]] = None
+        self._expires: Dict[Any, float] = {}
+
+    def _loaded(self) -> Dict[Any, Any]:
+        if self._data is None:
+            self._data = {}
+            for key, value, expires in self._store.items(self._ns):
+                k = self._key_type(key)
+                self._data[k] = value
+                if expires is not None:
+                    self._expires[k] = expires
+            logger.debug(f"Loaded {len(self._data)} entries from {self._ns}")
+        return self._data
+
+    def _alive(self, key) -> bool:
+        expires = self._expires.get(key)
+        if expires is not None and expires <= time.time():
+            self._loaded().pop(key, None)
+            self._expires.pop(key, None)
+            return False
+        return True
+
+    def __getitem__(self, key):
+        data = self._loaded()
+        if key not in data or not self._alive(key):
+            raise KeyError(key)
+        return data[key]
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def set(self, key, value, ttl: Optional[float] = None):
+        """Записать значение; ttl по умолчанию задан при создании"""
+        ttl = ttl if ttl is not None else self._ttl
+        expires = time.time() + ttl if ttl else None
+        self._loaded()[key] = value
+        if expires is None:
+            self._expires.pop(key, None)
+        else:
+            self._expires[key] = expires
+        self._store.set(self._ns, str(key), value, expires)
+
+    def __delitem__(self, key):
+        data = self._loaded()
+        if key not in data:
+            raise KeyError(key)
+        del data[key]
+        self._expires.pop(key, None)
+        self._store.delete(self._ns, str(key))
+
+    def __contains__(self, key) -> bool:
+        return key in self._loaded() and self._alive(key)
+
+    def _evict_expired(self) -> Dict[Any, Any]:
+        """Убрать из памяти просроченные ключи (строки на диске удаляет purge_expired)"""
+        data = self._loaded()
+        now = time.time()
+        for key in [k for k, expires in self._expires.items() if expires <= now]:
+            data.pop(key, None)
+            del self._expires[key]
+        return data
+
+    def __iter__(self) -> Iterator:
+        return iter(list(self._evict_expired()))
+
+    def __len__(self) -> int:
+        return len(self._evict_expired())
+
+    def __repr__(self) -> str:
+        return f"PersistentDict({self._ns!r}, {len(self)} entries)"
+
+
+class PersistentSet(MutableSet):
+    """set с записью на диск, элементы живут ttl секунд"""
+
+    def __init__(self, store: KVStore, ns: str, ttl: Optional[float] = None,
+                 key_type: Callable[[str], Any] = str):
+        self._items = PersistentDict(store, ns, ttl=ttl, key_type=key_type)
+
+    def __contains__(self, item) -> bool:
+        return item in self._items
+
+    def __iter__(self) -> Iterator:
+        return iter(self._items)
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def add(self, item):
+        self._items[item] = 1
+
+    def discard(self, item):
+        if item in self._items:
+            del self._items[item]
+
+    def __repr__(self) -> str:
+        return f"PersistentSet({self._items._ns!r}, {len(self)} items)"
@@ -0,0 +1,149 @@
+"""
+live_feed.py - Шина событий БД и живая лента админ-панели
+
+db.py публикует события (депозиты, покупки, спины, выводы, блокировки) в
+EventBus. LiveFeed держит скользящие счётчики по минутным корзинам за
+сутки, а SSE-подписчики получают сами события - панели не нужно
+перезапрашивать полную статистику.
+"""
+
+import queue
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, Iterable, List, Optional, Tuple
+
+# Суммируемые поля событий для счётчиков
+SUM_FIELDS = {
+    "deposit": ("amount",),
+    "purchase": ("amount", "stars"),
+    "spin": ("bet", "win"),
+    "withdrawal": ("amount",),
+}
+
+WINDOWS = {"1h": 3600, "24h": 86400}
+
+
+class Subscription:
+    """Очередь событий одного подписчика (при переполнении старые теряются)"""
+
+    def __init__(self, bus: "EventBus", maxsize: int):
+        self._bus = bus
+        self._queue: "queue.Queue[Dict[str, Any]]" = queue.Queue(maxsize)
+        self.dropped = 0
+
+    def put(self, event: Dict[str, Any]):
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            self.dropped += 1
+
+    def get(self, timeout: float) -> Optional[Dict[str, Any]]:
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self._bus.unsubscribe(self)
+
+
+class EventBus:
+    """Шина событий процесса; publish не блокируется медленными подписчиками"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscriptions: List[Subscription] = []
+        self._handlers: List[Callable[[Dict[str, Any]], None]] = []
+
+    def publish(self, kind: str, **data):
+        event = {"type": kind, "ts": data.pop("ts", None) or time.time(), **data}
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+            handlers = list(self._handlers)
+        for handler in handlers:
+            handler(event)
+        for subscription in subscriptions:
+            subscription.put(event)
+
+    def add_handler(self, handler: Callable[[Dict[str, Any]], None]):
+        """Синхронный обработчик каждого события (быстрый, без ввода-вывода)"""
+        with self._lock:
+            self._handlers.append(handler)
+
+    def subscribe(self, maxsize: int = 1000) -> Subscription:
+        subscription = Subscription(self, maxsize)
+        with self._lock:
+            self._subscriptions.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            if subscription in self._subscriptions:
+                self._subscriptions.remove(subscription)
+
+
+class LiveFeed:
+    """Скользящие счётчики событий за час и сутки"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # kind -> корзины (минута, количество, суммы полей)
+        self._buckets: Dict[str, Deque[Tuple[int, int, Dict[str, float]]]] = {}
+
+    def seed(self, kind: str, events: Iterable[Dict[str, Any]]):
+        """Заполнить счётчики историей (события в порядке времени)"""
+        for event in events:
+            self.add({"type": kind, **event})
+
+    def attach(self, bus: EventBus):
+        """Считать события шины. Вызывается после seed: чтение истории
+        перечитывает файлы, и публикуемые при этом события уже есть в ней"""
+        bus.add_handler(self.add)
+
+    def add(self, event: Dict[str, Any]):
+        kind = event["type"]
+        minute = int(event.get("ts") or event.get("timestamp") or time.time()) // 60
+        fields = SUM_FIELDS.get(kind, ())
+        with self._lock:
+            buckets = self._buckets.setdefault(kind, deque())
+            # Обычно событие попадает в последнюю корзину; опоздавшие (из
+            # другого процесса) - в свою минуту глубже
+            i = len(buckets) - 1
+            while i >= 0 and buckets[i][0] > minute:
+                i -= 1
+            if i >= 0 and buckets[i][0] == minute:
+                _, count, sums = buckets[i]
+                buckets[i] = (minute, count + 1, sums)
+            else:
+                sums = {f: 0.0 for f in fields}
+                buckets.insert(i + 1, (minute, 1, sums))
+            for f in fields:
+                sums[f] += float(event.get(f) or 0)
+            self._trim(buckets)
+
+    @staticmethod
+    def _trim(buckets: Deque, now: Optional[float] = None):
+        oldest = int(now or time.time()) // 60 - max(WINDOWS.values()) // 60
+        while buckets and buckets[0][0] <= oldest:
+            buckets.popleft()
+
+    def counters(self) -> Dict[str, Dict[str, Dict[str, float]]]:
+        """kind -> окно -> {count, суммы полей}"""
+        now = time.time()
+        result = {}
+        with self._lock:
+            for kind, buckets in self._buckets.items():
+                self._trim(buckets, now)
+                result[kind] = {}
+                for name, seconds in WINDOWS.items():
+                    since = int(now - seconds) // 60
+                    totals = {"count": 0, **{f: 0.0 for f in SUM_FIELDS.get(kind, ())}}
+                    for minute, count, sums in reversed(buckets):
+                        if minute <= since:
+                            break
+                        totals["count"] += count
+                        for f, value in sums.items():
+                            totals[f] += value
+                    result[kind][name] = totals
+        return result
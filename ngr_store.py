@@ -0,0 +1,80 @@
+"""
+ngr_store.py - Хранилище NGR игроков в файле записей фиксированной длины
+
+Запись: user_id, chat_id, total_wagered, total_won, paid_ngr (40 байт).
+Номер записи каждого ключа (user_id, chat_id) держится в памяти, поэтому
+обновление после спина - одна запись 40 байт по смещению, а не
+перезапись всего файла. Файл ведёт только процесс бота.
+"""
+
+import os
+import struct
+import threading
+from typing import Dict, Iterator, Optional, Tuple
+
+RECORD = struct.Struct("<qqddd")
+
+Key = Tuple[int, int]
+Values = Tuple[float, float, float]  # total_wagered, total_won, paid_ngr
+
+
+class NGRStore:
+    """NGR по парам (user_id, chat_id) с записью на месте"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._slots: Dict[Key, int] = {}
+        self._values: Dict[Key, Values] = {}
+        self._file = None
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+    def open(self):
+        """Прочитать файл и держать его открытым для записи"""
+        with self._lock:
+            if self._file is not None:
+                return
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            if not os.path.exists(self.path):
+                open(self.path, "wb").close()
+            self._file = open(self.path, "r+b")
+            data = self._file.read()
+            # Недописанная последняя запись (падение при записи) отбрасывается
+            usable = len(data) - len(data) % RECORD.size
+            if usable != len(data):
+                self._file.truncate(usable)
+            for slot, (user_id, chat_id, wagered, won, paid) in enumerate(RECORD.iter_unpack(data[:usable])):
+                self._slots[(user_id, chat_id)] = slot
+                self._values[(user_id, chat_id)] = (wagered, won, paid)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def get(self, user_id: int, chat_id: int) -> Optional[Values]:
+        return self._values.get((user_id, chat_id))
+
+    def put(self, user_id: int, chat_id: int, wagered: float, won: float, paid: float, flush: bool = True):
+        """Записать значения ключа: на место его записи или в конец файла"""
+        key = (user_id, chat_id)
+        with self._lock:
+            slot = self._slots.get(key)
+            if slot is None:
+                slot = self._slots[key] = len(self._slots)
+            self._values[key] = (wagered, won, paid)
+            self._file.seek(slot * RECORD.size)
+            self._file.write(RECORD.pack(user_id, chat_id, wagered, won, paid))
+            if flush:
+                self._file.flush()
+
+    def flush(self):
+        with self._lock:
+            self._file.flush()
+
+    def items(self) -> Iterator[Tuple[Key, Values]]:
+        return iter(list(self._values.items()))
@@ -0,0 +1,156 @@
+"""
+partner_index.py - Индекс партнёров (владельцев чатов)
+
+owner_id -> чаты владельца, суммы по его чатам (объём, заработок, выводы)
+и вычисленный уровень. Уровень пересчитывается только при пересечении
+порога PARTNER_LEVELS или смене ручного уровня, поэтому расчёт комиссии за
+спин не перебирает чаты. Список партнёров по объёму поддерживается
+отсортированным и читается без группировки.
+"""
+
+import bisect
+from typing import Any, Dict, List, Tuple
+
+# Суммируемые поля чата (в этом порядке в строке индекса и в суммах владельца)
+TOTAL_FIELDS = ("total_volume", "total_earnings", "withdrawn", "spin_earnings", "purchase_earnings")
+VOLUME = 0
+
+
+class PartnerIndex:
+    """Агрегаты по владельцам, обновляемые при изменении чата"""
+
+    def __init__(self, levels: Dict[str, Dict[str, Any]]):
+        # Пороги уровней по возрастанию: (min_volume, key)
+        self._thresholds = sorted((level["min_volume"], key) for key, level in levels.items())
+        self._level_keys = set(levels)
+        self._reset()
+
+    def _reset(self):
+        # chat_id -> (owner_id, is_active, manual_level, суммы TOTAL_FIELDS)
+        self._rows: Dict[str, Tuple] = {}
+        self._owner_chats: Dict[int, List[str]] = {}
+        self._totals: Dict[int, List[float]] = {}
+        self._levels: Dict[int, Tuple[str, bool]] = {}
+        # (-объём, owner_id) - партнёры по убыванию объёма
+        self._by_volume: List[Tuple[float, int]] = []
+
+    @staticmethod
+    def _row(chat: Dict[str, Any]) -> Tuple:
+        return (
+            chat.get("owner_id"),
+            bool(chat.get("is_active", True)),
+            chat.get("manual_level") or None,
+            tuple(float(chat.get(field) or 0) for field in TOTAL_FIELDS),
+        )
+
+    def level_for_volume(self, volume: float) -> str:
+        key = self._thresholds[0][1]
+        for min_volume, level_key in self._thresholds:
+            if volume >= min_volume:
+                key = level_key
+        return key
+
+    def rebuild(self, chats: Dict[str, Dict[str, Any]]):
+        """Построить индекс по словарю chats.json"""
+        self._reset()
+        for chat_id, chat in chats.items():
+            self.update(chat_id, chat)
+
+    def update(self, chat_id: str, chat: Dict[str, Any]):
+        """Учесть изменение (или появление) чата"""
+        row = self._row(chat)
+        old = self._rows.get(chat_id)
+        if old == row:
+            return
+        self._rows[chat_id] = row
+        owner_id, _, manual, sums = row
+
+        if old is not None and old[0] != owner_id:
+            self._unlink(chat_id, old)
+            old = None
+        if old is None:
+            self._owner_chats.setdefault(owner_id, []).append(chat_id)
+            self._add(owner_id, sums)
+            self._levels.pop(owner_id, None)
+            return
+
+        old_volume = self._totals[owner_id][VOLUME]
+        self._add(owner_id, tuple(new - prev for new, prev in zip(sums, old[3])))
+        new_volume = self._totals[owner_id][VOLUME]
+        if manual != old[2] or self.level_for_volume(new_volume) != self.level_for_volume(old_volume):
+            self._levels.pop(owner_id, None)
+
+    def remove(self, chat_id: str):
+        old = self._rows.pop(chat_id, None)
+        if old is not None:
+            self._unlink(chat_id, old)
+
+    def _add(self, owner_id: int, deltas: Tuple[float, ...]):
+        """Прибавить приращения к суммам владельца, сохраняя порядок по объёму"""
+        totals = self._totals.get(owner_id)
+        if totals is None:
+            totals = self._totals[owner_id] = [0.0] * len(TOTAL_FIELDS)
+        elif deltas[VOLUME]:
+            self._unsort(owner_id, totals[VOLUME])
+        else:
+            for i, delta in enumerate(deltas):
+                totals[i] += delta
+            return
+        for i, delta in enumerate(deltas):
+            totals[i] += delta
+        bisect.insort(self._by_volume, (-totals[VOLUME], owner_id))
+
+    def _unsort(self, owner_id: int, volume: float):
+        pos = bisect.bisect_left(self._by_volume, (-volume, owner_id))
+        if pos < len(self._by_volume) and self._by_volume[pos] == (-volume, owner_id):
+            del self._by_volume[pos]
+
+    def _unlink(self, chat_id: str, old: Tuple):
+        owner_id = old[0]
+        chat_ids = self._owner_chats.get(owner_id, [])
+        if chat_id in chat_ids:
+            chat_ids.remove(chat_id)
+        if chat_ids:
+            self._add(owner_id, tuple(-value for value in old[3]))
+        else:
+            self._owner_chats.pop(owner_id, None)
+            totals = self._totals.pop(owner_id, None)
+            if totals is not None:
+                self._unsort(owner_id, totals[VOLUME])
+        self._levels.pop(owner_id, None)
+
+    def chat_ids(self, owner_id: int, active_only: bool = False) -> List[str]:
+        """ID чатов владельца в порядке регистрации"""
+        chat_ids = self._owner_chats.get(owner_id, [])
+        if active_only:
+            return [cid for cid in chat_ids if self._rows[cid][1]]
+        return list(chat_ids)
+
+    def volume(self, owner_id: int) -> float:
+        totals = self._totals.get(owner_id)
+        return max(totals[VOLUME], 0.0) if totals else 0.0
+
+    def totals(self, owner_id: int) -> Dict[str, float]:
+        """Суммы TOTAL_FIELDS по всем чатам владельца"""
+        totals = self._totals.get(owner_id) or [0.0] * len(TOTAL_FIELDS)
+        return dict(zip(TOTAL_FIELDS, totals))
+
+    def level(self, owner_id: int) -> Tuple[str, bool]:
+        """(ключ уровня, установлен ли вручную)"""
+        cached = self._levels.get(owner_id)
+        if cached is not None:
+            return cached
+        # Ручной уровень - первый найденный среди чатов владельца
+        manual = next((self._rows[cid][2] for cid in self._owner_chats.get(owner_id, [])
+                       if self._rows[cid][2]), None)
+        if manual in self._level_keys:
+            cached = (manual, True)
+        else:
+            cached = (self.level_for_volume(self.volume(owner_id)), manual is not None)
+        self._levels[owner_id] = cached
+        return cached
+
+    def partners(self) -> List[Tuple[int, Dict[str, float], int]]:
+        """(owner_id, суммы, число чатов) по убыванию объёма"""
+        return [(owner_id, self.totals(owner_id), len(self._owner_chats[owner_id]))
+                for _, owner_id in self._by_volume]
@@ -0,0 +1,113 @@
+"""
+payment_webhooks.py - Приём вебхуков CryptoPay и xRocket внутри процесса бота
+
+Подпись обоих провайдеров: HMAC-SHA256 тела запроса с ключом SHA256(токена).
+Опрос счетов остаётся как резервный путь.
+"""
+
+import hashlib
+import hmac
+import json
+from typing import Awaitable, Callable, Optional
+
+from aiohttp import web
+from loguru import logger
+
+
+InvoiceHandler = Callable[[dict], Awaitable[None]]
+
+CRYPTOPAY_SIGNATURE_HEADER = "crypto-pay-api-signature"
+XROCKET_SIGNATURE_HEADER = "rocket-pay-signature"
+
+
+def verify_signature(token: str, body: bytes, signature: Optional[str]) -> bool:
+    """Проверка HMAC-SHA256(body, sha256(token))"""
+    if not token or not signature:
+        return False
+    secret = hashlib.sha256(token.encode()).digest()
+    expected = hmac.new(secret, body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, signature.strip().lower())
+
+
+def parse_payload(payload: Optional[str]) -> Optional[tuple]:
+    """Разбор payload счёта вида "user_id:currency:amount" """
+    try:
+        user_id, currency, amount = str(payload).split(":", 2)
+        return int(user_id), currency, float(amount)
+    except (TypeError, ValueError):
+        return None
+
+
+class PaymentWebhookServer:
+    """aiohttp-сервер для вебхуков платёжных систем"""
+
+    def __init__(self, host: str, port: int,
+                 cryptopay_token: str = "", on_cryptopay_paid: Optional[InvoiceHandler] = None,
+                 xrocket_key: str = "", on_xrocket_paid: Optional[InvoiceHandler] = None):
+        self.host = host
+        self.port = port
+        self._cryptopay_token = cryptopay_token
+        self._on_cryptopay_paid = on_cryptopay_paid
+        self._xrocket_key = xrocket_key
+        self._on_xrocket_paid = on_xrocket_paid
+        self._runner: Optional[web.AppRunner] = None
+
+        self.app = web.Application()
+        if on_cryptopay_paid and cryptopay_token:
+            self.app.router.add_post("/webhook/cryptopay", self._cryptopay)
+        if on_xrocket_paid and xrocket_key:
+            self.app.router.add_post("/webhook/xrocket", self._xrocket)
+
+    async def _read_verified(self, request: web.Request, token: str, header: str) -> Optional[dict]:
+        body = await request.read()
+        if not verify_signature(token, body, request.headers.get(header)):
+            logger.warning(f"Webhook {request.path}: bad signature from {request.remote}")
+            return None
+        try:
+            return json.loads(body)
+        except ValueError:
+            return {}
+
+    async def _cryptopay(self, request: web.Request) -> web.Response:
+        update = await self._read_verified(request, self._cryptopay_token, CRYPTOPAY_SIGNATURE_HEADER)
+        if update is None:
+            return web.Response(status=401)
+        if not update:
+            return web.Response(status=400)
+
+        if update.get("update_type") == "invoice_paid":
+            invoice = update.get("payload") or {}
+            try:
+                await self._on_cryptopay_paid(invoice)
+            except Exception as e:
+                logger.error(f"CryptoPay webhook handler error: {e}")
+                return web.Response(status=500)
+        return web.json_response({"ok": True})
+
+    async def _xrocket(self, request: web.Request) -> web.Response:
+        update = await self._read_verified(request, self._xrocket_key, XROCKET_SIGNATURE_HEADER)
+        if update is None:
+            return web.Response(status=401)
+        if not update:
+            return web.Response(status=400)
+
+        if update.get("type") == "invoicePay":
+            invoice = update.get("data") or {}
+            try:
+                await self._on_xrocket_paid(invoice)
+            except Exception as e:
+                logger.error(f"xRocket webhook handler error: {e}")
+                return web.Response(status=500)
+        return web.json_response({"ok": True})
+
+    async def start(self):
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        logger.info(f"Payment webhooks listening on {self.host}:{self.port}")
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
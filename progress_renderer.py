@@ -0,0 +1,90 @@
+"""
+progress_renderer.py - Прогресс долгих операций в одном сообщении
+
+Конвейер только сообщает смену этапа, а рендерер редактирует сообщение
+не чаще min_interval: промежуточные этапы, которые уже прошли, пропускаются,
+финальное состояние показывается всегда.
+"""
+
+import asyncio
+from typing import Callable, Optional, Tuple
+
+from aiogram import types
+from aiogram.exceptions import TelegramBadRequest
+from loguru import logger
+
+
+class ProgressRenderer:
+    """Объединяет правки сообщения с прогрессом"""
+
+    def __init__(self, message: types.Message, render: Callable[[str, int], str],
+                 min_interval: float = 1.0):
+        self._message = message
+        self._render = render
+        self._min_interval = min_interval
+        self._pending: Optional[Tuple[str, int]] = None
+        self._last_edit = 0.0
+        self._last_text: Optional[str] = None
+        self._task: Optional[asyncio.Task] = None
+        self._sleeping = False
+        self._closed = False
+
+    async def start(self, stage: str, percent: int):
+        """Показать первый этап сразу, без клавиатуры (повторно нажать кнопку нельзя)"""
+        if self._closed:
+            return
+        await self._edit(self._render(stage, percent), None)
+
+    def update(self, stage: str, percent: int):
+        """Сообщить о новом этапе; сообщение обновится, когда позволит интервал"""
+        if self._closed:
+            return
+        self._pending = (stage, percent)
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        try:
+            while self._pending is not None and not self._closed:
+                delay = self._last_edit + self._min_interval - loop.time()
+                if delay > 0:
+                    self._sleeping = True
+                    try:
+                        await asyncio.sleep(delay)
+                    finally:
+                        self._sleeping = False
+                if self._pending is None or self._closed:
+                    break
+                stage, percent = self._pending
+                self._pending = None
+                await self._edit(self._render(stage, percent), None)
+        finally:
+            self._task = None
+
+    async def _edit(self, text: str, reply_markup: Optional[types.InlineKeyboardMarkup]):
+        if text == self._last_text and reply_markup is None:
+            return
+        self._last_edit = asyncio.get_running_loop().time()
+        try:
+            # reply_markup=None убирает клавиатуру сообщения
+            await self._message.edit_text(text, reply_markup=reply_markup)
+            self._last_text = text
+        except TelegramBadRequest as e:
+            if "message is not modified" not in str(e):
+                logger.warning(f"Progress edit failed: {e}")
+
+    async def finish(self, text: str, reply_markup: Optional[types.InlineKeyboardMarkup] = None):
+        """Показать финальное состояние; дальнейшие update игнорируются"""
+        self._closed = True
+        task = self._task
+        if task is not None:
+            # Ждём правку, которая уже отправляется, но не паузу перед следующей
+            if self._sleeping:
+                task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._pending = None
+        await self._edit(text, reply_markup)
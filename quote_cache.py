@@ -0,0 +1,135 @@
+"""
+quote_cache.py - Общий кэш котировок бота и админ-панели
+
+Курсы TON и баланс кошелька обновляет один процесс (бот) и пишет их в
+JSON-файл с временем обновления; админ-панель и сам бот читают файл
+(перечитывается только при изменении mtime) и никогда не ждут внешние API.
+"""
+
+import asyncio
+import json
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, NamedTuple, Optional, Tuple
+
+from loguru import logger
+
+
+class Quote(NamedTuple):
+    value: Any
+    ts: float
+    source: Optional[str]
+    max_age: float
+
+    @property
+    def age(self) -> float:
+        return time.time() - self.ts
+
+    @property
+    def stale(self) -> bool:
+        return self.age > self.max_age
+
+
+class QuoteCache:
+    """Котировки в файле: name -> {value, ts, source, max_age}"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._data: Dict[str, Dict[str, Any]] = {}
+        self._mtime: Optional[float] = None
+
+    def _reload(self):
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except FileNotFoundError:
+            return
+        if mtime == self._mtime:
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                self._data = json.load(f)
+            self._mtime = mtime
+        except (OSError, ValueError) as e:
+            # Файл заменяется атомарно, ошибка возможна только при порче
+            logger.error(f"Failed to read quotes from {self.path}: {e}")
+
+    def get(self, name: str) -> Optional[Quote]:
+        """Последнее значение котировки или None, если её ещё не было"""
+        with self._lock:
+            self._reload()
+            entry = self._data.get(name)
+        if entry is None:
+            return None
+        return Quote(entry["value"], entry["ts"], entry.get("source"), entry.get("max_age", 300.0))
+
+    def publish(self, name: str, value: Any, source: Optional[str] = None, max_age: float = 300.0):
+        """Записать свежее значение (вызывает процесс-обновлятель)"""
+        with self._lock:
+            self._reload()
+            self._data[name] = {"value": value, "ts": time.time(), "source": source, "max_age": max_age}
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(self._data, f, ensure_ascii=False)
+            os.replace(tmp, self.path)
+            self._mtime = os.stat(self.path).st_mtime
+
+    def status(self) -> Dict[str, Dict[str, Any]]:
+        """Время обновления и флаг устаревания по всем котировкам"""
+        with self._lock:
+            self._reload()
+            names = list(self._data)
+        result = {}
+        for name in names:
+            quote = self.get(name)
+            result[name] = {"ts": quote.ts, "age": round(quote.age, 1), "stale": quote.stale,
+                            "source": quote.source}
+        return result
+
+
+class QuoteRefresher:
+    """Фоновое обновление котировок: name -> (fetch, интервал, сек)"""
+
+    def __init__(self, cache: QuoteCache,
+                 sources: Dict[str, Tuple[Callable[[], Optional[Tuple[Any, str]]], float]]):
+        # fetch - синхронная функция, возвращает (значение, источник) или None при ошибке
+        self._cache = cache
+        self._sources = sources
+        self._due: Dict[str, float] = {name: 0.0 for name in sources}
+        self._task: Optional[asyncio.Task] = None
+
+    async def refresh(self, name: str) -> bool:
+        fetch, interval = self._sources[name]
+        result = await asyncio.to_thread(fetch)
+        if result is None:
+            # Старое значение остаётся, читатели видят его возраст
+            return False
+        value, source = result
+        # Значение устаревает, если пропущено больше двух обновлений
+        self._cache.publish(name, value, source, max_age=interval * 3)
+        return True
+
+    async def _run(self):
+        while True:
+            now = time.monotonic()
+            for name, due in list(self._due.items()):
+                if due > now:
+                    continue
+                try:
+                    await self.refresh(name)
+                except Exception as e:
+                    logger.error(f"Quote refresh failed for {name}: {e}")
+                self._due[name] = time.monotonic() + self._sources[name][1]
+            await asyncio.sleep(max(0.5, min(self._due.values()) - time.monotonic()))
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
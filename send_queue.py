@@ -0,0 +1,183 @@
+"""
+send_queue.py - Единая очередь исходящих сообщений Telegram
+
+Middleware сессии бота: все отправки и правки сообщений проходят через
+общий лимит (~30 в секунду) и лимиты на чат, ответы пользователям идут
+раньше фоновых уведомлений, RetryAfter обрабатывается повтором.
+"""
+
+import asyncio
+import contextlib
+import heapq
+import itertools
+import time
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Tuple
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+from loguru import logger
+
+from throttling import BucketRegistry, Rule
+
+
+INTERACTIVE = 0
+BACKGROUND = 10
+
+# Приоритет отправок текущей задачи; задачи наследуют его при создании
+send_priority: ContextVar[int] = ContextVar("send_priority", default=INTERACTIVE)
+
+# Методы, на которые распространяются лимиты Telegram на отправку
+LIMITED_METHODS = {
+    "SendMessage", "SendPhoto", "SendAnimation", "SendAudio", "SendDocument",
+    "SendVideo", "SendVoice", "SendSticker", "SendDice", "SendMediaGroup",
+    "SendLocation", "SendContact", "SendPoll", "CopyMessage", "ForwardMessage",
+    "EditMessageText", "EditMessageCaption", "EditMessageMedia", "EditMessageReplyMarkup",
+}
+
+
+@contextlib.contextmanager
+def priority(level: int):
+    """Выполнить блок (и созданные в нём задачи) с заданным приоритетом отправки"""
+    token = send_priority.set(level)
+    try:
+        yield
+    finally:
+        send_priority.reset(token)
+
+
+class SendScheduler(BaseRequestMiddleware):
+    """Планировщик отправок с общим и поканальными token bucket"""
+
+    def __init__(self, global_per_second: float = 30.0, private_per_second: float = 1.0,
+                 private_burst: int = 3, group_per_minute: float = 20.0,
+                 max_retries: int = 3, max_chats: int = 50000):
+        self._global_rule = Rule(1.0, burst=int(global_per_second))
+        self._private_rule = Rule(private_burst / private_per_second, burst=private_burst)
+        self._group_rule = Rule(60.0, burst=int(group_per_minute))
+        self._max_retries = max_retries
+        self._buckets = BucketRegistry(max_keys=max_chats)
+        # RetryAfter: блокировки чатов и общая (для запросов без chat_id)
+        self._blocked_until: Dict[int, float] = {}
+        self._global_blocked_until = 0.0
+
+        # Куча (priority, seq, chat_id, future); выполненные и отменённые
+        # заявки удаляются лениво, когда оказываются на вершине
+        self._queue: List[Tuple[int, int, Optional[int], asyncio.Future]] = []
+        self._seq = itertools.count()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return sum(1 for entry in self._queue if not entry[3].done())
+
+    async def __call__(self, make_request, bot, method):
+        if type(method).__name__ not in LIMITED_METHODS:
+            return await make_request(bot, method)
+
+        chat_id = getattr(method, "chat_id", None)
+        chat_id = chat_id if isinstance(chat_id, int) else None
+        level = send_priority.get()
+
+        for attempt in range(self._max_retries + 1):
+            await self._acquire(chat_id, level)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                until = time.monotonic() + e.retry_after
+                if chat_id is None:
+                    self._global_blocked_until = until
+                else:
+                    self._blocked_until[chat_id] = until
+                if attempt >= self._max_retries:
+                    raise
+                logger.warning(f"Flood control for chat {chat_id}: retry in {e.retry_after}s "
+                               f"(attempt {attempt + 1}/{self._max_retries})")
+
+    async def _acquire(self, chat_id: Optional[int], level: int):
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._dispatch())
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (level, next(self._seq), chat_id, future))
+        self._wakeup.set()
+        await future
+
+    def _chat_rule(self, chat_id: Optional[int]) -> Optional[Rule]:
+        if chat_id is None:
+            return None
+        return self._group_rule if chat_id < 0 else self._private_rule
+
+    def _chat_wait(self, chat_id: Optional[int], now: float) -> float:
+        rule = self._chat_rule(chat_id)
+        if rule is None:
+            return 0.0
+        blocked = self._blocked_until.get(chat_id, 0.0) - now
+        if blocked > 0:
+            return blocked
+        self._blocked_until.pop(chat_id, None)
+        allowed, wait = self._buckets.consume(("chat", chat_id), rule, now)
+        return 0.0 if allowed else wait
+
+    def _next_ready(self, now: float) -> Tuple[Optional[int], float]:
+        """Индекс первой по приоритету готовой заявки и минимальное ожидание остальных.
+
+        Куча обходится лениво в порядке приоритета (через кучу индексов её
+        узлов), поэтому просматриваются только заявки до первой готовой.
+        """
+        queue = self._queue
+        min_wait = float("inf")
+        frontier = [(queue[0], 0)] if queue else []
+        while frontier:
+            entry, index = heapq.heappop(frontier)
+            for child in (2 * index + 1, 2 * index + 2):
+                if child < len(queue):
+                    heapq.heappush(frontier, (queue[child], child))
+            _, _, chat_id, future = entry
+            if future.done():
+                continue
+            wait = self._chat_wait(chat_id, now)
+            if wait <= 0:
+                return index, 0.0
+            min_wait = min(min_wait, wait)
+        return None, min_wait
+
+    async def _dispatch(self):
+        while True:
+            # Выполненные и отменённые ожидания (например, задача обработчика прервана)
+            while self._queue and self._queue[0][3].done():
+                heapq.heappop(self._queue)
+
+            if not self._queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            now = time.monotonic()
+            global_wait = self._global_blocked_until - now
+            if global_wait <= 0:
+                allowed, global_wait = self._buckets.consume(("global",), self._global_rule, now)
+                if allowed:
+                    index, wait = self._next_ready(now)
+                    if index is not None:
+                        # Заявка не с вершины остаётся в куче выполненной до своей очереди
+                        future = self._queue[index][3]
+                        if index == 0:
+                            heapq.heappop(self._queue)
+                        future.set_result(None)
+                        continue
+                    # Токен не нужен ни одной заявке сейчас - возвращаем его
+                    self._buckets.refund(("global",), self._global_rule)
+                    global_wait = wait
+
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=max(global_wait, 0.005))
+            except asyncio.TimeoutError:
+                pass
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
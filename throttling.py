@@ -0,0 +1,155 @@
+"""
+throttling.py - Ограничение частоты действий пользователей (token bucket)
+
+Корзины пополняются лениво при обращении, хранятся в LRU с жёстким
+лимитом размера, поэтому память не растёт с числом пользователей.
+"""
+
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+from aiogram import BaseMiddleware
+from aiogram.dispatcher.event.bases import UNHANDLED
+from aiogram.types import CallbackQuery, Message
+
+
+class Rule:
+    """Правило: rate действий в секунду, не больше burst подряд"""
+
+    __slots__ = ("rate", "burst", "message")
+
+    def __init__(self, per_seconds: float, burst: int = 1, message: Optional[str] = None):
+        self.rate = burst / per_seconds
+        self.burst = float(burst)
+        self.message = message
+
+
+class TokenBucket:
+    __slots__ = ("tokens", "updated", "notified")
+
+    def __init__(self, tokens: float, updated: float):
+        self.tokens = tokens
+        self.updated = updated
+        self.notified = False
+
+
+class BucketRegistry:
+    """Корзины по ключам с вытеснением давно неиспользуемых"""
+
+    def __init__(self, max_keys: int = 100000):
+        self._max_keys = max_keys
+        self._buckets: "OrderedDict[Hashable, TokenBucket]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def consume(self, key: Hashable, rule: Rule, now: Optional[float] = None) -> Tuple[bool, float]:
+        """Списать токен; возвращает (разрешено, через сколько секунд повторить)"""
+        now = now if now is not None else time.monotonic()
+        bucket = self._buckets.get(key)
+
+        if bucket is None:
+            bucket = TokenBucket(rule.burst, now)
+            self._buckets[key] = bucket
+            if len(self._buckets) > self._max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+            bucket.tokens = min(rule.burst, bucket.tokens + (now - bucket.updated) * rule.rate)
+            bucket.updated = now
+
+        if bucket.tokens >= 1.0:
+            bucket.tokens -= 1.0
+            bucket.notified = False
+            return True, 0.0
+        return False, (1.0 - bucket.tokens) / rule.rate
+
+    def refund(self, key: Hashable, rule: Rule):
+        """Вернуть токен, списанный без фактического действия"""
+        bucket = self._buckets.get(key)
+        if bucket is not None:
+            bucket.tokens = min(rule.burst, bucket.tokens + 1.0)
+
+    def should_notify(self, key: Hashable) -> bool:
+        """Предупреждать пользователя один раз, пока корзина пуста"""
+        bucket = self._buckets.get(key)
+        if bucket is None or bucket.notified:
+            return False
+        bucket.notified = True
+        return True
+
+
+def event_throttle_key(event: Any) -> Optional[str]:
+    """Ключ правила для события: cmd:<команда> или cb:<префикс callback_data>"""
+    if isinstance(event, Message):
+        text = event.text or ""
+        if text.startswith("/"):
+            return "cmd:" + text[1:].split(maxsplit=1)[0].split("@", 1)[0].lower()
+        return None
+    if isinstance(event, CallbackQuery):
+        return "cb:" + (event.data or "")
+    return None
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """Ограничение частоты для обработчиков, выбранных по ключу события.
+
+    Ключи правил: "cmd:dice" - команда, "cb:buygo:" - префикс callback_data.
+    Регистрируется как outer middleware, чтобы охватить и роутеры модулей.
+    Токен возвращается, если событие не обработано ни одним обработчиком или
+    обработчик отклонил его сам через throttle_refund() (повтор, дубль).
+    """
+
+    def __init__(self, rules: Dict[str, Rule], registry: Optional[BucketRegistry] = None,
+                 default_message: str = "⏳ Слишком часто, подождите немного"):
+        self._commands = {k: v for k, v in rules.items() if k.startswith("cmd:")}
+        self._callbacks = [(k, v) for k, v in rules.items() if k.startswith("cb:")]
+        self.registry = registry or BucketRegistry()
+        self._default_message = default_message
+
+    def _match(self, key: str) -> Optional[Tuple[str, Rule]]:
+        if key.startswith("cmd:"):
+            rule = self._commands.get(key)
+            return (key, rule) if rule else None
+        for prefix, rule in self._callbacks:
+            if key.startswith(prefix):
+                return prefix, rule
+        return None
+
+    async def __call__(
+        self,
+        handler: Callable[[Any, Dict[str, Any]], Awaitable[Any]],
+        event: Any,
+        data: Dict[str, Any]
+    ) -> Any:
+        key = event_throttle_key(event)
+        user = getattr(event, "from_user", None)
+        matched = self._match(key) if key and user else None
+        if matched is None:
+            return await handler(event, data)
+
+        rule_key, rule = matched
+        bucket_key = (rule_key, user.id)
+        allowed, _ = self.registry.consume(bucket_key, rule)
+        if allowed:
+            refunded = False
+
+            def refund():
+                nonlocal refunded
+                if not refunded:
+                    refunded = True
+                    self.registry.refund(bucket_key, rule)
+
+            data["throttle_refund"] = refund
+            result = await handler(event, data)
+            if result is UNHANDLED:
+                refund()
+            return result
+
+        text = rule.message or self._default_message
+        if isinstance(event, CallbackQuery):
+            await event.answer(text, show_alert=True)
+        elif self.registry.should_notify(bucket_key):
+            await event.answer(text)
+        return None
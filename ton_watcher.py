@@ -0,0 +1,222 @@
+"""
+ton_watcher.py - Фоновое отслеживание входящих TON-депозитов
+
+Один наблюдатель постранично читает транзакции кошелька из toncenter,
+начиная с сохранённого курсора (logical time), декодирует комментарии
+один раз и сопоставляет их с ожидающими платежами по коду.
+"""
+
+import asyncio
+import base64
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from loguru import logger
+
+
+TONCENTER_URL = "https://toncenter.com/api/v2/getTransactions"
+COMMENT_FIELDS = ("text", "comment", "payload", "body")
+
+
+def decode_comment(comment: str) -> Optional[str]:
+    if not comment:
+        return None
+
+    comment = str(comment).strip()
+
+    if len(comment) % 4 == 0 and all(
+            c in 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/=' for c in comment):
+        try:
+            decoded = base64.b64decode(comment).decode('utf-8')
+            if decoded and (decoded.isdigit() or any(c.isalnum() for c in decoded)):
+                return decoded.strip()
+        except Exception:
+            pass
+
+    return comment
+
+
+def extract_comment(in_msg: dict) -> Optional[str]:
+    """Комментарий входящего сообщения транзакции"""
+    msg_data = in_msg.get("msg_data", {})
+
+    if isinstance(msg_data, dict):
+        for field in COMMENT_FIELDS:
+            value = msg_data.get(field)
+            if value:
+                comment = decode_comment(str(value))
+                if comment:
+                    return comment
+
+    message = in_msg.get("message")
+    if message:
+        return decode_comment(message)
+    return None
+
+
+class DepositWatcher:
+    """Наблюдатель за входящими транзакциями кошелька"""
+
+    def __init__(self, address: str, session_factory: Callable, pending: Dict[str, Tuple[int, float]],
+                 on_deposit: Callable[[str, int, float, str], Awaitable[None]],
+                 load_cursor: Callable[[], int], save_cursor: Callable[[int], None],
+                 api_key: str = "", min_amount: float = 0.0,
+                 interval: float = 10.0, page_size: int = 50, warn_pages: int = 20):
+        self.address = address
+        self._session_factory = session_factory
+        # code -> (user_id, timestamp), общий словарь с bot.py
+        self._pending = pending
+        self._on_deposit = on_deposit
+        self._load_cursor = load_cursor
+        self._save_cursor = save_cursor
+        self._api_key = api_key
+        self._min_amount = min_amount
+        self._interval = interval
+        self._page_size = page_size
+        self._warn_pages = warn_pages
+
+        self._cursor_lt: Optional[int] = None
+        self._scan_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self.last_scan = 0.0
+        self.last_error: Optional[str] = None
+
+    @property
+    def healthy(self) -> bool:
+        """Последний проход был успешным и недавним"""
+        return self.last_error is None and time.time() - self.last_scan < self._interval * 3
+
+    def _fetch_page(self, lt: Optional[int], tx_hash: Optional[str], to_lt: int) -> List[dict]:
+        params = {
+            "address": self.address,
+            "limit": self._page_size,
+            "archival": True,
+        }
+        if lt and tx_hash:
+            params["lt"] = lt
+            params["hash"] = tx_hash
+        if to_lt:
+            params["to_lt"] = to_lt
+
+        response = self._session_factory().get(
+            TONCENTER_URL,
+            params=params,
+            headers={"X-API-Key": self._api_key},
+            timeout=15
+        )
+        response.raise_for_status()
+        data = response.json()
+        if not data.get("ok"):
+            raise RuntimeError(f"TonCenter error: {data.get('error')}")
+        return data.get("result", [])
+
+    def _fetch_new(self, cursor_lt: int) -> List[dict]:
+        """Все транзакции новее курсора, от новых к старым.
+
+        Страницы читаются до курсора без ограничения: пропущенная транзакция
+        была бы потеряна, потому что курсор после прохода уходит дальше неё.
+        """
+        result: List[dict] = []
+        lt, tx_hash = None, None
+        pages = 0
+
+        while True:
+            page = self._fetch_page(lt, tx_hash, cursor_lt)
+            pages += 1
+            fresh = [tx for tx in page if int(tx.get("transaction_id", {}).get("lt", 0)) > cursor_lt]
+            # Страница начинается с транзакции lt/hash, которая уже в результате
+            if lt is not None:
+                fresh = [tx for tx in fresh if int(tx["transaction_id"]["lt"]) < lt]
+            result.extend(fresh)
+
+            if not cursor_lt or len(page) < self._page_size or len(fresh) < len(page) - (1 if lt else 0):
+                break
+
+            last_id = page[-1].get("transaction_id", {})
+            lt, tx_hash = int(last_id.get("lt", 0)), last_id.get("hash")
+            if pages % self._warn_pages == 0:
+                logger.warning(f"Deposit watcher: {pages} pages since lt={cursor_lt}, still catching up")
+
+        return result
+
+    async def scan(self):
+        """Один проход: загрузить новые транзакции и обработать совпадения"""
+        async with self._scan_lock:
+            if self._cursor_lt is None:
+                self._cursor_lt = int(self._load_cursor() or 0)
+
+            try:
+                transactions = await asyncio.to_thread(self._fetch_new, self._cursor_lt)
+            except Exception as e:
+                self.last_error = str(e)
+                logger.error(f"Deposit watcher fetch error: {e}")
+                return
+
+            # Обрабатываем от старых к новым; при ошибке курсор остаётся перед
+            # транзакцией, и она будет повторена на следующем проходе
+            processed_lt = self._cursor_lt
+            for tx in reversed(transactions):
+                try:
+                    await self._process(tx)
+                except Exception as e:
+                    logger.error(f"Deposit watcher processing error: {e}")
+                    break
+                processed_lt = int(tx["transaction_id"]["lt"])
+
+            if processed_lt != self._cursor_lt:
+                self._cursor_lt = processed_lt
+                self._save_cursor(processed_lt)
+
+            self.last_scan = time.time()
+            self.last_error = None
+
+    async def _process(self, tx: dict):
+        in_msg = tx.get("in_msg")
+        if not in_msg or not in_msg.get("value"):
+            return
+
+        amount_ton = int(in_msg.get("value", 0)) / 1e9
+        if amount_ton < self._min_amount:
+            return
+
+        comment = extract_comment(in_msg)
+        if not comment:
+            return
+
+        code = str(comment).strip()
+        entry = self._pending.get(code)
+        if entry is None:
+            return
+
+        user_id, timestamp = entry
+        tx_time = tx.get("utime", 0)
+        if tx_time < timestamp:
+            return
+
+        tx_id = tx.get("transaction_id", {})
+        tx_hash = tx_id.get("hash", f"tx_{tx_time}_{user_id}")
+        logger.info(f"Deposit watcher matched payment {code}: user={user_id}, amount={amount_ton} TON")
+        await self._on_deposit(code, user_id, amount_ton, tx_hash)
+
+    async def sync(self, max_age: float = 3.0):
+        """Дождаться свежего прохода; запросы от многих пользователей объединяются в один"""
+        if time.time() - self.last_scan < max_age:
+            return
+        if self._scan_lock.locked():
+            async with self._scan_lock:
+                return
+        await self.scan()
+
+    async def _loop(self):
+        while True:
+            await self.scan()
+            await asyncio.sleep(self._interval)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
@@ -0,0 +1,138 @@
+"""
+user_search.py - Поисковый индекс пользователей для админ-панели
+
+Префиксный поиск по ID (отсортированный список строк) и поиск подстроки
+в username через триграммы: кандидаты - пересечение множеств триграмм
+запроса, затем точная проверка. Время поиска не зависит от числа
+пользователей, только от числа совпадений.
+"""
+
+import bisect
+from typing import Dict, List, Optional, Set
+
+
+def _trigrams(text: str) -> Set[str]:
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class UserSearchIndex:
+    """Индекс ID и username для поиска подстрокой"""
+
+    def __init__(self):
+        self._reset()
+
+    def _reset(self):
+        self._ids: List[str] = []
+        self._names: Dict[int, str] = {}
+        self._by_trigram: Dict[str, Set[int]] = {}
+        # (username, id) по алфавиту - для коротких запросов (1-2 символа)
+        self._sorted_names: List[tuple] = []
+
+    def rebuild(self, names: Dict[int, str]):
+        """Построить индекс по словарю user_id -> username"""
+        self._reset()
+        self._ids = sorted(str(uid) for uid in names)
+        for uid, name in names.items():
+            name = (name or "").lower()
+            if name:
+                self._names[uid] = name
+                for gram in _trigrams(name):
+                    self._by_trigram.setdefault(gram, set()).add(uid)
+        self._sorted_names = sorted((name, uid) for uid, name in self._names.items())
+
+    def update(self, uid: int, name: Optional[str]):
+        """Добавить пользователя или учесть смену username"""
+        key = str(uid)
+        pos = bisect.bisect_left(self._ids, key)
+        if pos == len(self._ids) or self._ids[pos] != key:
+            self._ids.insert(pos, key)
+
+        name = (name or "").lower()
+        old = self._names.get(uid)
+        if old == (name or None):
+            return
+        if old:
+            for gram in _trigrams(old):
+                ids = self._by_trigram.get(gram)
+                if ids is not None:
+                    ids.discard(uid)
+                    if not ids:
+                        del self._by_trigram[gram]
+            pos = bisect.bisect_left(self._sorted_names, (old, uid))
+            if pos < len(self._sorted_names) and self._sorted_names[pos] == (old, uid):
+                del self._sorted_names[pos]
+            del self._names[uid]
+        if name:
+            self._names[uid] = name
+            for gram in _trigrams(name):
+                self._by_trigram.setdefault(gram, set()).add(uid)
+            bisect.insort(self._sorted_names, (name, uid))
+
+    def remove(self, uid: int):
+        self.update(uid, None)
+        key = str(uid)
+        pos = bisect.bisect_left(self._ids, key)
+        if pos < len(self._ids) and self._ids[pos] == key:
+            del self._ids[pos]
+
+    def id_prefix(self, prefix: str, limit: Optional[int] = None) -> List[int]:
+        """ID, начинающиеся с prefix (в лексикографическом порядке)"""
+        result = []
+        for i in range(bisect.bisect_left(self._ids, prefix), len(self._ids)):
+            if not self._ids[i].startswith(prefix) or (limit is not None and len(result) >= limit):
+                break
+            result.append(int(self._ids[i]))
+        return result
+
+    def username_contains(self, query: str, limit: Optional[int] = None) -> List[int]:
+        """ID пользователей, чей username содержит query"""
+        query = query.lstrip("@").lower()
+        if not query:
+            return []
+
+        if len(query) < 3:
+            # Триграмм нет - ищем только по началу username
+            result = []
+            for i in range(bisect.bisect_left(self._sorted_names, (query,)), len(self._sorted_names)):
+                name, uid = self._sorted_names[i]
+                if not name.startswith(query) or (limit is not None and len(result) >= limit):
+                    break
+                result.append(uid)
+            return result
+
+        postings = []
+        for gram in _trigrams(query):
+            ids = self._by_trigram.get(gram)
+            if not ids:
+                return []
+            postings.append(ids)
+        postings.sort(key=len)
+
+        candidates = postings[0]
+        for ids in postings[1:]:
+            candidates = candidates & ids
+            if not candidates:
+                return []
+
+        result = []
+        for uid in sorted(candidates):
+            if query in self._names[uid]:
+                result.append(uid)
+                if limit is not None and len(result) >= limit:
+                    break
+        return result
+
+    def search(self, query: str, limit: int = 10) -> List[int]:
+        """Поиск для админки: сначала совпадения по ID, затем по username"""
+        query = query.strip()
+        result: List[int] = []
+        if query.isdigit():
+            result = self.id_prefix(query, limit)
+        if len(result) < limit:
+            seen = set(result)
+            for uid in self.username_contains(query, limit):
+                if uid not in seen:
+                    result.append(uid)
+                    if len(result) >= limit:
+                        break
+        return result
@@ -0,0 +1,129 @@
+"""
+wallet_tracker.py - Учёт баланса горячего кошелька бота
+
+Баланс обновляется в фоне, а покупки и выводы резервируют сумму локально,
+без запроса к tonapi на каждое действие.
+"""
+
+import asyncio
+import threading
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+from loguru import logger
+
+
+class WalletBalanceTracker:
+    """Кэш баланса кошелька с резервами под незавершённые траты"""
+
+    def __init__(self, fetch: Callable[[], Optional[float]], interval: float = 30.0,
+                 max_age: float = 600.0, settle_time: float = 90.0):
+        # fetch - синхронная функция, возвращает баланс в TON или None при ошибке
+        self._fetch = fetch
+        self._interval = interval
+        self._max_age = max_age
+        self._settle_time = settle_time
+
+        self._balance = 0.0
+        self._updated_at = 0.0
+        # key -> сумма, зарезервированная под операцию в процессе
+        self._reserved: Dict[str, float] = {}
+        # key -> (сумма, время) - уже отправленные траты, которых ещё может не быть в балансе
+        self._spent: Dict[str, Tuple[float, float]] = {}
+        self._lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def balance(self) -> float:
+        """Последний известный баланс кошелька"""
+        return self._balance
+
+    @property
+    def updated_at(self) -> float:
+        return self._updated_at
+
+    @property
+    def is_stale(self) -> bool:
+        return time.time() - self._updated_at > self._max_age
+
+    def reserved_total(self) -> float:
+        """Сумма резервов и неподтверждённых трат"""
+        with self._lock:
+            return self._reserved_total_locked()
+
+    def _reserved_total_locked(self) -> float:
+        return sum(self._reserved.values()) + sum(a for a, _ in self._spent.values())
+
+    def available(self) -> float:
+        """Баланс, доступный для новых трат"""
+        with self._lock:
+            return self._balance - self._reserved_total_locked()
+
+    def try_reserve(self, key: str, amount: float) -> bool:
+        """Атомарно проверить и зарезервировать сумму под операцию"""
+        if amount <= 0:
+            return True
+        with self._lock:
+            if key in self._reserved:
+                return True
+            if self._updated_at == 0 or self.is_stale:
+                logger.warning(f"Wallet balance is unknown or stale, cannot reserve {amount:.4f} TON")
+                return False
+            if self._balance - self._reserved_total_locked() < amount:
+                return False
+            self._reserved[key] = amount
+            return True
+
+    def release(self, key: str):
+        """Снять резерв (операция не состоялась)"""
+        with self._lock:
+            self._reserved.pop(key, None)
+
+    def commit(self, key: str, amount: Optional[float] = None):
+        """Отметить резерв как потраченный (транзакция отправлена)"""
+        with self._lock:
+            reserved = self._reserved.pop(key, None)
+            spent = amount if amount is not None else reserved
+            if spent:
+                self._spent[key] = (spent, time.time())
+
+    def _apply_balance(self, balance: float, fetched_at: float):
+        with self._lock:
+            self._balance = balance
+            self._updated_at = fetched_at
+            # Траты, отправленные задолго до снимка, уже учтены в балансе
+            cutoff = fetched_at - self._settle_time
+            for key in [k for k, (_, ts) in self._spent.items() if ts < cutoff]:
+                del self._spent[key]
+
+    async def refresh(self) -> Optional[float]:
+        """Обновить баланс из сети"""
+        started = time.time()
+        try:
+            balance = await asyncio.to_thread(self._fetch)
+        except Exception as e:
+            logger.error(f"Wallet balance refresh failed: {e}")
+            return None
+
+        if balance is None:
+            return None
+
+        self._apply_balance(float(balance), started)
+        logger.debug(f"Wallet balance refreshed: {balance:.4f} TON, reserved {self.reserved_total():.4f} TON")
+        return balance
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self._interval)
+            await self.refresh()
+
+    async def start(self):
+        """Первичная загрузка баланса и запуск фонового обновления"""
+        await self.refresh()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
@@ -4,12 +4,15 @@ web_admin.py - Защищенная веб-панель администрато
 """
 
 import os
+import csv
+import io
 import json
 import time
 import hashlib
 import secrets
 import re
-from datetime import datetime, timedelta
+import threading
+from datetime import datetime, timedelta, timezone
 from functools import wraps
 
 def check_admin(f):
@@ -35,6 +38,8 @@ from flask import (
     url_for,
     session,
     make_response,
+    Response,
+    stream_with_context,
     abort
 )
 from flask_cors import CORS
@@ -49,6 +54,9 @@ import bleach
 
 import db_selector as db  # локальный модуль работы с БД
 import dao_wallet as ton_wallet
+from broadcast_jobs import BroadcastWorker
+from quote_cache import QuoteCache
+from live_feed import LiveFeed
 
 load_dotenv()
 
@@ -90,6 +98,12 @@ ADMIN_USERNAME = os.getenv("ADMIN_USERNAME", "admin")
 ADMIN_PASSWORD = os.getenv("ADMIN_PASSWORD", "password")
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 WALLET_ADDRESS = os.getenv("TON_WALLET_ADDRESS")
+# Курсы и баланс кошелька обновляет бот, панель только читает
+quotes = QuoteCache(os.getenv("QUOTES_FILE", "data/quotes.json"))
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "20"))  # сообщений в секунду, остаток лимита - боту
+
+# Правки админа сразу пишутся на диск - бот увидит их при следующем чтении
+db.set_write_delay(0)
 
 # Защита от brute force - хранение попыток входа
 login_attempts: Dict[str, list] = {}
@@ -204,25 +218,19 @@ def login_required(f):
     return decorated_function
 
 def get_ton_rates():
-    """Получает курсы TON безопасно"""
-    try:
-        r = requests.get(
-            "https://min-api.cryptocompare.com/data/price",
-            params={"fsym": "TON", "tsyms": "USD,RUB"},
-            timeout=10,
-            verify=certifi.where(),
-        )
-        r.raise_for_status()
-        data = r.json()
-        usd = float(data.get("USD", 0) or 0)
-        rub = float(data.get("RUB", 0) or 0)
-        return usd, rub
-    except Exception as e:
-        logger.error(f"Failed to get TON rates: {e}")
+    """Курсы TON из общего кэша котировок (0, если бот их ещё не получил)"""
+    quote = quotes.get("ton_rates")
+    if quote is None:
         return 0.0, 0.0
+    return float(quote.value.get("usd", 0)), float(quote.value.get("rub", 0))
 
 def get_wallet_balance():
-    """Получает баланс TON-кошелька безопасно"""
+    """Баланс TON-кошелька из общего кэша котировок"""
+    quote = quotes.get("wallet_balance")
+    return float(quote.value) if quote is not None else 0.0
+
+def fetch_wallet_balance():
+    """Получает баланс TON-кошелька напрямую из tonapi (проверка подключения)"""
     if not WALLET_ADDRESS:
         return 0.0
     
@@ -332,47 +340,11 @@ def api_stats():
         fee_percent = db.get_fee_percent()
 
         stats = db.get_statistics()
-        users = db.get_all_users()
-
-        # Санитизация данных пользователей
-        enriched_users = []
-        now = time.time()
-        activity = {}
-        
-        for user in users:
-            user_data = dict(user)
-            uid = user_data.get("id") or user_data.get("user_id") or 0
-            
-            # Валидация user_id
-            if not str(uid).isdigit():
-                continue
-            
-            uid = int(uid)
-            
-            # Определение активности
-            last_msg = user_data.get("last_message_time", 0)
-            if now - last_msg < 86400:  # 24 часа
-                activity[uid] = "active"
-            elif now - last_msg < 604800:  # 7 дней
-                activity[uid] = "recent"
-            else:
-                activity[uid] = "inactive"
-            
-            # Санитизация данных
-            user_data["id"] = uid
-            user_data["username"] = sanitize_input(user_data.get("username", f"User_{uid}"))
-            user_data["balance"] = float(user_data.get("balance", 0))
-            user_data["total_deposited"] = float(user_data.get("total_deposited", 0))
-            user_data["total_bought"] = int(user_data.get("total_bought", 0))
-            
-            enriched_users.append(user_data)
-        
-        # Получаем топ пользователей по балансу
-        top_users = sorted(
-            enriched_users,
-            key=lambda x: float(x.get("balance", 0)),
-            reverse=True
-        )[:10]
+        users_summary = db.get_users_summary()
+        top_users = [
+            _sanitize_user(user)
+            for user in db.get_users_page(sort="balance", order="desc", limit=10)["users"]
+        ]
         
         # Форматируем статистику
         formatted_stats = {
@@ -383,12 +355,12 @@ def api_stats():
             "stats": {
                 "total_deals": stats.get("deposits", {}).get("count", 0),
                 "total_stars": stats.get("purchases", {}).get("total_stars", 0),
-                "total_balance": stats.get("users", {}).get("total_balance", 0)
+                "total_balance": users_summary["total_balance"]
             },
-            "users": enriched_users,
+            "quotes": quotes.status(),
+            "users_summary": users_summary,
             "top_users": top_users,
-            "activity": activity,
-            "users_count": len(enriched_users),
+            "users_count": users_summary["total"],
         }
         
         return jsonify(formatted_stats)
@@ -396,6 +368,143 @@ def api_stats():
         logger.error(f"Error in api_stats: {e}")
         abort(500)
 
+# Живая лента: события БД и скользящие счётчики за час/сутки.
+# Каждый SSE-клиент занимает поток сервера, поэтому админку запускают с
+# потоковыми или gevent-воркерами (gunicorn -k gthread --threads 8 / -k gevent);
+# число потоков ограничено LIVE_MAX_CLIENTS, поток закрывается через
+# LIVE_STREAM_TTL секунд, и браузер переподключается сам.
+LIVE_COUNTERS_INTERVAL = 5  # секунд между снимками счётчиков (и keepalive)
+LIVE_MAX_CLIENTS = int(os.getenv("LIVE_MAX_CLIENTS", "4"))
+LIVE_STREAM_TTL = int(os.getenv("LIVE_STREAM_TTL", "300"))
+live_feed: Optional[LiveFeed] = None
+live_feed_lock = threading.Lock()
+live_clients = threading.BoundedSemaphore(LIVE_MAX_CLIENTS)
+
+def get_live_feed() -> LiveFeed:
+    """Лента создаётся при первом подключении и заполняется историей за сутки"""
+    global live_feed
+    with live_feed_lock:
+        if live_feed is None:
+            feed = LiveFeed()
+            since = time.time() - 86400
+            feed.seed("deposit", db.iter_history("deposits", since=since))
+            feed.seed("purchase", db.iter_history("purchases", since=since))
+            feed.seed("spin", db.iter_history("spins", since=since))
+            feed.seed("withdrawal", (w for w in reversed(db.get_withdrawal_requests())
+                                     if w.get("created_at", 0) >= since))
+            feed.attach(db.events)
+            live_feed = feed
+        return live_feed
+
+def _sse(event: str, data: Any) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.route("/api/live")
+@check_admin
+@login_required
+@limiter.limit("30 per minute")
+def api_live():
+    """SSE-поток: события (deposit, purchase, spin, withdrawal, block) и счётчики"""
+    if not live_clients.acquire(blocking=False):
+        return jsonify({'error': 'Too many live connections'}), 503
+    try:
+        feed = get_live_feed()
+        subscription = db.events.subscribe()
+    except Exception:
+        live_clients.release()
+        raise
+    
+    def stream():
+        try:
+            yield _sse("counters", {"counters": feed.counters(), "users": db.get_users_summary()})
+            started = last_poll = last_counters = time.monotonic()
+            while time.monotonic() - started < LIVE_STREAM_TTL:
+                event = subscription.get(timeout=1.0)
+                if event is not None:
+                    yield _sse(event["type"], event)
+                
+                now = time.monotonic()
+                if now - last_poll >= 1.0:
+                    # Записи бота приходят через перечитывание файлов
+                    db.poll_events()
+                    last_poll = now
+                if now - last_counters >= LIVE_COUNTERS_INTERVAL:
+                    yield _sse("counters", {"counters": feed.counters(), "users": db.get_users_summary()})
+                    last_counters = now
+        finally:
+            subscription.close()
+    
+    response = Response(
+        stream_with_context(stream()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+    # Место освобождается, даже если клиент ушёл до первого события
+    response.call_on_close(live_clients.release)
+    return response
+
+USERS_PAGE_SORTS = ("id", "balance", "total_deposited", "last_active")
+
+def _sanitize_user(user: Dict[str, Any]) -> Dict[str, Any]:
+    """Безопасное представление пользователя для API"""
+    uid = int(user.get("id") or user.get("user_id") or 0)
+    return {
+        "id": uid,
+        "username": sanitize_input(user.get("username") or f"User_{uid}"),
+        "balance": float(user.get("balance", 0)),
+        "total_deposited": float(user.get("total_deposited", 0)),
+        "total_bought": int(user.get("total_bought", 0)),
+        "last_active": user.get("last_active", 0),
+        "created_at": user.get("created_at", 0),
+        "is_blocked": bool(user.get("is_blocked", False))
+    }
+
+@app.route("/api/users")
+@check_admin
+@login_required
+@limiter.limit("120 per minute")
+def api_users():
+    """API постраничного списка пользователей (курсор, сортировка и фильтры на сервере)"""
+    sort = request.args.get("sort", "id")
+    order = request.args.get("order", "asc")
+    if sort not in USERS_PAGE_SORTS or order not in ("asc", "desc"):
+        abort(400)
+    
+    limit = request.args.get("limit", "50")
+    if not limit.isdigit():
+        abort(400)
+    limit = min(max(int(limit), 1), 200)
+    
+    cursor = request.args.get("cursor") or None
+    if cursor and not re.match(r'^-?[0-9.e+-]{1,32}:[0-9]{1,15}$', cursor):
+        abort(400)
+    
+    user_id = request.args.get("id", "").strip()
+    if user_id and not PATTERNS['user_id'].match(user_id):
+        abort(400)
+    
+    activity = request.args.get("activity") or None
+    if activity not in (None, "active", "recent", "inactive"):
+        abort(400)
+    
+    try:
+        result = db.get_users_page(
+            sort=sort,
+            order=order,
+            cursor=cursor,
+            limit=limit,
+            username=sanitize_input(request.args.get("username", "")) or None,
+            user_id=user_id or None,
+            activity=activity
+        )
+        result["users"] = [_sanitize_user(user) for user in result["users"]]
+        return jsonify(result)
+    except ValueError:
+        abort(400)
+    except Exception as e:
+        logger.error(f"Error in api_users: {e}")
+        abort(500)
+
 @app.route("/api/user/search", methods=["POST"])
 @check_admin
 @login_required
@@ -409,24 +518,14 @@ def api_user_search():
         if not query:
             return jsonify([])
         
-        users = db.get_all_users()
         results = []
-        
-        for user in users:
-            user_data = dict(user)
-            uid = str(user_data.get("id") or user_data.get("user_id", ""))
-            username = str(user_data.get("username", ""))
-            
-            # Поиск по ID или username
-            if query.lower() in uid or query.lower() in username.lower():
-                results.append({
-                    "id": int(uid) if uid.isdigit() else 0,
-                    "username": sanitize_input(username),
-                    "balance": float(user_data.get("balance", 0))
-                })
-                
-                if len(results) >= 10:  # Максимум 10 результатов
-                    break
+        for user in db.search_users(query, limit=10):  # Максимум 10 результатов
+            uid = str(user.get("id") or user.get("user_id", ""))
+            results.append({
+                "id": int(uid) if uid.isdigit() else 0,
+                "username": sanitize_input(str(user.get("username", ""))),
+                "balance": float(user.get("balance", 0))
+            })
         
         return jsonify(results)
     except Exception as e:
@@ -451,14 +550,11 @@ def api_user(user_id: str):
         if not user:
             abort(404)
         
-        # Получаем дополнительную статистику
-        user_deposits = db.get_user_deposits(user_id)
-        user_purchases = db.get_user_purchases(user_id)
-        user_spins = db.get_user_spins(user_id)
-        
-        # Подсчет статистики по спинам
-        total_bet = sum(float(s.get("bet", 0)) for s in user_spins)
-        total_win = sum(float(s.get("win", 0)) for s in user_spins)
+        # Сводка ведётся при записи событий - одно чтение по ключу
+        summary = db.get_user_summary(user_id)
+        spins = summary["spins"]
+        total_bet = float(spins.get("bet", 0))
+        total_win = float(spins.get("win", 0))
         casino_profit = total_win - total_bet
         
         # Санитизация данных перед отправкой
@@ -468,12 +564,16 @@ def api_user(user_id: str):
             "balance": float(user.get("balance", 0)),
             "total_bought": int(user.get("total_bought", 0)),
             "total_deposited": float(user.get("total_deposited", 0)),
-            "deposits_count": len(user_deposits),
-            "purchases_count": len(user_purchases),
-            "spins_count": len(user_spins),
+            "deposits_count": summary["deposits"]["count"],
+            "purchases_count": summary["purchases"]["count"],
+            "spins_count": spins["count"],
             "total_bet": total_bet,
             "total_win": total_win,
             "casino_profit": casino_profit,
+            "first_deposit_at": summary["deposits"]["first"],
+            "last_deposit_at": summary["deposits"]["last"],
+            "last_purchase_at": summary["purchases"]["last"],
+            "last_spin_at": spins["last"],
             "created_at": user.get("created_at", 0),
             "last_active": user.get("last_active", 0)
         }
@@ -667,77 +767,152 @@ def api_wallets():
         logger.error(f"Error in api_wallets: {e}")
         return jsonify([])
 
+HISTORY_CURSOR = re.compile(r'^[0-9.e+-]{1,32}:[0-9]{1,15}$')
+
+def _history_page(kind: str, sanitize) -> Any:
+    """Общая часть API журналов: курсоры before/after и размер страницы.
+
+    Без параметров - прежний формат: массив последних 100 записей от старых
+    к новым. С before/after/limit - страница {items, before, after, total}
+    от новых к старым (первая страница - только limit).
+    """
+    before = request.args.get("before") or None
+    after = request.args.get("after") or None
+    limit = request.args.get("limit", "100")
+    if (before and after) or not limit.isdigit():
+        abort(400)
+    if any(c and not HISTORY_CURSOR.match(c) for c in (before, after)):
+        abort(400)
+    paged = before is not None or after is not None or "limit" in request.args
+    
+    try:
+        page = db.get_history_page(kind, before=before, after=after, limit=min(max(int(limit), 1), 500))
+        items = [sanitize(item) for item in page["items"]]
+        if not paged:
+            items.reverse()
+            return jsonify(items)
+        page["items"] = items
+        return jsonify(page)
+    except ValueError:
+        abort(400)
+    except Exception as e:
+        logger.error(f"Error in api_{kind}: {e}")
+        if not paged:
+            return jsonify([])
+        abort(500)
+
 @app.route("/api/deposits")
 @check_admin
 @login_required
-@limiter.limit("30 per minute")
+@limiter.limit("60 per minute")
 def api_deposits():
-    """API для получения списка депозитов"""
-    try:
-        deposits = db.get_deposits_list()
-        
-        safe_deposits = []
-        for dep in deposits[-100:]:  # Последние 100
-            safe_deposits.append({
-                "user_id": dep.get("user_id"),
-                "amount": float(dep.get("amount", 0)),
-                "timestamp": dep.get("timestamp", 0),
-                "hash": (dep.get("hash", "")[:10] + "...") if dep.get("hash") else ""
-            })
-        
-        return jsonify(safe_deposits)
-    except Exception as e:
-        logger.error(f"Error in api_deposits: {e}")
-        return jsonify([])
+    """API депозитов: последние записи или страница по курсору before/after"""
+    return _history_page("deposits", lambda dep: {
+        "user_id": dep.get("user_id"),
+        "amount": float(dep.get("amount", 0)),
+        "timestamp": dep.get("timestamp", 0),
+        "hash": (dep.get("hash", "")[:10] + "...") if dep.get("hash") else ""
+    })
 
 @app.route("/api/purchases")
 @check_admin
 @login_required
-@limiter.limit("30 per minute")
+@limiter.limit("60 per minute")
 def api_purchases():
-    """API для получения списка покупок Stars"""
-    try:
-        purchases = db.get_purchases_list()
-        
-        safe_purchases = []
-        for pur in purchases[-100:]:  # Последние 100
-            safe_purchases.append({
-                "user_id": pur.get("user_id"),
-                "stars": int(pur.get("stars", 0)),
-                "amount": float(pur.get("amount", 0)),
-                "timestamp": pur.get("timestamp", 0)
-            })
-        
-        return jsonify(safe_purchases)
-    except Exception as e:
-        logger.error(f"Error in api_purchases: {e}")
-        return jsonify([])
+    """API покупок Stars: последние записи или страница по курсору"""
+    return _history_page("purchases", lambda pur: {
+        "user_id": pur.get("user_id"),
+        "stars": int(pur.get("stars", 0)),
+        "amount": float(pur.get("amount", 0)),
+        "timestamp": pur.get("timestamp", 0)
+    })
 
 @app.route("/api/spins")
 @check_admin
 @login_required
-@limiter.limit("30 per minute")
+@limiter.limit("60 per minute")
 def api_spins():
-    """API для получения списка спинов казино"""
+    """API спинов казино: последние записи или страница по курсору"""
+    return _history_page("spins", lambda spin: {
+        "user_id": spin.get("user_id"),
+        "spin_id": spin.get("spin_id", ""),
+        "bet": float(spin.get("bet", 0)),
+        "win": float(spin.get("win", 0)),
+        "combo": spin.get("combo", ""),
+        "mult": float(spin.get("mult", 0)),
+        "timestamp": spin.get("timestamp", 0)
+    })
+
+# Колонки выгрузок (порядок колонок CSV)
+EXPORT_FIELDS = {
+    "deposits": ("timestamp", "user_id", "amount", "hash", "from_address"),
+    "purchases": ("timestamp", "user_id", "stars", "amount", "tx_hash"),
+    "spins": ("timestamp", "user_id", "spin_id", "bet", "win", "combo", "mult", "chat_id"),
+    "transactions": ("timestamp", "user_id", "type", "amount", "description"),
+}
+
+def _parse_export_date(value: Optional[str]) -> Optional[float]:
+    """Дата YYYY-MM-DD (UTC) в timestamp; ValueError при неверном формате"""
+    if not value:
+        return None
+    return datetime.strptime(value, "%Y-%m-%d").replace(tzinfo=timezone.utc).timestamp()
+
+@app.route("/api/export/<kind>")
+@check_admin
+@login_required
+@limiter.limit("10 per minute")
+def api_export(kind: str):
+    """Потоковая выгрузка журнала в NDJSON или CSV.
+
+    Параметры: format=ndjson|csv, from/to - даты YYYY-MM-DD (to включительно),
+    user_id. Строки отдаются генератором, файл целиком в памяти не собирается.
+    """
+    fields = EXPORT_FIELDS.get(kind)
+    fmt = request.args.get("format", "ndjson")
+    if fields is None or fmt not in ("ndjson", "csv"):
+        abort(400)
+    
+    user_id = request.args.get("user_id", "").strip()
+    if user_id and not PATTERNS['user_id'].match(user_id):
+        abort(400)
     try:
-        spins = db.get_spins_list()
-        
-        safe_spins = []
-        for spin in spins[-100:]:  # Последние 100
-            safe_spins.append({
-                "user_id": spin.get("user_id"),
-                "spin_id": spin.get("spin_id", ""),
-                "bet": float(spin.get("bet", 0)),
-                "win": float(spin.get("win", 0)),
-                "combo": spin.get("combo", ""),
-                "mult": float(spin.get("mult", 0)),
-                "timestamp": spin.get("timestamp", 0)
-            })
-        
-        return jsonify(safe_spins)
-    except Exception as e:
-        logger.error(f"Error in api_spins: {e}")
-        return jsonify([])
+        since = _parse_export_date(request.args.get("from"))
+        until = _parse_export_date(request.args.get("to"))
+    except ValueError:
+        abort(400)
+    if until is not None:
+        until += 86400
+    
+    records = db.iter_history(kind, since=since, until=until, user_id=int(user_id) if user_id else None)
+    
+    def generate_ndjson():
+        for record in records:
+            yield json.dumps({f: record.get(f) for f in fields}, ensure_ascii=False) + "\n"
+    
+    def generate_csv():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(("date",) + fields)
+        for record in records:
+            ts = record.get("timestamp", 0)
+            date = datetime.fromtimestamp(ts, timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+            writer.writerow([date] + [record.get(f, "") for f in fields])
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    
+    period = f"{request.args.get('from') or 'start'}_{request.args.get('to') or 'now'}"
+    if fmt == "csv":
+        body, mimetype = generate_csv(), "text/csv; charset=utf-8"
+    else:
+        body, mimetype = generate_ndjson(), "application/x-ndjson"
+    
+    logger.info(f"Export {kind} ({fmt}) from {request.remote_addr}: {period}, user={user_id or 'all'}")
+    return Response(
+        stream_with_context(body),
+        mimetype=mimetype,
+        headers={"Content-Disposition": f"attachment; filename={kind}_{period}.{fmt}"}
+    )
 
 @app.route("/api/fee", methods=["POST"])
 @check_admin
@@ -783,7 +958,7 @@ def api_test_connection():
         
         # Тест TON API
         try:
-            balance = get_wallet_balance()
+            balance = fetch_wallet_balance()
             results["TON API"] = {
                 "status": balance >= 0,
                 "message": f"Balance: {balance:.2f} TON" if balance >= 0 else "Failed"
@@ -900,12 +1075,20 @@ if __name__ == "__main__":
 
 
 
+# Фоновый исполнитель рассылок; задания подбирает по аренде в БД, поэтому
+# воркеры нескольких процессов не отправляют одну рассылку дважды
+broadcast_worker = BroadcastWorker(BOT_TOKEN, db, per_second=BROADCAST_RATE, lease=db.BROADCAST_LEASE)
+
+@app.before_request
+def ensure_broadcast_worker():
+    if not broadcast_worker.running:
+        broadcast_worker.start()
+
 @app.route('/broadcast')
 @login_required
 def broadcast_page():
     """Страница рассылки"""
-    users = db.get_all_users()
-    total_users = len(users)
+    total_users = db.get_user_count()
     
     return f'''<!DOCTYPE html>
 <html>
@@ -1092,6 +1275,10 @@ def broadcast_page():
                         <input type="radio" name="audience" value="selected" onchange="toggleUsernames()">
                         <span>Выбранным пользователям</span>
                     </label>
+                    <label class="radio-item">
+                        <input type="radio" name="audience" value="segment" onchange="toggleUsernames()">
+                        <span>Сегменту</span>
+                    </label>
                 </div>
     </div>
             </div>
@@ -1106,6 +1293,22 @@ def broadcast_page():
             </div>
     </div>
 
+            <div class="form-group hidden" id="segment-block">
+                <label>🎯 Сегмент</label>
+                <select name="language">
+                    <option value="">Любой язык</option>
+                    <option value="ru">RU</option>
+                    <option value="en">EN</option>
+                </select>
+                <input type="number" name="active_days" min="1" placeholder="Активны за последние N дней">
+                <input type="number" name="min_balance" step="0.01" min="0" placeholder="Баланс от, TON">
+                <input type="number" name="min_deposited" step="0.01" min="0" placeholder="Депозитов от, TON">
+                <small style="color: #666; display: block; margin-top: 4px;">
+                    Пустые поля не учитываются. <a href="#" onclick="countAudience(); return false;">Посчитать получателей</a>
+                    <span id="audience-count"></span>
+                </small>
+            </div>
+
             <div class="buttons-section">
                 <label style="margin-bottom: 12px; display: block;">🔘 Инлайн-кнопки</label>
                 <div id="buttons-container"></div>
@@ -1128,6 +1331,14 @@ def broadcast_page():
             }} else {{
                 block.classList.add('hidden');
             }}
+            document.getElementById('segment-block').classList.toggle('hidden', selected !== 'segment');
+        }}
+
+        async function countAudience() {{
+            const form = new FormData(document.querySelector('form'));
+            const response = await fetch('/api/broadcast/audience', {{method: 'POST', body: form}});
+            const data = await response.json();
+            document.getElementById('audience-count').textContent = '— ' + (data.count ?? data.error);
         }}
 
         function addButton() {{
@@ -1156,30 +1367,53 @@ def broadcast_page():
 </html>
 '''
 
+def _form_number(form, name: str) -> Optional[float]:
+    value = form.get(name, '').strip()
+    try:
+        return float(value) if value else None
+    except ValueError:
+        return None
+
+def audience_from_form(form) -> List[int]:
+    """Получатели рассылки по полям формы (через индексы пользователей)"""
+    audience = form.get('audience', 'all')
+    if audience == 'selected':
+        usernames_input = form.get('usernames', '')
+        usernames = [u.strip().replace('@', '') for u in usernames_input.replace(',', ' ').split() if u.strip()]
+        return db.select_audience(usernames=usernames)
+    if audience == 'segment':
+        return db.select_audience(
+            language=form.get('language') or None,
+            active_days=_form_number(form, 'active_days'),
+            min_balance=_form_number(form, 'min_balance'),
+            min_deposited=_form_number(form, 'min_deposited')
+        )
+    return db.select_audience()
+
+@app.route('/api/broadcast/audience', methods=['POST'])
+@login_required
+def api_broadcast_audience():
+    """Количество получателей для выбранной аудитории"""
+    try:
+        return jsonify({'count': len(audience_from_form(request.form))})
+    except Exception as e:
+        logger.error(f"Error selecting audience: {e}")
+        return jsonify({'error': 'Audience error'}), 500
+
 @app.route('/broadcast/send', methods=['POST'])
 @login_required
 def broadcast_send():
     """Отправка рассылки"""
     message_text = request.form.get('message', '').strip()
     photo_url = request.form.get('photo_url', '').strip() or None
-    audience = request.form.get('audience', 'all')
     
     if not message_text:
         return '<h1>Ошибка: текст сообщения пустой</h1><a href="/broadcast">Назад</a>'
     
-    # Получаем список user_id
-    users = db.get_all_users()
-    if audience == 'all':
-        user_ids = [int(user.get('id') or user.get('user_id', 0)) for user in users if user.get('id') or user.get('user_id')]
-    else:
-        usernames_input = request.form.get('usernames', '')
-        usernames = [u.strip().replace('@', '') for u in usernames_input.replace(',', ' ').split() if u.strip()]
-        user_ids = []
-        for user in users:
-            if user.get('username') in usernames:
-                uid = user.get('id') or user.get('user_id')
-                if uid:
-                    user_ids.append(int(uid))
+    user_ids = audience_from_form(request.form)
+    
+    if not user_ids:
+        return '<h1>Ошибка: нет получателей</h1><a href="/broadcast">Назад</a>'
     
     # Собираем кнопки
     buttons = []
@@ -1196,22 +1430,27 @@ def broadcast_send():
                     'callback': btn_url if btn_type == 'callback' else None
                 })
     
-    # Отправляем рассылку
-    import asyncio
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    result = loop.run_until_complete(
-        send_broadcast_to_users(user_ids, message_text, photo_url, buttons)
-    )
-    loop.close()
-    
+    # Рассылка выполняется фоновым воркером, страница показывает прогресс
+    job = db.create_broadcast_job(message_text, user_ids, photo_url, buttons)
+    broadcast_worker.submit(job['id'])
+    logger.info(f"Broadcast {job['id']} queued by admin: {len(user_ids)} recipients")
+    return redirect(url_for('broadcast_status_page', job_id=job['id']))
+
+@app.route('/broadcast/<job_id>')
+@login_required
+def broadcast_status_page(job_id):
+    """Страница прогресса рассылки"""
+    if not db.get_broadcast_job(job_id):
+        abort(404)
+    job_id = escape(job_id)
+
     return f'''<!DOCTYPE html>
 <html>
 <head>
     <meta charset="utf-8">
-    <title>Результат рассылки</title>
+    <title>Прогресс рассылки</title>
     <style>
-        body {{{{
+        body {{
             font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, sans-serif;
             background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
             min-height: 100vh;
@@ -1219,139 +1458,145 @@ def broadcast_send():
             align-items: center;
             justify-content: center;
             margin: 0;
-        }}}}
-        .result-card {{{{
+        }}
+        .result-card {{
             background: white;
             padding: 40px;
             border-radius: 12px;
             box-shadow: 0 4px 20px rgba(0,0,0,0.2);
             text-align: center;
-            max-width: 500px;
-        }}}}
-        .success-icon {{{{ font-size: 60px; margin-bottom: 20px; }}}}
-        h1 {{{{ color: #28a745; margin-bottom: 20px; }}}}
-        .stats {{{{
+            width: 500px;
+        }}
+        h1 {{ color: #333; margin-bottom: 20px; }}
+        .progress {{
+            background: #e0e0e0;
+            border-radius: 8px;
+            height: 16px;
+            overflow: hidden;
+        }}
+        .progress-bar {{
+            background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
+            height: 100%;
+            width: 0;
+            transition: width 0.5s;
+        }}
+        .stats {{
             background: #f8f9fa;
             padding: 20px;
             border-radius: 8px;
             margin: 20px 0;
-        }}}}
-        .stat-row {{{{
+        }}
+        .stat-row {{
             display: flex;
             justify-content: space-between;
             padding: 8px 0;
             border-bottom: 1px solid #e0e0e0;
-        }}}}
-        .stat-row:last-child {{{{ border-bottom: none; }}}}
-        .buttons {{{{
+        }}
+        .stat-row:last-child {{ border-bottom: none; }}
+        .buttons {{
             display: flex;
             gap: 12px;
             margin-top: 24px;
-        }}}}
-        .btn {{{{
+        }}
+        .btn {{
             flex: 1;
             padding: 12px;
             text-decoration: none;
+            border: none;
             border-radius: 8px;
             font-weight: 600;
-            transition: transform 0.2s;
-        }}}}
-        .btn:hover {{{{ transform: translateY(-2px); }}}}
-        .btn-primary {{{{
-            background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-            color: white;
-        }}}}
-        .btn-secondary {{{{
-            background: #6c757d;
+            font-size: 14px;
+            cursor: pointer;
             color: white;
-        }}}}
+        }}
+        .btn-primary {{ background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); }}
+        .btn-secondary {{ background: #6c757d; }}
+        .btn-danger {{ background: #dc3545; }}
+        .hidden {{ display: none; }}
     </style>
 </head>
 <body>
     <div class="result-card">
-        <div class="success-icon">✅</div>
-        <h1>Рассылка завершена</h1>
+        <h1 id="title">📤 Рассылка выполняется</h1>
+        <div class="progress"><div class="progress-bar" id="bar"></div></div>
         <div class="stats">
-            <div class="stat-row">
-                <span>Успешно отправлено:</span>
-                <strong style="color: #28a745;">{result['success']}</strong>
-            </div>
-    </div>
-            <div class="stat-row">
-                <span>Не удалось отправить:</span>
-                <strong style="color: #dc3545;">{result['failed']}</strong>
-            </div>
-    </div>
-            <div class="stat-row">
-                <span>Всего пользователей:</span>
-                <strong>{result['success'] + result['failed']}</strong>
-            </div>
-    </div>
+            <div class="stat-row"><span>Обработано:</span><strong id="done">-</strong></div>
+            <div class="stat-row"><span>Успешно отправлено:</span><strong style="color: #28a745;" id="sent">-</strong></div>
+            <div class="stat-row"><span>Заблокировали бота:</span><strong style="color: #fd7e14;" id="blocked">-</strong></div>
+            <div class="stat-row"><span>Не удалось отправить:</span><strong style="color: #dc3545;" id="failed">-</strong></div>
         </div>
-    </div>
         <div class="buttons">
+            <button class="btn btn-danger" id="cancel-btn" onclick="cancelJob()">Остановить</button>
             <a href="/broadcast" class="btn btn-secondary">Новая рассылка</a>
             <a href="/" class="btn btn-primary">На главную</a>
         </div>
     </div>
-    </div>
+
+    <script>
+        const jobId = '{job_id}';
+        const titles = {{
+            queued: '⏳ Рассылка в очереди',
+            running: '📤 Рассылка выполняется',
+            completed: '✅ Рассылка завершена',
+            cancelled: '⛔ Рассылка остановлена',
+            failed: '❌ Ошибка рассылки'
+        }};
+        let timer = null;
+
+        async function refresh() {{
+            try {{
+                const response = await fetch('/api/broadcast/' + jobId);
+                const job = await response.json();
+                const percent = job.total ? Math.floor(job.cursor * 100 / job.total) : 100;
+                document.getElementById('title').textContent = titles[job.status] || job.status;
+                document.getElementById('bar').style.width = percent + '%';
+                document.getElementById('done').textContent = job.cursor + ' / ' + job.total + ' (' + percent + '%)';
+                document.getElementById('sent').textContent = job.sent;
+                document.getElementById('blocked').textContent = job.blocked;
+                document.getElementById('failed').textContent = job.failed;
+                if (job.status !== 'queued' && job.status !== 'running') {{
+                    document.getElementById('cancel-btn').classList.add('hidden');
+                    clearInterval(timer);
+                }}
+            }} catch (error) {{
+                console.error('Error loading broadcast status:', error);
+            }}
+        }}
+
+        async function cancelJob() {{
+            if (!confirm('Остановить рассылку?')) return;
+            await fetch('/api/broadcast/' + jobId + '/cancel', {{method: 'POST'}});
+            refresh();
+        }}
+
+        refresh();
+        timer = setInterval(refresh, 2000);
+    </script>
 </body>
 </html>
 '''
 
-async def send_broadcast_to_users(user_ids, text, photo_url=None, buttons=None):
-    """Отправка рассылки пользователям"""
-    from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-    from aiogram import Bot
-    import logging
-    import asyncio
-    
-    logger = logging.getLogger(__name__)
-    success = 0
-    failed = 0
-    
-    # Используем BOT_TOKEN из глобальной области
-    bot_instance = Bot(token=BOT_TOKEN)
-    
-    # Формируем клавиатуру
-    keyboard = None
-    if buttons:
-        kb_buttons = []
-        for btn in buttons:
-            if btn.get('url'):
-                kb_buttons.append([InlineKeyboardButton(text=btn['text'], url=btn['url'])])
-            elif btn.get('callback'):
-                kb_buttons.append([InlineKeyboardButton(text=btn['text'], callback_data=btn['callback'])])
-        if kb_buttons:
-            keyboard = InlineKeyboardMarkup(inline_keyboard=kb_buttons)
-    
-    try:
-        for user_id in user_ids:
-            try:
-                if photo_url:
-                    await bot_instance.send_photo(
-                        chat_id=user_id,
-                        photo=photo_url,
-                        caption=text,
-                        reply_markup=keyboard,
-                        parse_mode='HTML'
-                    )
-                else:
-                    await bot_instance.send_message(
-                        chat_id=user_id,
-                        text=text,
-                        reply_markup=keyboard,
-                        parse_mode='HTML'
-                    )
-                success += 1
-                await asyncio.sleep(0.05)
-            except Exception as e:
-                logger.error(f"Broadcast failed for {user_id}: {e}")
-                failed += 1
-    finally:
-        await bot_instance.session.close()
-    
-    return {'success': success, 'failed': failed}
+@app.route('/api/broadcast/<job_id>')
+@login_required
+def api_broadcast_status(job_id):
+    """Статус и прогресс задания рассылки"""
+    job = db.get_broadcast_job(job_id)
+    if not job:
+        return jsonify({'error': 'Not found'}), 404
+    return jsonify({
+        key: job.get(key) for key in (
+            'id', 'status', 'total', 'cursor', 'sent', 'failed', 'blocked',
+            'error', 'created_at', 'started_at', 'finished_at'
+        )
+    })
+
+@app.route('/api/broadcast/<job_id>/cancel', methods=['POST'])
+@login_required
+def api_broadcast_cancel(job_id):
+    """Остановить рассылку"""
+    if broadcast_worker.cancel(job_id):
+        return jsonify({'ok': True})
+    return jsonify({'error': 'Job is not active'}), 400
 
 @app.route('/users')
 @check_admin
@@ -1389,7 +1634,7 @@ def users_page():
     <div class="max-w-7xl mx-auto px-4 py-8">
         <!-- Фильтры -->
         <div class="bg-white rounded-lg shadow p-6 mb-6">
-            <div class="grid grid-cols-1 md:grid-cols-3 gap-4">
+            <div class="grid grid-cols-1 md:grid-cols-4 gap-4">
                 <input type="text" id="search-username" class="filter-input" placeholder="🔍 Поиск по username...">
                 <input type="number" id="search-id" class="filter-input" placeholder="🔍 Поиск по ID...">
                 <select id="filter-activity" class="filter-input">
@@ -1398,6 +1643,12 @@ def users_page():
                     <option value="recent">Недавние (7д)</option>
                     <option value="inactive">Неактивные</option>
                 </select>
+                <select id="sort-by" class="filter-input">
+                    <option value="id:asc">По ID</option>
+                    <option value="balance:desc">По балансу</option>
+                    <option value="total_deposited:desc">По депозитам</option>
+                    <option value="last_active:desc">По активности</option>
+                </select>
             </div>
         <!-- Статистика -->
         </div>
@@ -1437,88 +1688,98 @@ def users_page():
                     <tr><td colspan="7" class="text-center py-8 text-gray-500">Загрузка...</td></tr>
                 </tbody>
             </table>
+            <div class="flex justify-between items-center px-6 py-4 bg-gray-50">
+                <span class="text-sm text-gray-500" id="shown-count"></span>
+                <button id="load-more" class="hidden px-4 py-2 bg-blue-600 text-white rounded hover:bg-blue-700" onclick="loadMore()">Загрузить ещё</button>
+            </div>
         </div>
     </div>
     </div>
 
     <script>
-        let allUsers = [];
-        let filteredUsers = [];
+        const PAGE_SIZE = 50;
+        let shownUsers = [];
+        let nextCursor = null;
+        let totalFiltered = 0;
+        let requestSeq = 0;
+        let filterTimer = null;
+
+        function pageQuery(cursor) {
+            const [sort, order] = document.getElementById('sort-by').value.split(':');
+            const params = new URLSearchParams({sort: sort, order: order, limit: PAGE_SIZE});
+            const username = document.getElementById('search-username').value.trim();
+            const id = document.getElementById('search-id').value.trim();
+            const activity = document.getElementById('filter-activity').value;
+            if (username) params.set('username', username);
+            if (id) params.set('id', id);
+            if (activity) params.set('activity', activity);
+            if (cursor) params.set('cursor', cursor);
+            return '/api/users?' + params.toString();
+        }
 
-        async function loadUsers() {
+        async function loadSummary() {
             try {
                 const response = await fetch('/api/stats');
                 const data = await response.json();
-                allUsers = data.users || [];
-                filteredUsers = allUsers;
-                
-                updateStats();
+                const summary = data.users_summary || {};
+
+                document.getElementById('total-count').textContent = summary.total || 0;
+                document.getElementById('active-count').textContent = summary.active_24h || 0;
+                document.getElementById('total-balance').textContent = (summary.total_balance || 0).toFixed(2) + ' TON';
+                document.getElementById('total-deposited').textContent = (summary.total_deposited || 0).toFixed(2) + ' TON';
+            } catch (error) {
+                console.error('Error loading stats:', error);
+            }
+        }
+
+        async function loadUsers() {
+            // Первая страница с текущими фильтрами и сортировкой
+            const seq = ++requestSeq;
+            try {
+                const response = await fetch(pageQuery(null));
+                const data = await response.json();
+                if (seq !== requestSeq) return;  // пришёл ответ на устаревший фильтр
+                shownUsers = data.users || [];
+                nextCursor = data.next_cursor;
+                totalFiltered = data.total || 0;
                 renderTable();
-                
-                // Применяем фильтры
-                document.getElementById('search-username').addEventListener('input', applyFilters);
-                document.getElementById('search-id').addEventListener('input', applyFilters);
-                document.getElementById('filter-activity').addEventListener('change', applyFilters);
             } catch (error) {
                 console.error('Error loading users:', error);
             }
         }
 
-        function updateStats() {
-            const now = Date.now() / 1000;
-            const active24h = allUsers.filter(u => (now - (u.last_active || 0)) < 86400).length;
-            const totalBalance = allUsers.reduce((sum, u) => sum + (u.balance || 0), 0);
-            const totalDeposited = allUsers.reduce((sum, u) => sum + (u.total_deposited || 0), 0);
-
-            document.getElementById('total-count').textContent = allUsers.length;
-            document.getElementById('active-count').textContent = active24h;
-            document.getElementById('total-balance').textContent = totalBalance.toFixed(2) + ' TON';
-            document.getElementById('total-deposited').textContent = totalDeposited.toFixed(2) + ' TON';
+        async function loadMore() {
+            if (!nextCursor) return;
+            const seq = requestSeq;
+            try {
+                const response = await fetch(pageQuery(nextCursor));
+                const data = await response.json();
+                if (seq !== requestSeq) return;
+                shownUsers = shownUsers.concat(data.users || []);
+                nextCursor = data.next_cursor;
+                renderTable();
+            } catch (error) {
+                console.error('Error loading users:', error);
+            }
         }
 
         function applyFilters() {
-            const usernameQuery = document.getElementById('search-username').value.toLowerCase();
-            const idQuery = document.getElementById('search-id').value;
-            const activityFilter = document.getElementById('filter-activity').value;
-            const now = Date.now() / 1000;
-
-            filteredUsers = allUsers.filter(user => {
-                // Фильтр по username
-                if (usernameQuery && !user.username.toLowerCase().includes(usernameQuery)) {
-                    return false;
-                }
-                
-                // Фильтр по ID
-                if (idQuery && !String(user.id).includes(idQuery)) {
-                    return false;
-                }
-                
-                // Фильтр по активности
-                if (activityFilter) {
-                    const lastActive = user.last_active || 0;
-                    const diff = now - lastActive;
-                    
-                    if (activityFilter === 'active' && diff >= 86400) return false;
-                    if (activityFilter === 'recent' && (diff < 86400 || diff >= 604800)) return false;
-                    if (activityFilter === 'inactive' && diff < 604800) return false;
-                }
-                
-                return true;
-            });
-
-            renderTable();
+            clearTimeout(filterTimer);
+            filterTimer = setTimeout(loadUsers, 300);
         }
 
         function renderTable() {
             const tbody = document.getElementById('users-table');
+            document.getElementById('shown-count').textContent = `Показано ${shownUsers.length} из ${totalFiltered}`;
+            document.getElementById('load-more').classList.toggle('hidden', !nextCursor);
             
-            if (filteredUsers.length === 0) {
+            if (shownUsers.length === 0) {
                 tbody.innerHTML = '<tr><td colspan="7" class="text-center py-8 text-gray-500">Пользователи не найдены</td></tr>';
                 return;
             }
 
             const now = Date.now() / 1000;
-            tbody.innerHTML = filteredUsers.map(user => {
+            tbody.innerHTML = shownUsers.map(user => {
                 const lastActive = user.last_active || 0;
                 const diff = now - lastActive;
                 let statusBadge, statusText;
@@ -1661,6 +1922,7 @@ def users_page():
                 if (res.ok) {
                     alert('Баланс изменён!');
                     loadUserDetails(userId);
+                    loadSummary();
                     loadUsers();
                 } else {
                     alert('Ошибка изменения баланса');
@@ -1671,10 +1933,15 @@ def users_page():
         }
         
         // Загрузка при старте
+        document.getElementById('search-username').addEventListener('input', applyFilters);
+        document.getElementById('search-id').addEventListener('input', applyFilters);
+        document.getElementById('filter-activity').addEventListener('change', loadUsers);
+        document.getElementById('sort-by').addEventListener('change', loadUsers);
+        loadSummary();
         loadUsers();
         
-        // Автообновление каждые 30 секунд
-        setInterval(loadUsers, 30000);
+        // Автообновление сводки каждые 30 секунд (страницы списка не сбрасываются)
+        setInterval(loadSummary, 30000);
     </script>
 </body>
 </html>
@@ -1917,9 +2184,7 @@ def partners_page():
 @login_required
 def api_partners_list():
     """Список всех партнёров"""
-    partners = db.get_all_partners()
-    print(f"API partners: {partners}")
-    return jsonify(partners)
+    return jsonify(db.get_all_partners())
 
 
 @app.route('/api/partners/withdrawals')